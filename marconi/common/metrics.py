@@ -0,0 +1,246 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Metrics library.
+
+Storage drivers and other components record counters and
+histograms against a sink. Sinks are loaded by name from the
+`marconi.common.metrics.sinks` entry point namespace, and are
+shared by every component in the process that asks for the
+same sink, so that one of them (e.g., the admin API) can read
+back what the others recorded.
+
+Supported configuration options:
+
+`sink`: Name of the metrics sink to use.
+"""
+
+import abc
+import collections
+import threading
+
+from oslo.config import cfg
+import six
+from stevedore import driver
+
+
+_METRICS_OPTIONS = [
+    cfg.StrOpt('sink', default='memory',
+               help='The metrics sink to use, default value is `memory`.'),
+]
+
+_METRICS_GROUP = 'metrics'
+
+# Upper bounds for histogram buckets. These are
+# coarse on purpose, and cover both small counts (e.g., attempts)
+# and short durations, in seconds (e.g., backoff sleeps).
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                     1, 2, 5, 10, 50, 100, 500, 1000)
+
+# Default maximum number of scopes (e.g., queues) for which
+# to keep metrics in a registry, in addition to the global ones.
+MAX_SCOPES = 1000
+
+_SINKS = {}
+
+
+def get_sink(conf):
+    """Loads the metrics sink specified in the given configuration.
+
+    Sinks are cached by name, so every caller in the process
+    gets the same instance.
+
+    :param conf: Configuration instance to use
+    """
+    conf.register_opts(_METRICS_OPTIONS, group=_METRICS_GROUP)
+    name = conf[_METRICS_GROUP].sink
+
+    try:
+        return _SINKS[name]
+    except KeyError:
+        mgr = driver.DriverManager('marconi.common.metrics.sinks', name,
+                                   invoke_on_load=True)
+
+        return _SINKS.setdefault(name, mgr.driver)
+
+
+@six.add_metaclass(abc.ABCMeta)
+class Sink(object):
+    """Interface for metrics sinks.
+
+    Every metric is recorded globally and, when a scope is given,
+    for that scope as well (e.g., a fully-scoped queue name).
+    """
+
+    @abc.abstractmethod
+    def incr(self, name, value=1, scope=None):
+        """Increments a counter.
+
+        :param name: Name of the counter
+        :param value: (Default 1) Amount by which to increment it
+        :param scope: (Default None) Additional scope under which
+            to record the value.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def observe(self, name, value, scope=None):
+        """Records a single value in a histogram.
+
+        :param name: Name of the histogram
+        :param value: Value to record
+        :param scope: (Default None) Additional scope under which
+            to record the value.
+        """
+        raise NotImplementedError
+
+    def snapshot(self, scope=None):
+        """Returns the metrics recorded so far, if supported.
+
+        :param scope: (Default None) Only return metrics recorded
+            for this scope.
+        :returns: A dict, or None if the sink can not be read back.
+        """
+        return None
+
+
+class NullSink(Sink):
+    """Discards everything it is given."""
+
+    def incr(self, name, value=1, scope=None):
+        pass
+
+    def observe(self, name, value, scope=None):
+        pass
+
+
+class Registry(Sink):
+    """Thread-safe, in-process metrics registry.
+
+    Metrics are kept for a bounded number of scopes. When that
+    number is reached, the metrics for the least-recently updated
+    scope are discarded to make room for a new one, so that scopes
+    that are no longer used (e.g., deleted queues) do not pile up.
+    Global metrics are always kept.
+
+    :param max_scopes: (Default MAX_SCOPES) Maximum number of
+        scopes for which to keep metrics
+    """
+
+    def __init__(self, max_scopes=MAX_SCOPES):
+        self._lock = threading.Lock()
+        self._max_scopes = max_scopes
+        self._global = ({}, {})
+        self._scopes = collections.OrderedDict()
+
+    def _metrics_for(self, scope):
+        if scope is None:
+            return self._global
+
+        try:
+            metrics = self._scopes.pop(scope)
+        except KeyError:
+            metrics = ({}, {})
+            if len(self._scopes) >= self._max_scopes:
+                self._scopes.popitem(last=False)
+
+        self._scopes[scope] = metrics
+        return metrics
+
+    def incr(self, name, value=1, scope=None):
+        with self._lock:
+            for key in _keys(scope):
+                counters = self._metrics_for(key)[0]
+                counters[name] = counters.get(name, 0) + value
+
+    def observe(self, name, value, scope=None):
+        with self._lock:
+            for key in _keys(scope):
+                histograms = self._metrics_for(key)[1]
+
+                try:
+                    histogram = histograms[name]
+                except KeyError:
+                    histogram = histograms[name] = {
+                        'count': 0,
+                        'sum': 0,
+                        'buckets': [0] * (len(HISTOGRAM_BUCKETS) + 1),
+                    }
+
+                histogram['count'] += 1
+                histogram['sum'] += value
+                histogram['buckets'][_bucket(value)] += 1
+
+    def snapshot(self, scope=None):
+        """Returns a copy of the metrics recorded so far.
+
+        :param scope: (Default None) Only return metrics recorded
+            for this scope.
+
+        :returns: A dict of the form::
+
+                {
+                    'global': {'counters': {...}, 'histograms': {...}},
+                    'scopes': {scope: {...}, ...}
+                }
+
+            If `scope` is given, only the metrics for that
+            scope are returned, using the same format as
+            'global', above.
+        """
+        with self._lock:
+            if scope is not None:
+                return _export(self._scopes.get(scope, ({}, {})))
+
+            return {
+                'global': _export(self._global),
+                'scopes': dict((key, _export(metrics))
+                               for key, metrics in self._scopes.items()),
+            }
+
+    def reset(self):
+        """Discards every metric recorded so far."""
+        with self._lock:
+            self._global = ({}, {})
+            self._scopes = collections.OrderedDict()
+
+
+def _keys(scope):
+    return (None,) if scope is None else (None, scope)
+
+
+def _bucket(value):
+    for index, bound in enumerate(HISTOGRAM_BUCKETS):
+        if value <= bound:
+            return index
+
+    return len(HISTOGRAM_BUCKETS)
+
+
+def _export(metrics):
+    counters, histograms = metrics
+    bounds = [str(bound) for bound in HISTOGRAM_BUCKETS] + ['+Inf']
+
+    return {
+        'counters': dict(counters),
+        'histograms': dict(
+            (name, {
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'buckets': dict(zip(bounds, histogram['buckets'])),
+            })
+            for name, histogram in histograms.items()
+        ),
+    }
@@ -28,8 +28,23 @@ that is not None.
 
 At least one of the stages has to implement the calling method. If none of
 them do, an AttributeError exception will be raised.
+
+A stage may also implement `after_{method}`, which is called with the
+result, followed by the method's arguments, once a later stage has
+returned it (or once every stage has been called, with a result of None).
+Hooks are called in reverse order, and are not called if a stage raises
+an exception. This lets a stage act on a result without producing it,
+e.g., to cache it.
+
+The stages implementing each method are looked up once, the first time the
+method is called, and looked up again only after a new stage is appended.
+
+Optionally, the time spent in each stage can be recorded in a metrics sink
+(see `marconi.common.metrics`), under 'pipeline.{method}.{stage}'.
 """
 
+import time
+
 import six
 
 from marconi.common import decorators
@@ -39,17 +54,63 @@ LOG = logging.getLogger(__name__)
 
 
 class Pipeline(object):
+    """Calls a method on each stage in turn, until one returns a value.
 
-    def __init__(self, pipeline=None):
+    :param pipeline: (Default None) Iterable of stages
+    :param sink: (Default None) Metrics sink in which to record the
+        time spent in each stage, in seconds. Stages are not timed
+        when no sink is given.
+    """
+
+    def __init__(self, pipeline=None, sink=None):
         self._pipeline = pipeline and list(pipeline) or []
+        self._sink = sink
+        self._targets = {}
 
     def append(self, stage):
         self._pipeline.append(stage)
 
+        # Consumers resolve their targets again on
+        # their next call.
+        self._targets = {}
+
     @decorators.cached_getattr
     def __getattr__(self, name):
         return self.consumer_for(name)
 
+    def _resolve(self, method):
+        """Lists the stages implementing `method`, in order.
+
+        :returns: A tuple of (stage name, bound method, bound hook)
+            triples, where the hook is None unless the stage
+            implements `after_{method}`
+        """
+
+        targets = []
+
+        for stage in self._pipeline:
+            try:
+                target = getattr(stage, method)
+            except AttributeError:
+                sstage = six.text_type(stage)
+                msgtmpl = _(u"Stage %(stage)s does not "
+                            "implement %(method)s")
+                LOG.debug(msgtmpl, {'stage': sstage, 'method': method})
+                continue
+
+            # Look the hook up on the class, since stages
+            # such as nested pipelines respond to any attribute.
+            hook = None
+            if hasattr(type(stage), 'after_' + method):
+                hook = getattr(stage, 'after_' + method)
+
+            targets.append((type(stage).__name__, target, hook))
+
+        targets = tuple(targets)
+        self._targets[method] = targets
+
+        return targets
+
     def consumer_for(self, method):
         """Creates a closure for `method`
 
@@ -65,45 +126,53 @@ class Pipeline(object):
         def consumer(*args, **kwargs):
             """Consumes the pipeline for `method`
 
-            This function walks through the pipeline and calls
-            `method` for each of the items in the pipeline. A
-            warning will be logged for each stage not implementing
-            `method` and an Attribute error will be raised if
-            none of the stages do.
+            This function walks through the stages implementing
+            `method`, calling each of them in turn. An AttributeError
+            will be raised if none of the stages implement `method`.
 
             :param args: Positional arguments to pass to the call.
             :param kwargs: Keyword arguments to pass to the call.
 
             :raises: AttributeError if none of the stages implement `method`
             """
-            # NOTE(flaper87): Used as a way to verify
-            # the requested method exists in at least
-            # one of the stages, otherwise AttributeError
-            # will be raised.
-            target = None
-
-            for stage in self._pipeline:
-                try:
-                    target = getattr(stage, method)
-                except AttributeError:
-                    sstage = six.text_type(stage)
-                    msgtmpl = _(u"Stage %(stage)s does not "
-                                "implement %(method)s")
-                    LOG.warning(msgtmpl, {'stage': sstage, 'method': method})
-                    continue
-
-                result = target(*args, **kwargs)
+            try:
+                targets = self._targets[method]
+            except KeyError:
+                targets = self._resolve(method)
+
+            if not targets:
+                msg = _(u'Method %s not found in any of '
+                        'the registered stages') % method
+                LOG.error(msg)
+                raise AttributeError(msg)
+
+            sink = self._sink
+            hooks = []
+            result = None
+
+            for stage_name, target, hook in targets:
+                if sink is None:
+                    result = target(*args, **kwargs)
+                else:
+                    start = time.time()
+                    try:
+                        result = target(*args, **kwargs)
+                    finally:
+                        sink.observe('pipeline.%s.%s' % (method, stage_name),
+                                     time.time() - start)
 
                 # NOTE(flaper87): Will keep going forward
                 # through the stageline unless the call returns
                 # something.
                 if result is not None:
-                    return result
+                    break
 
-            if target is None:
-                msg = _(u'Method %s not found in any of '
-                        'the registered stages') % method
-                LOG.error(msg)
-                raise AttributeError(msg)
+                if hook is not None:
+                    hooks.append(hook)
+
+            for hook in reversed(hooks):
+                hook(result, *args, **kwargs)
+
+            return result
 
         return consumer
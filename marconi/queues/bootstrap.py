@@ -72,7 +72,7 @@ class Bootstrap(object):
             storage_driver = storage_utils.load_storage_driver(self.conf)
 
         LOG.debug(_(u'Loading storage pipeline'))
-        return pipeline.DataDriver(self.conf, storage_driver)
+        return pipeline.DataDriver(self.conf, storage_driver, self.cache)
 
     @decorators.lazy_property(write=False)
     def cache(self):
@@ -298,7 +298,7 @@ class MessageBase(ControllerBase):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def bulk_delete(self, queue, message_ids, project=None):
+    def bulk_delete(self, queue, message_ids, project=None, claim=None):
         """Base method for deleting multiple messages.
 
         :param queue: Name of the queue to post
@@ -306,6 +306,31 @@ class MessageBase(ControllerBase):
         :param message_ids: A sequence of message IDs
             to be deleted.
         :param project: Project id
+        :param claim: (Default None) If given, only delete the
+            messages that belong to this claim. Ownership must be
+            checked by the same operation that deletes them.
+
+        :returns: None if `claim` is None; otherwise, a list of the
+            given message IDs that were not deleted, because they are
+            still in the queue, but not part of the claim.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def pop(self, queue, limit, project=None):
+        """Base method for atomically claiming and deleting messages.
+
+        Removes up to `limit` active (i.e., unclaimed) messages from
+        the head of the queue, and returns them. Each message is
+        returned to at most one caller.
+
+        :param queue: Name of the queue to pop messages from
+        :param limit: Maximum number of messages to pop
+        :param project: Project id
+
+        :returns: A list of the messages that were removed, oldest
+            first. The list is empty if the queue does not exist, or
+            if it has no active messages.
         """
         raise NotImplementedError
 
@@ -0,0 +1,211 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time buckets for message collections.
+
+When enabled, messages are not stored in a single collection per
+partition. Instead, each partition database holds one messages
+collection per time bucket, named 'messages_{bucket}', where
+bucket is the number of `bucket_seconds` intervals between the
+UNIX epoch and the time the message was created.
+
+Since ObjectIds embed their generation time, the bucket that
+holds any given message can be found from its ID alone.
+
+The latest expiration time of the messages in each bucket is kept
+in the partition's 'buckets' collection. Once that time has passed,
+and the bucket no longer receives new messages, the whole collection
+is dropped, rather than relying on the TTL monitor to remove its
+messages one by one.
+
+Field Mappings:
+    Name        Field
+    -----------------
+    bucket   ->   _id
+    expires  ->     e
+"""
+
+import threading
+
+import pymongo.errors
+
+import marconi.openstack.common.log as logging
+from marconi.queues.storage.mongodb import utils
+
+
+LOG = logging.getLogger(__name__)
+
+# Maximum number of seconds for which to cache the list
+# of live buckets, and the minimum interval between attempts to drop
+# expired buckets.
+REFRESH_INTERVAL = 60
+
+
+class Buckets(object):
+    """Manages the time buckets in a single partition database.
+
+    :param database: Partition database
+    :param seconds: Length of each bucket, in seconds
+    :param ensure_indexes: Callable that creates the indexes for
+        a new messages collection, given the collection.
+    """
+
+    def __init__(self, database, seconds, ensure_indexes):
+        self._database = database
+        self._seconds = seconds
+        self._ensure_indexes = ensure_indexes
+        self._refresh_interval = min(seconds, REFRESH_INTERVAL)
+
+        self._meta = database.buckets
+        self._lock = threading.Lock()
+        self._ensured = set()
+        self._recorded = {}
+        self._live = []
+        self._live_expires = 0
+        self._reaped_at = 0
+
+    def bucket(self, ts):
+        """Gets the bucket for the given UNIX timestamp."""
+        return int(ts // self._seconds)
+
+    def bucket_for_id(self, oid):
+        """Gets the bucket holding the message with the given ID."""
+        return self.bucket(utils.oid_ts(oid))
+
+    def collection(self, bucket):
+        """Gets the messages collection for the given bucket.
+
+        The collection's indexes are created the first time a
+        bucket is requested by this process.
+        """
+        collection = self._database['messages_' + str(bucket)]
+
+        if bucket not in self._ensured:
+            self._ensure_indexes(collection)
+            self._ensured.add(bucket)
+
+        return collection
+
+    def existing(self, bucket):
+        """Gets the messages collection for the given bucket.
+
+        Unlike `collection`, this never creates any indexes, since
+        it is only used for lookups.
+        """
+        return self._database['messages_' + str(bucket)]
+
+    def collection_for_id(self, oid):
+        """Gets the collection holding the message with the given ID.
+
+        See also `existing`.
+        """
+        return self.existing(self.bucket_for_id(oid))
+
+    def live(self, now):
+        """Lists the collections of buckets that have not expired.
+
+        The buckets for the current and the previous interval are
+        always included, since they may have just been created
+        by another process.
+
+        :param now: Current UNIX timestamp
+        :returns: A list of collections, ordered oldest first.
+        """
+        if self._live_expires <= now:
+            docs = self._meta.find({'e': {'$gt': now}}, fields={'_id': 1})
+            self._live = [doc['_id'] for doc in docs]
+            self._live_expires = now + self._refresh_interval
+
+        current = self.bucket(now)
+        buckets = set(self._live)
+        buckets.update((current - 1, current))
+
+        return [self.existing(bucket) for bucket in sorted(buckets)]
+
+    def record(self, bucket, expires):
+        """Records the expiration time of messages added to a bucket.
+
+        :param bucket: Bucket the messages were added to
+        :param expires: Expiration time of the messages, as a UNIX
+            timestamp
+        """
+        if self._recorded.get(bucket, 0) >= expires:
+            return
+
+        try:
+            # Only move the expiration time forward. If
+            # the bucket already expires at or after the given time,
+            # the upsert raises DuplicateKeyError, and we are done.
+            self._meta.update({'_id': bucket, 'e': {'$lt': expires}},
+                              {'$set': {'e': expires}},
+                              upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            pass
+
+        with self._lock:
+            self._recorded[bucket] = max(self._recorded.get(bucket, 0),
+                                         expires)
+
+    def extend(self, message_ids, expires, now):
+        """Ensures that the buckets holding the given messages live
+        at least until the given time.
+
+        Buckets that have already expired are left alone, so that
+        they are still dropped.
+
+        :param message_ids: IDs of the messages whose expiration
+            time is being extended
+        :param expires: UNIX timestamp
+        :param now: Current UNIX timestamp
+        """
+        buckets = sorted(set(self.bucket_for_id(oid)
+                             for oid in message_ids))
+
+        self._meta.update({'_id': {'$in': buckets},
+                           'e': {'$gt': now, '$lt': expires}},
+                          {'$set': {'e': expires}},
+                          multi=True)
+
+    def reap(self, now):
+        """Drops buckets whose messages have all expired.
+
+        This is a no-op unless enough time has passed since
+        the last time it was called.
+
+        :param now: Current UNIX timestamp
+        """
+        if now - self._reaped_at < self._refresh_interval:
+            return
+
+        self._reaped_at = now
+
+        # Never drop the buckets for the current or
+        # previous interval, since they may still be receiving
+        # new messages.
+        query = {'_id': {'$lt': self.bucket(now) - 1}, 'e': {'$lte': now}}
+
+        for doc in self._meta.find(query, fields={'_id': 1}):
+            bucket = doc['_id']
+            LOG.debug(u'Dropping expired message bucket %(bucket)s',
+                      {'bucket': bucket})
+
+            self._database.drop_collection('messages_' + str(bucket))
+            self._meta.remove({'_id': bucket, 'e': {'$lte': now}})
+
+            with self._lock:
+                self._ensured.discard(bucket)
+                self._recorded.pop(bucket, None)
+
+        self._live_expires = 0
@@ -22,6 +22,7 @@ Field Mappings:
 """
 
 import datetime
+import random
 
 from bson import objectid
 
@@ -54,8 +55,52 @@ class ClaimController(storage.ClaimBase):
     requires less memory since a single index is
     required. The index is a compound index between
     the claim id and it's expiration timestamp.
+
+    Optionally (see the `separate_claims` option), claims
+    are also kept in a dedicated collection, next to the
+    messages collection in each partition. In that case,
+    messages are still tagged with the claim ID, but the
+    claim's expiration time is only stamped on them when
+    the claim is created, so that renewing a claim only
+    requires updating the claim document itself.
+
+    Claims:
+        Name                Field
+        -------------------------
+        scope           ->   p_q
+        ttl             ->     t
+        expires         ->     e
+        stamped         ->     s
+        msgs expire     ->     x
+        gc expires      ->     g
+
+    Where "stamped" is the claim expiration time that was
+    stamped on the claimed messages, and "msgs expire" is
+    the earliest time at which any of the claimed messages
+    may expire.
     """
 
+    def _claim_doc(self, queue, claim_id, project, now):
+        """Gets a live claim from the claims collection.
+
+        :returns: The claim, in the same format used for the
+            'c' field of claimed messages, or None if the
+            claim does not exist or has expired.
+        """
+        collection = self.driver.message_controller._claim_collection(
+            queue, project)
+
+        doc = collection.find_one({'_id': claim_id,
+                                   'p_q': utils.scope_queue_name(queue,
+                                                                 project),
+                                   'e': {'$gt': now}},
+                                  fields={'t': 1, 'e': 1})
+
+        if doc is None:
+            return None
+
+        return {'id': doc['_id'], 't': doc['t'], 'e': doc['e']}
+
     @utils.raises_conn_error
     def get(self, queue, claim_id, project=None):
         msg_ctrl = self.driver.message_controller
@@ -84,6 +129,13 @@ class ClaimController(storage.ClaimBase):
                                               project=project))
             claim = next(msgs)
 
+            if msg_ctrl._separate_claims:
+                # The claim stamped on the messages
+                # does not reflect any renewals.
+                claim = self._claim_doc(queue, cid, project, now)
+                if claim is None:
+                    raise exceptions.ClaimDoesNotExist(cid, queue, project)
+
             update_time = claim['e'] - claim['t']
             age = now - update_time
 
@@ -109,9 +161,13 @@ class ClaimController(storage.ClaimBase):
 
         Since there's a lot of space for race conditions here,
         we'll check if the number of updated records is equal to
-        the max number of messages to claim. If the number of updated
-        messages is lower than limit we'll try to claim the remaining
-        number of messages.
+        the number of messages we tried to claim. If it is, every
+        one of them was claimed by this request, and the claimed
+        messages are built from the documents that were already
+        read. Otherwise, some of them were claimed by a parallel
+        request, and the claimed messages are read back from the
+        primary in order to find out which ones were actually
+        tagged with the claim ID.
 
         This 2 queries are required because there's no way, as for the
         time being, to execute an update on a limited number of records.
@@ -140,8 +196,20 @@ class ClaimController(storage.ClaimBase):
 
         # Get a list of active, not claimed nor expired
         # messages that could be claimed.
-        msgs = msg_ctrl._active(queue, fields={'_id': 1}, project=project,
-                                limit=limit)
+        #
+        # Get everything needed to return the
+        # claimed messages, so that they don't have to be read
+        # again in the common case.
+        fields = {'_id': 1, 't': 1, 'e': 1, 'b': 1}
+        lanes = self.driver.mongodb_conf.claim_lanes
+        msgs = msg_ctrl._claimable(queue, fields, project=project,
+                                   limit=limit * lanes)
+
+        # Messages in lanes that were not chosen are
+        # not put back in the head cache, if it is enabled, but they
+        # will be seen again once the cached head is read again.
+        if len(msgs) > limit:
+            msgs = _choose_lane(msgs, limit)
 
         messages = iter([])
         ids = [msg['_id'] for msg in msgs]
@@ -149,6 +217,22 @@ class ClaimController(storage.ClaimBase):
         if len(ids) == 0:
             return (None, messages)
 
+        scope = utils.scope_queue_name(queue, project)
+
+        if msg_ctrl._separate_claims:
+            # Create the claim first, so that it
+            # is never missing while any messages refer to it.
+            claims = msg_ctrl._claim_collection(queue, project)
+            claims.insert({
+                '_id': oid,
+                'p_q': scope,
+                't': ttl,
+                'e': claim_expires,
+                's': claim_expires,
+                'x': claim_expires + grace,
+                'g': datetime.datetime.utcfromtimestamp(claim_expires),
+            })
+
         now = timeutils.utcnow_ts()
 
         # NOTE(kgriffs): Set the claim field for
@@ -156,31 +240,50 @@ class ClaimController(storage.ClaimBase):
         # filtering out any messages that happened
         # to get claimed just now by one or more
         # parallel requests.
-        #
-        # Filtering by just 'c.e' works because
-        # new messages have that field initialized
-        # to the current time when the message is
-        # posted. There is no need to check whether
-        # 'c' exists or 'c.id' is None.
-        collection = msg_ctrl._collection(queue, project)
-        updated = collection.update({'_id': {'$in': ids},
-                                     'c.e': {'$lte': now}},
-                                    {'$set': {'c': meta}},
-                                    upsert=False,
-                                    multi=True)['n']
+        msgs, updated = msg_ctrl._claim_head(queue, project, msgs, meta,
+                                             fields, now)
+        ids = [msg['_id'] for msg in msgs]
+
+        self.driver.metrics.observe('claims.create.claimed', updated,
+                                    scope=scope)
+
+        if updated != 0:
+            self.driver.queue_controller._update_stats(queue, project,
+                                                       claimed=updated)
+        elif msg_ctrl._separate_claims:
+            claims.remove({'_id': oid}, w=0)
 
         # NOTE(flaper87): Dirty hack!
         # This sets the expiration time to
         # `expires` on messages that would
         # expire before claim.
-        new_values = {'e': message_expiration, 't': message_ttl}
-        collection.update({'p_q': utils.scope_queue_name(queue, project),
-                           'e': {'$lt': message_expiration},
-                           'c.id': oid},
-                          {'$set': new_values},
-                          upsert=False, multi=True)
-
-        if updated != 0:
+        #
+        # Skip it when none of the
+        # messages read above would expire early,
+        # which is usually the case.
+        expiring = [msg for msg in msgs if msg['e'] < message_expiration]
+
+        if expiring:
+            msg_ctrl._extend_buckets(queue, project,
+                                     [msg['_id'] for msg in expiring],
+                                     claim_expires + grace)
+
+            new_values = {'e': message_expiration, 't': message_ttl}
+            msg_ctrl._update_all(queue, project,
+                                 {'p_q': scope,
+                                  'e': {'$lt': message_expiration},
+                                  'c.id': oid},
+                                 {'$set': new_values})
+
+        if updated == len(ids):
+            for msg in expiring:
+                msg['t'] = message_ttl
+
+            now = timeutils.utcnow_ts()
+            messages = iter([utils.basic_message(msg, now)
+                             for msg in msgs])
+
+        elif updated != 0:
             # NOTE(kgriffs): This extra step is necessary because
             # in between having gotten a list of active messages
             # and updating them, some of them may have been
@@ -202,6 +305,12 @@ class ClaimController(storage.ClaimBase):
         expires = now + ttl
 
         msg_ctrl = self.driver.message_controller
+        scope = utils.scope_queue_name(queue, project)
+
+        if msg_ctrl._separate_claims:
+            self._renew(queue, cid, ttl, expires, project, now)
+            return
+
         claimed = msg_ctrl._claimed(queue, cid, expires=now,
                                     limit=1, project=project)
 
@@ -218,23 +327,77 @@ class ClaimController(storage.ClaimBase):
 
         # TODO(kgriffs): Create methods for these so we don't interact
         # with the messages collection directly (loose coupling)
+        msg_ctrl._update_all(queue, project,
+                             {'p_q': scope, 'c.id': cid},
+                             {'$set': {'c': meta}})
+
+        # NOTE(flaper87): Dirty hack!
+        # This sets the expiration time to
+        # `expires` on messages that would
+        # expire before claim.
+        msg_ctrl._update_all(queue, project,
+                             {'p_q': scope,
+                              'e': {'$lt': expires},
+                              'c.id': cid},
+                             {'$set': {'e': expires, 't': ttl}})
+
+    def _renew(self, queue, claim_id, ttl, expires, project, now):
+        """Renews a claim kept in the claims collection.
+
+        In the common case, only the claim document is updated.
+        """
+        msg_ctrl = self.driver.message_controller
         scope = utils.scope_queue_name(queue, project)
-        collection = msg_ctrl._collection(queue, project)
-        collection.update({'p_q': scope, 'c.id': cid},
-                          {'$set': {'c': meta}},
-                          upsert=False, multi=True)
+        claims = msg_ctrl._claim_collection(queue, project)
+        expires_dt = datetime.datetime.utcfromtimestamp(expires)
+
+        claim = claims.find_and_modify(
+            {'_id': claim_id, 'p_q': scope, 'e': {'$gt': now}},
+            {'$set': {'t': ttl, 'e': expires, 'g': expires_dt}},
+            fields={'x': 1})
+
+        if claim is None:
+            raise exceptions.ClaimDoesNotExist(str(claim_id), queue, project)
+
+        if claim['x'] >= expires:
+            return
 
         # NOTE(flaper87): Dirty hack!
         # This sets the expiration time to
         # `expires` on messages that would
         # expire before claim.
-        collection.update({'p_q': scope,
-                           'e': {'$lt': expires},
-                           'c.id': cid},
-                          {'$set': {'e': expires, 't': ttl}},
-                          upsert=False, multi=True)
+        msg_ctrl._extend_claim_buckets(queue, project, claim_id, expires)
+        msg_ctrl._update_all(queue, project,
+                             {'p_q': scope,
+                              'e': {'$lt': expires_dt},
+                              'c.id': claim_id},
+                             {'$set': {'e': expires_dt, 't': ttl}})
+
+        claims.update({'_id': claim_id}, {'$set': {'x': expires}},
+                      upsert=False, multi=False)
 
     @utils.raises_conn_error
     def delete(self, queue, claim_id, project=None):
         msg_ctrl = self.driver.message_controller
         msg_ctrl._unclaim(queue, claim_id, project=project)
+
+
+def _choose_lane(msgs, limit):
+    """Chooses a random lane of messages to claim.
+
+    Lanes are consecutive runs of `limit` messages. If the last
+    lane is chosen and it is not full, it is topped up with
+    messages from the first lane.
+
+    :param msgs: Candidate messages, ordered by marker
+    :param limit: Maximum number of messages per lane
+    :returns: A list of up to `limit` messages
+    """
+    num_lanes = (len(msgs) + limit - 1) // limit
+    start = random.randrange(num_lanes) * limit
+
+    lane = msgs[start:start + limit]
+    if start != 0:
+        lane += msgs[:limit - len(lane)]
+
+    return lane
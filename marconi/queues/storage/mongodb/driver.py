@@ -17,25 +17,76 @@
 
 import pymongo
 import pymongo.errors
+from pymongo import uri_parser
 
 from marconi.common import decorators
+from marconi.common import metrics
 from marconi.openstack.common import log as logging
 from marconi.queues import storage
 from marconi.queues.storage.mongodb import controllers
+from marconi.queues.storage.mongodb import events
 from marconi.queues.storage.mongodb import options
+from marconi.queues.storage.mongodb import utils
 
 
 LOG = logging.getLogger(__name__)
 
 
-def _connection(conf):
-    """MongoDB client connection instance."""
-    if conf.uri and 'replicaSet' in conf.uri:
+def _connection(conf, uri=None):
+    """MongoDB client connection instance.
+
+    :param conf: MongoDB driver options
+    :param uri: (Default None) URI to connect to, if other
+        than `conf.uri`.
+    """
+    uri = uri or conf.uri
+
+    if uri and 'replicaSet' in uri:
         MongoClient = pymongo.MongoReplicaSetClient
     else:
         MongoClient = pymongo.MongoClient
 
-    return MongoClient(conf.uri)
+    kwargs = {}
+
+    if conf.max_pool_size is not None:
+        kwargs['max_pool_size'] = conf.max_pool_size
+
+    if conf.socket_timeout is not None:
+        kwargs['socketTimeoutMS'] = int(conf.socket_timeout * 1000)
+
+    if conf.write_concern:
+        w = conf.write_concern
+        kwargs['w'] = int(w) if w.isdigit() else w
+
+    return MongoClient(uri, **kwargs)
+
+
+def _check_write_concern(conf):
+    """Ensures that writes are acknowledged.
+
+    The controllers rely on the results of writes, such as the number
+    of documents updated, and on duplicate key errors being raised,
+    neither of which is reported for unacknowledged writes.
+
+    :param conf: MongoDB driver options
+    :raises: ValueError if `write_concern`, or the one given in any
+        of the URIs, is 0
+    """
+    concerns = [conf.write_concern]
+    for uri in [conf.uri] + list(conf.partition_uris):
+        if uri:
+            concerns.append(uri_parser.parse_uri(uri)['options'].get('w'))
+
+    for w in concerns:
+        try:
+            acknowledged = w is None or int(w) > 0
+        except ValueError:
+            # A tag set, or "majority"
+            acknowledged = True
+
+        if not acknowledged:
+            raise ValueError(u'Unacknowledged writes (w=%s) are not '
+                             u'supported by the MongoDB driver' % w)
 
 
 class DataDriver(storage.DataDriverBase):
@@ -47,6 +98,32 @@ class DataDriver(storage.DataDriverBase):
                                 group=options.MONGODB_GROUP)
 
         self.mongodb_conf = self.conf[options.MONGODB_GROUP]
+        _check_write_concern(self.mongodb_conf)
+        self._staleness_monitors = {}
+
+    def stale_read_preference(self, connection):
+        """Gets the read preference for reads that may be stale.
+
+        :param connection: Connection that will be used for the read
+        :returns: None (i.e., the connection's default) unless
+            secondary reads are enabled, in which case secondaries
+            are preferred while replication lag is acceptable.
+        """
+
+        if not self.mongodb_conf.secondary_reads:
+            return None
+
+        key = id(connection)
+
+        try:
+            monitor = self._staleness_monitors[key]
+        except KeyError:
+            monitor = self._staleness_monitors.setdefault(
+                key, utils.StalenessMonitor(
+                    connection, self.mongodb_conf.max_staleness,
+                    self.mongodb_conf.staleness_check_interval))
+
+        return monitor.read_preference()
 
     @decorators.lazy_property(write=False)
     def queues_database(self):
@@ -64,7 +141,6 @@ class DataDriver(storage.DataDriverBase):
         """List of message databases, ordered by partition number."""
 
         name = self.mongodb_conf.database
-        partitions = self.mongodb_conf.partitions
 
         # NOTE(kgriffs): Partition names are zero-based, and
         # the list is ordered by partition, which means that a
@@ -73,13 +149,75 @@ class DataDriver(storage.DataDriverBase):
         #
         #     self.driver.message_databases[0]
         #
-        return [self.connection[name + '_messages_p' + str(p)]
-                for p in range(partitions)]
+        return [connection[name + '_messages_p' + str(p)]
+                for p, connection in enumerate(self.message_connections)]
+
+    @decorators.lazy_property(write=False)
+    def message_connections(self):
+        """List of client connections, ordered by partition number.
+
+        Partitions that share a URI also share a connection (and
+        therefore a connection pool). Partitions without a URI of
+        their own share the main connection.
+
+        While the number of partitions is being reduced, the list
+        also covers the partitions that are being drained, since
+        messages are still read from and moved out of them.
+        """
+
+        uris = self.mongodb_conf.partition_uris
+        partitions = max(self.mongodb_conf.partitions,
+                         self.mongodb_conf.previous_partitions)
+
+        connections = {}
+        result = []
+
+        for p in range(partitions):
+            uri = uris[p] if p < len(uris) else None
+
+            if not uri or uri == self.mongodb_conf.uri:
+                result.append(self.connection)
+                continue
+
+            try:
+                connection = connections[uri]
+            except KeyError:
+                connection = connections[uri] = _connection(
+                    self.mongodb_conf, uri)
+
+            result.append(connection)
+
+        return result
 
     @decorators.lazy_property(write=False)
     def connection(self):
         return _connection(self.mongodb_conf)
 
+    @decorators.lazy_property(write=False)
+    def post_events(self):
+        """Post events shared with other processes, if enabled.
+
+        The first time this is accessed, a background thread is
+        started to tail events posted by other processes.
+
+        :returns: An events.Events instance, or None if post_events
+            is disabled.
+        """
+
+        if not self.mongodb_conf.post_events:
+            return None
+
+        post_events = events.Events(self.queues_database,
+                                    self.mongodb_conf.post_events_size)
+        post_events.start()
+
+        return post_events
+
+    @decorators.lazy_property(write=True)
+    def metrics(self):
+        """Sink for recording driver metrics, such as post retries."""
+        return metrics.get_sink(self.conf)
+
     @decorators.lazy_property(write=False)
     def queue_controller(self):
         return controllers.QueueController(self)
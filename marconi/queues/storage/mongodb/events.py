@@ -0,0 +1,139 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cross-process notifications of posted messages.
+
+When enabled, every post appends an event to a capped collection
+in the queues database, and every process tails that collection
+with a tailable cursor, signaling the in-process notifier (see
+marconi.queues.storage.notifier) for each event posted by some
+other process. Requests waiting on a queue are therefore woken up
+no matter which process the messages were posted through.
+
+Events are inserted without an _id, so that the primary assigns
+one, and they sort in the order in which they were inserted.
+
+Field Mappings:
+    Name        Field
+    -----------------
+    queue    ->   p_q
+    marker   ->     k
+    source   ->     s
+"""
+
+import threading
+import time
+import uuid
+
+import pymongo
+import pymongo.errors
+
+import marconi.openstack.common.log as logging
+from marconi.queues.storage.mongodb import utils
+from marconi.queues.storage import notifier
+
+
+LOG = logging.getLogger(__name__)
+
+# Number of seconds to wait before tailing the
+# events collection again, after the cursor died (e.g., because
+# the collection was still empty) or the connection failed.
+RETRY_INTERVAL = 1
+
+
+class Events(object):
+    """Publishes and tails post events.
+
+    :param database: Database in which to keep the events collection
+    :param size: Size, in bytes, of the events collection. Only used
+        if the collection does not exist yet.
+    """
+
+    def __init__(self, database, size):
+        try:
+            database.create_collection('events', capped=True, size=size)
+        except pymongo.errors.CollectionInvalid:
+            # Already created by another process
+            pass
+
+        self._collection = database.events
+        self._source = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # Only wake up waiters for events posted
+        # from now on.
+        newest = list(self._collection.find(fields={'_id': 1})
+                      .sort('_id', pymongo.DESCENDING).limit(1))
+        self._last_id = newest[0]['_id'] if newest else None
+
+    def publish(self, queue_name, project, marker):
+        """Records that messages were posted to the given queue.
+
+        :param queue_name: Name of the queue
+        :param project: Queue's project
+        :param marker: Marker of the last message that was posted
+        """
+        event = {
+            'p_q': utils.scope_queue_name(queue_name, project),
+            'k': marker,
+            's': self._source,
+        }
+
+        # Don't wait for an acknowledgement, since
+        # an event that is lost only delays the waiters until their
+        # next poll.
+        try:
+            self._collection.insert(event, manipulate=False, w=0)
+        except pymongo.errors.PyMongoError as ex:
+            LOG.exception(ex)
+
+    def start(self):
+        """Starts tailing events in a background thread, if not yet."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                cursor = self._cursor()
+                while cursor.alive:
+                    self._dispatch(cursor)
+
+            except Exception as ex:
+                LOG.exception(ex)
+
+            time.sleep(RETRY_INTERVAL)
+
+    def _cursor(self):
+        query = {}
+        if self._last_id is not None:
+            query['_id'] = {'$gt': self._last_id}
+
+        return self._collection.find(query, tailable=True, await_data=True)
+
+    def _dispatch(self, events):
+        """Signals the notifier for each event posted by others."""
+        for event in events:
+            self._last_id = event['_id']
+
+            if event.get('s') == self._source:
+                continue
+
+            project, name = event['p_q'].split('/', 1)
+            notifier.notify(name, project or None)
@@ -21,9 +21,13 @@ Field Mappings:
     letter of their long name.
 """
 
+import calendar
 import datetime
+import heapq
+import itertools
 import time
 
+from bson import objectid
 import pymongo.errors
 import pymongo.read_preferences
 
@@ -31,7 +35,9 @@ import marconi.openstack.common.log as logging
 from marconi.openstack.common import timeutils
 from marconi.queues import storage
 from marconi.queues.storage import exceptions
+from marconi.queues.storage.mongodb import buckets
 from marconi.queues.storage.mongodb import utils
+from marconi.queues.storage import notifier
 
 
 LOG = logging.getLogger(__name__)
@@ -47,6 +53,11 @@ MAX_RETRY_POST_DURATION = 45
 # producers to succeed in turn.
 COUNTER_STALL_WINDOW = 5
 
+# Messages being popped are briefly held under a private
+# claim that is never stored. Should the process die before removing
+# them, they become available again once this many seconds have passed.
+POP_CLAIM_TTL = 60
+
 # For hinting
 ID_INDEX_FIELDS = [('_id', 1)]
 
@@ -56,13 +67,20 @@ TTL_INDEX_FIELDS = [
 ]
 
 # NOTE(kgriffs): This index is for listing messages, usually
-# filtering out claimed ones.
+# filtering out claimed ones, and the client's own messages.
 ACTIVE_INDEX_FIELDS = [
     ('p_q', 1),  # Project will to be unique, so put first
     ('k', 1),  # Used for sorting and paging, must come before range queries
     ('c.e', 1),  # Used for filtering out claimed messages
+    ('u', 1),  # Used for filtering out the client's own messages
 ]
 
+# The active index was renamed when the client UUID
+# was added to it, since an existing index can not be redefined under
+# the same name. The old one is dropped once the new one exists.
+ACTIVE_INDEX_NAME = 'active_echo'
+LEGACY_ACTIVE_INDEX_NAME = 'active'
+
 # For counting
 COUNTING_INDEX_FIELDS = [
     ('p_q', 1),  # Project will to be unique, so put first
@@ -83,6 +101,19 @@ MARKER_INDEX_FIELDS = [
     ('k', 1),
 ]
 
+# Index used for finding renewed claims, when claims are
+# kept in their own collection.
+RENEWED_CLAIMS_INDEX_FIELDS = [
+    ('p_q', 1),
+    ('e', 1),
+    ('s', 1),
+]
+
+# For removing expired claims
+CLAIMS_TTL_INDEX_FIELDS = [
+    ('g', 1),
+]
+
 
 class MessageController(storage.MessageBase):
     """Implements message resource operations using MongoDB.
@@ -104,9 +135,14 @@ class MessageController(storage.MessageBase):
         super(MessageController, self).__init__(*args, **kwargs)
 
         # Cache for convenience and performance
-        self._num_partitions = self.driver.mongodb_conf.partitions
+        conf = self.driver.mongodb_conf
+        self._partition = utils.partitioner(conf.partitions,
+                                            conf.partition_vnodes)
         self._queue_ctrl = self.driver.queue_controller
-        self._retry_range = range(self.driver.mongodb_conf.max_attempts)
+        self._retry_range = range(conf.max_attempts)
+        self._metrics = self.driver.metrics
+        self._post_events = self.driver.post_events
+        self._reserve_markers = conf.reserve_markers
 
         # Create a list of 'messages' collections, one for each database
         # partition, ordered by partition number.
@@ -118,9 +154,46 @@ class MessageController(storage.MessageBase):
         self._collections = [db.messages
                              for db in self.driver.message_databases]
 
-        # Ensure indexes are initialized before any queries are performed
-        for collection in self._collections:
-            self._ensure_indexes(collection)
+        # When buckets are enabled, there is one list of
+        # bucketed collections per partition instead, ordered in the
+        # same way. Their indexes are created as they are needed.
+        self._buckets = None
+        if conf.bucket_seconds > 0:
+            self._buckets = [buckets.Buckets(db, conf.bucket_seconds,
+                                             self._ensure_bucket_indexes)
+                             for db in self.driver.message_databases]
+        else:
+            # Ensure indexes are initialized before any queries
+            # are performed
+            for collection in self._collections:
+                self._ensure_indexes(collection)
+
+        # While partitions are being rebalanced, queues
+        # may still have messages in the partition they used to map to.
+        self._previous_partition = None
+        if conf.previous_partitions > 0:
+            self._previous_partition = utils.partitioner(
+                conf.previous_partitions, conf.previous_partition_vnodes)
+
+        # Heads of queues, for claiming. Each entry is
+        # a list of messages, ordered by marker, which were claimable
+        # when they were read.
+        self._head_cache_size = conf.head_cache_size
+        self._head_cache = None
+        if (conf.head_cache_size > 0 and conf.head_cache_ttl > 0 and
+                conf.head_cache_queues > 0):
+            self._head_cache = utils.LRUCache(conf.head_cache_queues,
+                                              conf.head_cache_ttl)
+
+        # Claims are kept in the same partition as
+        # the messages they refer to.
+        self._separate_claims = self.driver.mongodb_conf.separate_claims
+        if self._separate_claims:
+            self._claim_collections = [db.claims for db
+                                       in self.driver.message_databases]
+
+            for collection in self._claim_collections:
+                self._ensure_claim_indexes(collection)
 
     #-----------------------------------------------------------------------
     # Helpers
@@ -134,10 +207,27 @@ class MessageController(storage.MessageBase):
                                 expireAfterSeconds=0,
                                 background=True)
 
+        self._ensure_bucket_indexes(collection)
+
+    def _ensure_bucket_indexes(self, collection):
+        """Ensures that all indexes, except the TTL one, are created.
+
+        Bucketed collections do not need a TTL index, since they
+        are dropped as a whole once all their messages expire.
+        """
+
         collection.ensure_index(ACTIVE_INDEX_FIELDS,
-                                name='active',
+                                name=ACTIVE_INDEX_NAME,
                                 background=True)
 
+        # Keeping the old active index around would only make
+        # every write to the collection maintain one more index.
+        try:
+            collection.drop_index(LEGACY_ACTIVE_INDEX_NAME)
+        except pymongo.errors.OperationFailure:
+            # Never created, or already dropped
+            pass
+
         collection.ensure_index(CLAIMED_INDEX_FIELDS,
                                 name='claimed',
                                 background=True)
@@ -158,10 +248,391 @@ class MessageController(storage.MessageBase):
                                 unique=True,
                                 background=True)
 
+    def _ensure_claim_indexes(self, collection):
+        """Ensures that all indexes are created for claims."""
+
+        collection.ensure_index(CLAIMS_TTL_INDEX_FIELDS,
+                                name='ttl',
+                                expireAfterSeconds=0,
+                                background=True)
+
+        collection.ensure_index(RENEWED_CLAIMS_INDEX_FIELDS,
+                                name='renewed',
+                                background=True)
+
+    def _partitions(self, queue_name, project=None):
+        """Lists the partitions that may hold messages for a queue.
+
+        :returns: A list holding the queue's partition number and,
+            while rebalancing, the number of the partition it used
+            to map to, if different.
+        """
+        partition = self._partition(queue_name, project)
+
+        if self._previous_partition is not None:
+            previous = self._previous_partition(queue_name, project)
+            if previous != partition:
+                return [partition, previous]
+
+        return [partition]
+
     def _collection(self, queue_name, project=None):
         """Get a partitioned collection instance."""
-        return self._collections[utils.get_partition(self._num_partitions,
-                                                     queue_name, project)]
+        return self._collections[self._partition(queue_name, project)]
+
+    def _partition_buckets(self, queue_name, project=None):
+        """Get the buckets for a queue's partition."""
+        return self._buckets[self._partition(queue_name, project)]
+
+    def _partition_collections(self, partition, now):
+        """Lists the collections that may hold messages in a partition.
+
+        :returns: A list holding the partition's collection or, when
+            buckets are enabled, the collections for every live
+            bucket in the partition, oldest first.
+        """
+        if self._buckets is None:
+            return [self._collections[partition]]
+
+        return self._buckets[partition].live(now)
+
+    def _collection_groups(self, queue_name, project=None):
+        """Lists the collections that may hold messages for a queue.
+
+        :returns: A list holding, for each of the queue's partitions,
+            the list of collections returned by
+            `_partition_collections`.
+        """
+        now = timeutils.utcnow_ts()
+
+        return [self._partition_collections(partition, now)
+                for partition in self._partitions(queue_name, project)]
+
+    def _collections_for(self, queue_name, project=None):
+        """Lists the collections that may hold messages for a queue."""
+        return [collection
+                for group in self._collection_groups(queue_name, project)
+                for collection in group]
+
+    def _group_by_collection(self, queue_name, project, message_ids):
+        """Groups message IDs by the collection that holds them.
+
+        While rebalancing, the IDs for a queue that is being moved
+        are listed under both of its partitions.
+
+        :returns: A list of (collection, message_ids) tuples
+        """
+        partitions = self._partitions(queue_name, project)
+
+        if self._buckets is None:
+            return [(self._collections[partition], message_ids)
+                    for partition in partitions]
+
+        groups = []
+        for partition in partitions:
+            partition_buckets = self._buckets[partition]
+
+            by_bucket = {}
+            for mid in message_ids:
+                bucket = partition_buckets.bucket_for_id(mid)
+                by_bucket.setdefault(bucket, []).append(mid)
+
+            groups.extend((partition_buckets.collection_for_id(ids[0]), ids)
+                          for bucket, ids in sorted(by_bucket.items()))
+
+        return groups
+
+    def _collections_for_id(self, queue_name, project, message_id):
+        """Lists the collections that may hold the given message."""
+        return [collection for collection, ids
+                in self._group_by_collection(queue_name, project,
+                                             [message_id])]
+
+    def _update_all(self, queue_name, project, query, update):
+        """Updates matching messages in every collection for a queue.
+
+        :returns: Total number of messages updated
+        """
+        return sum(collection.update(query, update,
+                                     upsert=False, multi=True)['n']
+                   for collection in self._collections_for(queue_name,
+                                                           project))
+
+    def _update_by_ids(self, queue_name, project, message_ids,
+                       query, update):
+        """Updates the given messages, if they match the query.
+
+        :returns: Total number of messages updated
+        """
+        updated = 0
+        for collection, ids in self._group_by_collection(queue_name,
+                                                         project,
+                                                         message_ids):
+            selector = dict(query, _id={'$in': ids})
+            updated += collection.update(selector, update,
+                                         upsert=False, multi=True)['n']
+
+        return updated
+
+    def _extend_buckets(self, queue_name, project, message_ids, expires):
+        """Keeps buckets around until the given time, if enabled.
+
+        Must be called whenever the expiration time of messages
+        is extended.
+
+        :param message_ids: IDs of the messages being extended
+        :param expires: UNIX timestamp
+        """
+        if self._buckets is None or not message_ids:
+            return
+
+        now = timeutils.utcnow_ts()
+        for partition in self._partitions(queue_name, project):
+            self._buckets[partition].extend(message_ids, expires, now)
+
+    def _extend_claim_buckets(self, queue_name, project, claim_id, expires):
+        """Keeps the buckets holding a claim's messages around until
+        the given time, if enabled.
+
+        :param expires: UNIX timestamp
+        """
+        if self._buckets is None:
+            return
+
+        query = {
+            'p_q': utils.scope_queue_name(queue_name, project),
+            'c.id': claim_id,
+        }
+
+        preference = pymongo.read_preferences.ReadPreference.PRIMARY
+        msgs = self._find(self._collection_groups(queue_name, project),
+                          query, fields={'_id': 1},
+                          read_preference=preference)
+
+        self._extend_buckets(queue_name, project,
+                             [msg['_id'] for msg in msgs], expires)
+
+    def _unexpired(self, query, now):
+        """Filters out expired messages in bucketed collections.
+
+        Without a TTL index, expired messages remain in their bucket
+        until the whole bucket is dropped.
+        """
+        if self._buckets is not None:
+            query['e'] = {'$gt': datetime.datetime.utcfromtimestamp(now)}
+
+    def _find(self, groups, query, fields=None, sort=1, limit=None,
+              hint=None, read_preference=None):
+        """Queries one or more collections for messages.
+
+        When more than one collection is given, the results are merged
+        by marker. Collections are queried in turn, and when a limit
+        is given, the remaining buckets in a partition are skipped once
+        enough messages were found, except for the next one. Since
+        markers follow the order in which messages were posted, only
+        messages posted right around the boundary between two buckets
+        may be out of order across them.
+
+        :param groups: A list of lists of collections, as returned
+            by `_collection_groups`.
+        :returns: A cursor, or an iterator over the merged results.
+        """
+        kwargs = {}
+        if read_preference is not None:
+            kwargs['read_preference'] = read_preference
+
+        count = sum(len(collections) for collections in groups)
+        if count > 1 and fields is not None:
+            fields = dict(fields, k=1)
+
+        def find(collection):
+            cursor = collection.find(query, fields=fields,
+                                     sort=[('k', sort)], **kwargs)
+
+            if limit is not None:
+                cursor = cursor.limit(limit)
+
+            if hint is not None:
+                cursor = cursor.hint(hint)
+
+            return cursor
+
+        cursors = []
+        for collections in groups:
+            if limit is None or len(collections) == 1:
+                cursors.extend(find(collection) for collection in collections)
+                continue
+
+            # Buckets are listed oldest first
+            if sort == -1:
+                collections = collections[::-1]
+
+            found = 0
+            for collection in collections:
+                if found >= limit:
+                    cursors.append(find(collection))
+                    break
+
+                msgs = list(find(collection))
+                found += len(msgs)
+                cursors.append(msgs)
+
+        if len(cursors) == 1:
+            return iter(cursors[0])
+
+        merged = heapq.merge(*[((msg['k'] * sort, index, msg)
+                                for msg in cursor)
+                               for index, cursor in enumerate(cursors)])
+
+        return itertools.islice(_unique_by_marker(merged), limit)
+
+    def _prepare_bucket(self, queue_name, project, messages, now):
+        """Assigns IDs to messages and gets the bucket to insert them in.
+
+        The IDs are generated up front, since they determine which
+        bucket holds each message. They are regenerated in the rare
+        case that they straddle two buckets, so that the whole batch
+        goes into the same one.
+
+        :returns: The collection for the bucket.
+        """
+        partition_buckets = self._partition_buckets(queue_name, project)
+
+        while True:
+            ids = [objectid.ObjectId() for message in messages]
+            bucket = partition_buckets.bucket_for_id(ids[0])
+            if partition_buckets.bucket_for_id(ids[-1]) == bucket:
+                break
+
+        for message, oid in zip(messages, ids):
+            message['_id'] = oid
+
+        expires = now + max(message['t'] for message in messages)
+        partition_buckets.record(bucket, expires)
+        partition_buckets.reap(now)
+
+        return partition_buckets.collection(bucket)
+
+    def _bucket_conflict(self, queue_name, project, messages):
+        """Checks whether a parallel post took the same markers.
+
+        The unique marker index only applies within a single bucket,
+        so two batches that were given the same markers do not
+        collide when they are posted right around the boundary
+        between two buckets, each going to a different one. Only
+        batches posted within MAX_RETRY_POST_DURATION of each other
+        can be given the same markers, so only the buckets within
+        that distance of the batch's own bucket are checked.
+
+        :param messages: Messages that were just inserted, ordered
+            by marker
+        :returns: True if any of the markers were taken in
+            another bucket, False otherwise
+        """
+        partition_buckets = self._partition_buckets(queue_name, project)
+
+        created = utils.oid_ts(messages[0]['_id'])
+        bucket = partition_buckets.bucket(created)
+        first = partition_buckets.bucket(created - MAX_RETRY_POST_DURATION)
+        last = partition_buckets.bucket(created + MAX_RETRY_POST_DURATION)
+
+        query = {
+            'p_q': utils.scope_queue_name(queue_name, project),
+            'k': {'$gte': messages[0]['k'], '$lte': messages[-1]['k']},
+        }
+
+        preference = pymongo.read_preferences.ReadPreference.PRIMARY
+        for neighbor in range(first, last + 1):
+            if neighbor == bucket:
+                continue
+
+            collection = partition_buckets.existing(neighbor)
+            if collection.find_one(query, fields={'_id': 1},
+                                   read_preference=preference):
+                return True
+
+        return False
+
+    def _stale_read_preference(self, queue_name, project=None):
+        """Gets the read preference for reads that may be stale.
+
+        While a queue is being rebalanced, its messages are only
+        read from secondaries if that is acceptable for both of
+        its partitions.
+        """
+        connections = self.driver.message_connections
+        preferences = set(self.driver.stale_read_preference(connections[p])
+                          for p in self._partitions(queue_name, project))
+
+        if len(preferences) > 1:
+            return pymongo.read_preferences.ReadPreference.PRIMARY
+
+        return preferences.pop()
+
+    def _claim_collection(self, queue_name, project=None):
+        """Get a partitioned claims collection instance.
+
+        Only available when claims are kept in their own collection.
+        """
+        partition = self._partition(queue_name, project)
+        return self._claim_collections[partition]
+
+    def _renewed_claims(self, queue_name, project, now):
+        """Lists the IDs of live claims that were renewed.
+
+        The claim expiration time stamped on claimed messages is
+        not updated when a claim is renewed. Therefore, once that
+        time has passed, the messages look like they are no longer
+        claimed, unless the claim itself is checked.
+
+        :returns: A list of claim IDs, which is always empty
+            unless claims are kept in their own collection.
+        """
+        if not self._separate_claims:
+            return []
+
+        query = {
+            'p_q': utils.scope_queue_name(queue_name, project),
+            'e': {'$gt': now},
+            's': {'$lte': now},
+        }
+
+        collection = self._claim_collection(queue_name, project)
+        claims = collection.find(query, fields={'_id': 1})
+
+        return [claim['_id'] for claim in claims]
+
+    def _invalidate_head(self, queue_name, project=None, message_ids=None):
+        """Drops the cached head of a queue.
+
+        :param message_ids: (Default None) If given, only drop these
+            messages from the cached head.
+        """
+        if self._head_cache is None:
+            return
+
+        key = utils.scope_queue_name(queue_name, project)
+        if message_ids is None:
+            self._head_cache.unset(key)
+            return
+
+        head = self._head_cache.pop(key)
+        if head:
+            message_ids = set(message_ids)
+            head = [msg for msg in head if msg['_id'] not in message_ids]
+            if head:
+                self._head_cache.set(key, head)
+
+    def _claim_is_live(self, queue_name, claim_id, project, now):
+        """Checks a claim in the claims collection."""
+        query = {
+            '_id': claim_id,
+            'p_q': utils.scope_queue_name(queue_name, project),
+            'e': {'$gt': now},
+        }
+
+        collection = self._claim_collection(queue_name, project)
+        return collection.find_one(query, fields={'_id': 1}) is not None
 
     def _backoff_sleep(self, attempt):
         """Sleep between retries using a jitter algorithm.
@@ -171,6 +642,7 @@ class MessageController(storage.MessageBase):
         at which they submit requests.
 
         :param attempt: current attempt number, zero-based
+        :returns: number of seconds slept
         """
         conf = self.driver.mongodb_conf
         seconds = utils.calculate_backoff(attempt, conf.max_attempts,
@@ -178,6 +650,39 @@ class MessageController(storage.MessageBase):
                                           conf.max_retry_jitter)
 
         time.sleep(seconds)
+        return seconds
+
+    def _commit_reserved(self, queue_name, project, reserved, stats=None):
+        """Commits the blocks of markers reserved for a post, in order.
+
+        :param reserved: List of (first marker, amount) tuples
+        :param stats: (Default None) Stats update to apply along
+            with the first commit.
+        """
+        for first, amount in reserved:
+            self._queue_ctrl._commit_markers(queue_name, project,
+                                             first, amount, stats=stats)
+            stats = None
+
+    def _not_inserted(self, collection, messages):
+        """Lists the messages of a failed batch insert that are missing.
+
+        A batch insert stops at the first document that fails, so
+        the documents before it may have been inserted. Those are
+        found by the IDs assigned to them by the driver.
+
+        :returns: The messages that were not inserted, in order
+        """
+        ids = [message['_id'] for message in messages if '_id' in message]
+
+        preference = pymongo.read_preferences.ReadPreference.PRIMARY
+        inserted = set(doc['_id'] for doc in
+                       collection.find({'_id': {'$in': ids}},
+                                       fields={'_id': 1},
+                                       read_preference=preference))
+
+        return [message for message in messages
+                if message.get('_id') not in inserted]
 
     def _purge_queue(self, queue_name, project=None):
         """Removes all messages from the queue.
@@ -192,12 +697,19 @@ class MessageController(storage.MessageBase):
         :param project: ID of the project to which the queue belongs
         """
         scope = utils.scope_queue_name(queue_name, project)
-        collection = self._collection(queue_name, project)
-        collection.remove({'p_q': scope}, w=0)
+        for collection in self._collections_for(queue_name, project):
+            collection.remove({'p_q': scope}, w=0)
+
+        if self._separate_claims:
+            collection = self._claim_collection(queue_name, project)
+            collection.remove({'p_q': scope}, w=0)
+
+        self._invalidate_head(queue_name, project)
 
     def _list(self, queue_name, project=None, marker=None,
               echo=False, client_uuid=None, fields=None,
-              include_claimed=False, sort=1, limit=None):
+              include_claimed=False, sort=1, limit=None,
+              read_preference=None, before=None):
         """Message document listing helper.
 
         :param queue_name: Name of the queue to list
@@ -221,6 +733,10 @@ class MessageController(storage.MessageBase):
             to list. The results may include fewer messages than the
             requested `limit` if not enough are available. If limit is
             not specified
+        :param read_preference: (Default None) Read preference to use,
+            if other than the connection's default.
+        :param before: (Default None) Marker at which to stop
+            iterating, exclusive.
 
         :returns: Generator yielding up to `limit` messages.
         """
@@ -237,26 +753,36 @@ class MessageController(storage.MessageBase):
             'p_q': utils.scope_queue_name(queue_name, project),
         }
 
+        # The client UUID is part of the active index,
+        # so messages can be filtered out without fetching them.
         if not echo:
             query['u'] = {'$ne': client_uuid}
 
         if marker is not None:
             query['k'] = {'$gt': marker}
 
-        collection = self._collection(queue_name, project)
+        if before is not None:
+            query.setdefault('k', {})['$lt'] = before
+
+        self._unexpired(query, now)
 
         if not include_claimed:
             # Only include messages that are not part of
             # any claim, or are part of an expired claim.
             query['c.e'] = {'$lte': now}
 
-        # Construct the request
-        cursor = collection.find(query, fields=fields,
-                                 sort=[('k', sort)], limit=limit)
+            renewed = self._renewed_claims(queue_name, project, now)
+            if renewed:
+                query['c.id'] = {'$nin': renewed}
 
+        # Construct the request
+        #
         # NOTE(flaper87): Suggest the index to use for this query to
         # ensure the most performant one is chosen.
-        return cursor.hint(ACTIVE_INDEX_FIELDS)
+        return self._find(self._collection_groups(queue_name, project),
+                          query, fields=fields, sort=sort, limit=limit,
+                          hint=ACTIVE_INDEX_FIELDS,
+                          read_preference=read_preference)
 
     #-----------------------------------------------------------------------
     # "Friends" interface
@@ -278,12 +804,28 @@ class MessageController(storage.MessageBase):
             'p_q': utils.scope_queue_name(queue_name, project),
         }
 
+        now = timeutils.utcnow_ts()
+        self._unexpired(query, now)
+
         if not include_claimed:
             # Exclude messages that are claimed
-            query['c.e'] = {'$lte': timeutils.utcnow_ts()}
+            query['c.e'] = {'$lte': now}
+
+            renewed = self._renewed_claims(queue_name, project, now)
+            if renewed:
+                query['c.id'] = {'$nin': renewed}
 
-        collection = self._collection(queue_name, project)
-        return collection.find(query).hint(COUNTING_INDEX_FIELDS).count()
+        # Counts are only used for stats, which
+        # may be slightly stale.
+        kwargs = {}
+        preference = self._stale_read_preference(queue_name, project)
+        if preference is not None:
+            kwargs['read_preference'] = preference
+
+        return sum(collection.find(query, **kwargs)
+                   .hint(COUNTING_INDEX_FIELDS).count()
+                   for collection in self._collections_for(queue_name,
+                                                           project))
 
     def _active(self, queue_name, marker=None, echo=False,
                 client_uuid=None, fields=None, project=None,
@@ -294,6 +836,95 @@ class MessageController(storage.MessageBase):
                           fields=fields, include_claimed=False,
                           limit=limit)
 
+    def _claimable(self, queue_name, fields, project=None, limit=None):
+        """Gets messages from the head of a queue, for claiming.
+
+        When the head cache is enabled, messages are taken from
+        it if possible, and removed from it, so that they are
+        not given out again by this process. Otherwise, or on a
+        miss, active messages are listed. Since other processes may
+        have claimed or deleted some of the cached messages in the
+        meantime, callers must claim them with `_claim_head`.
+
+        :param fields: Fields to include in the returned messages.
+            Must include '_id' and 'e'.
+        :param limit: Maximum number of messages to return
+        :returns: A list of messages, ordered by marker.
+        """
+        if self._head_cache is None:
+            return list(self._active(queue_name, fields=fields,
+                                     project=project, limit=limit))
+
+        key = utils.scope_queue_name(queue_name, project)
+        now = datetime.datetime.utcfromtimestamp(timeutils.utcnow_ts())
+
+        head = self._head_cache.pop(key) or []
+        head = [msg for msg in head if msg['e'] > now]
+
+        if len(head) < limit:
+            head = list(self._active(queue_name, fields=fields,
+                                     project=project,
+                                     limit=max(limit, self._head_cache_size)))
+
+        if len(head) > limit:
+            self._head_cache.set(key, head[limit:])
+
+        return head[:limit]
+
+    def _claim_head(self, queue_name, project, msgs, claim, fields, now):
+        """Tags messages returned by `_claimable` with a claim.
+
+        Messages that were claimed or deleted by someone else since
+        they were read, including messages under a renewed claim, are
+        skipped. When the head cache is enabled,
+        that usually means that the cached head is stale, e.g.,
+        because another process claimed the same messages, so it is
+        dropped, and active messages are listed once more to make up
+        for the ones that were skipped.
+
+        :param msgs: Messages returned by `_claimable`
+        :param claim: Claim to set, i.e., the value of the 'c' field
+        :param fields: Fields that were passed to `_claimable`
+        :param now: Current UNIX timestamp
+
+        :returns: A tuple of (candidates, claimed), where candidates
+            lists every message that the claim was tried on, and
+            claimed is the number of them that were actually tagged.
+        """
+        ids = [msg['_id'] for msg in msgs]
+
+        # NOTE(kgriffs): Filtering by just 'c.e' works because
+        # new messages have that field initialized to the current
+        # time when the message is posted. There is no need to check
+        # whether 'c' exists or 'c.id' is None.
+        query = {'c.e': {'$lte': now}}
+        update = {'$set': {'c': claim}}
+
+        # The candidates may have been read before a claim on
+        # them was renewed, or, from the head cache, long before; so
+        # check for renewed claims here too, as _list does.
+        renewed = self._renewed_claims(queue_name, project, now)
+        if renewed:
+            query['c.id'] = {'$nin': renewed}
+
+        claimed = self._update_by_ids(queue_name, project, ids,
+                                      query, update)
+
+        if claimed < len(ids) and self._head_cache is not None:
+            self._invalidate_head(queue_name, project)
+
+            more = list(self._active(queue_name, fields=fields,
+                                     project=project,
+                                     limit=len(ids) - claimed))
+            if more:
+                claimed += self._update_by_ids(
+                    queue_name, project, [msg['_id'] for msg in more],
+                    query, update)
+
+                msgs = msgs + more
+
+        return msgs, claimed
+
     def _claimed(self, queue_name, claim_id,
                  expires=None, limit=None, project=None):
 
@@ -303,24 +934,26 @@ class MessageController(storage.MessageBase):
         query = {
             'p_q': utils.scope_queue_name(queue_name, project),
             'c.id': claim_id,
-            'c.e': {'$gt': expires or timeutils.utcnow_ts()},
         }
 
+        # When claims are kept in their own
+        # collection, the expiration time stamped on the messages
+        # may be stale, so the caller must check the claim instead.
+        if not self._separate_claims:
+            query['c.e'] = {'$gt': expires or timeutils.utcnow_ts()}
+
+        now = timeutils.utcnow_ts()
+        self._unexpired(query, now)
+
         # NOTE(kgriffs): Claimed messages bust be queried from
         # the primary to avoid a race condition caused by the
         # multi-phased "create claim" algorithm.
         preference = pymongo.read_preferences.ReadPreference.PRIMARY
-        collection = self._collection(queue_name, project)
-        msgs = collection.find(query, sort=[('k', 1)],
-                               read_preference=preference)
-
-        if limit is not None:
-            msgs = msgs.limit(limit)
-
-        now = timeutils.utcnow_ts()
+        msgs = self._find(self._collection_groups(queue_name, project),
+                          query, limit=limit, read_preference=preference)
 
         def denormalizer(msg):
-            doc = _basic_message(msg, now)
+            doc = utils.basic_message(msg, now)
             doc['claim'] = msg['c']
 
             return doc
@@ -337,13 +970,87 @@ class MessageController(storage.MessageBase):
 
         # NOTE(cpp-cabrera):  unclaim by setting the claim ID to None
         # and the claim expiration time to now
+        #
+        # Messages whose claim already expired are
+        # left alone, since they are no longer claimed anyway. This
+        # also lets us count how many messages were actually released.
         now = timeutils.utcnow_ts()
         scope = utils.scope_queue_name(queue_name, project)
-        collection = self._collection(queue_name, project)
+        query = {'p_q': scope, 'c.id': cid, 'c.e': {'$gt': now}}
+
+        if self._separate_claims:
+            # The stamped expiration time may be
+            # stale, so check the claim itself. Messages still
+            # have to be updated, so that they can be listed again
+            # right away.
+            claim = self._claim_collection(queue_name, project).remove(
+                {'_id': cid, 'p_q': scope, 'e': {'$gt': now}})
+
+            if not claim['n']:
+                return
+
+            del query['c.e']
+
+        released = self._update_all(queue_name, project, query,
+                                    {'$set': {'c': {'id': None, 'e': now}}})
+
+        if released:
+            self._queue_ctrl._update_stats(queue_name, project,
+                                           claimed=-released)
+
+            # Released messages are claimable again,
+            # and may belong ahead of the cached head.
+            self._invalidate_head(queue_name, project)
+
+    def _migrate(self, queue_name, project=None, batch_size=100):
+        """Moves a queue's messages to its new partition.
+
+        Only does anything while rebalancing, and only if the queue's
+        partition changed. Reads and writes may continue meanwhile,
+        since each message is first copied to the new partition, where
+        it is also visible to readers, and then removed from the old
+        one. Messages that change in between are copied again, and
+        messages that are deleted in between are removed from the
+        new partition as well.
+
+        :param batch_size: (Default 100) Number of messages to read
+            from the old partition at a time.
+        :returns: Number of messages moved
+        """
+        partitions = self._partitions(queue_name, project)
+        if len(partitions) == 1:
+            return 0
+
+        partition, previous = partitions
+        scope = utils.scope_queue_name(queue_name, project)
+        now = timeutils.utcnow_ts()
+
+        moved = 0
+        for source in self._partition_collections(previous, now):
+            while True:
+                batch = list(source.find({'p_q': scope}, sort=[('k', 1)])
+                             .limit(batch_size))
 
-        collection.update({'p_q': scope, 'c.id': cid},
-                          {'$set': {'c': {'id': None, 'e': now}}},
-                          upsert=False, multi=True)
+                if not batch:
+                    break
+
+                for doc in batch:
+                    target = self._migration_target(partition, doc)
+                    moved += _move(doc, source, target)
+
+        return moved
+
+    def _migration_target(self, partition, doc):
+        """Get the collection a message is moved to."""
+        if self._buckets is None:
+            return self._collections[partition]
+
+        partition_buckets = self._buckets[partition]
+        bucket = partition_buckets.bucket_for_id(doc['_id'])
+        partition_buckets.record(bucket,
+                                 calendar.timegm(doc['e'].utctimetuple()))
+
+        return partition_buckets.collection(bucket)
 
     #-----------------------------------------------------------------------
     # Public interface
@@ -361,9 +1068,21 @@ class MessageController(storage.MessageBase):
             except ValueError:
                 yield iter([])
 
+        # When markers are reserved up front, a batch
+        # may be inserted after one with higher markers, so only list
+        # up to the point where every earlier batch is known to have
+        # been inserted; otherwise, an observer could page past a
+        # batch that has yet to arrive, and never see it.
+        before = None
+        if self._reserve_markers:
+            before = self._queue_ctrl._committed_marker(
+                queue_name, project, window=COUNTER_STALL_WINDOW)
+
+        preference = self._stale_read_preference(queue_name, project)
         messages = self._list(queue_name, project=project, marker=marker,
                               client_uuid=client_uuid,  echo=echo,
-                              include_claimed=include_claimed, limit=limit)
+                              include_claimed=include_claimed, limit=limit,
+                              read_preference=preference, before=before)
 
         marker_id = {}
 
@@ -374,16 +1093,17 @@ class MessageController(storage.MessageBase):
         def denormalizer(msg):
             marker_id['next'] = msg['k']
 
-            return _basic_message(msg, now)
+            return utils.basic_message(msg, now)
 
         yield utils.HookedCursor(messages, denormalizer)
         yield str(marker_id['next'])
 
     @utils.raises_conn_error
     def first(self, queue_name, project=None, sort=1):
+        preference = self._stale_read_preference(queue_name, project)
         cursor = self._list(queue_name, project=project,
                             include_claimed=True, sort=sort,
-                            limit=1)
+                            limit=1, read_preference=preference)
         try:
             message = next(cursor)
         except StopIteration:
@@ -405,14 +1125,17 @@ class MessageController(storage.MessageBase):
             'p_q': utils.scope_queue_name(queue_name, project),
         }
 
-        collection = self._collection(queue_name, project)
-        message = list(collection.find(query).limit(1).hint(ID_INDEX_FIELDS))
+        self._unexpired(query, now)
 
-        if not message:
-            raise exceptions.MessageDoesNotExist(message_id, queue_name,
-                                                 project)
+        for collection in self._collections_for_id(queue_name, project, mid):
+            message = list(collection.find(query)
+                           .limit(1).hint(ID_INDEX_FIELDS))
+
+            if message:
+                return utils.basic_message(message[0], now)
 
-        return _basic_message(message[0], now)
+        raise exceptions.MessageDoesNotExist(message_id, queue_name,
+                                             project)
 
     @utils.raises_conn_error
     def bulk_get(self, queue_name, message_ids, project=None):
@@ -424,47 +1147,69 @@ class MessageController(storage.MessageBase):
 
         # Base query, always check expire time
         query = {
-            '_id': {'$in': message_ids},
             'p_q': utils.scope_queue_name(queue_name, project),
         }
 
-        collection = self._collection(queue_name, project)
+        self._unexpired(query, now)
 
         # NOTE(flaper87): Should this query
         # be sorted?
-        messages = collection.find(query).hint(ID_INDEX_FIELDS)
+        cursors = [collection.find(dict(query, _id={'$in': ids}))
+                   .hint(ID_INDEX_FIELDS)
+                   for collection, ids
+                   in self._group_by_collection(queue_name, project,
+                                                message_ids)]
+
+        messages = cursors[0] if len(cursors) == 1 else (
+            _unique_by_id(itertools.chain.from_iterable(cursors)))
 
         def denormalizer(msg):
-            return _basic_message(msg, now)
+            return utils.basic_message(msg, now)
 
         return utils.HookedCursor(messages, denormalizer)
 
     @utils.raises_conn_error
     def post(self, queue_name, messages, client_uuid, project=None):
-        if not self._queue_ctrl.exists(queue_name, project):
-            raise exceptions.QueueDoesNotExist(queue_name, project)
-
         now = timeutils.utcnow_ts()
         now_dt = datetime.datetime.utcfromtimestamp(now)
-        collection = self._collection(queue_name, project)
-
-        # Set the next basis marker for the first attempt.
-        next_marker = self._queue_ctrl._get_counter(queue_name, project)
+        scope = utils.scope_queue_name(queue_name, project)
 
         prepared_messages = [
             {
                 't': message['ttl'],
-                'p_q': utils.scope_queue_name(queue_name, project),
+                'p_q': scope,
                 'e': now_dt + datetime.timedelta(seconds=message['ttl']),
                 'u': client_uuid,
                 'c': {'id': None, 'e': now},
                 'b': message['body'] if 'body' in message else {},
-                'k': next_marker + index,
             }
 
-            for index, message in enumerate(messages)
+            for message in messages
         ]
 
+        # Set the next basis marker for the first attempt.
+        #
+        # Both of these raise QueueDoesNotExist when
+        # the queue is missing, so there is no need to check for
+        # it separately beforehand.
+        reserved = []
+        if self._reserve_markers:
+            next_marker = self._queue_ctrl._reserve_markers(
+                queue_name, project, amount=len(prepared_messages))
+
+            reserved.append((next_marker, len(prepared_messages)))
+        else:
+            next_marker = self._queue_ctrl._get_counter(queue_name, project)
+
+        for index, message in enumerate(prepared_messages):
+            message['k'] = next_marker + index
+
+        if self._buckets is None:
+            collection = self._collection(queue_name, project)
+        else:
+            collection = self._prepare_bucket(queue_name, project,
+                                              prepared_messages, now)
+
         # Use a retry range for sanity, although we expect
         # to rarely, if ever, reach the maximum number of
         # retries.
@@ -472,9 +1217,23 @@ class MessageController(storage.MessageBase):
         # NOTE(kgriffs): With the default configuration (100 ms
         # max sleep, 1000 max attempts), the max stall time
         # before the operation is abandoned is 49.95 seconds.
+        pending = prepared_messages
         for attempt in self._retry_range:
             try:
-                ids = collection.insert(prepared_messages)
+                collection.insert(pending)
+                ids = [message['_id'] for message in prepared_messages]
+
+                # Back out of a collision with a parallel
+                # post to an adjacent bucket, and retry as if the
+                # unique index had caught it.
+                if (self._buckets is not None and
+                        not self._reserve_markers and
+                        self._bucket_conflict(queue_name, project,
+                                              prepared_messages)):
+
+                    collection.remove({'_id': {'$in': ids}})
+                    raise pymongo.errors.DuplicateKeyError(
+                        u'Markers taken in an adjacent bucket')
 
                 # Log a message if we retried, for debugging perf issues
                 if attempt != 0:
@@ -496,18 +1255,42 @@ class MessageController(storage.MessageBase):
                 # such that the competing marker's will start at a
                 # unique number, 1 past the max of the messages just
                 # inserted above.
-                self._queue_ctrl._inc_counter(queue_name, project,
-                                              amount=len(ids))
+                #
+                # When markers are reserved up front, the counter
+                # was already moved past this batch, so the blocks
+                # that were reserved for it are committed instead, which
+                # lets observers page past them.
+                #
+                # The queue's stats, if enabled, are
+                # updated along with the counter.
+                #
+                # There is no need to invalidate the cached head of
+                # the queue, since new messages always go behind it.
+                newest = prepared_messages[-1]
+                stats = self._queue_ctrl._stats_update(
+                    messages=len(ids), newest=newest)
+
+                if self._reserve_markers:
+                    self._commit_reserved(queue_name, project, reserved,
+                                          stats=stats)
+                else:
+                    self._queue_ctrl._inc_counter(queue_name, project,
+                                                  amount=len(ids),
+                                                  stats=stats)
+
+                self._metrics.observe('messages.post.attempts',
+                                      attempt + 1, scope=scope)
+
+                notifier.notify(queue_name, project)
+                if self._post_events is not None:
+                    self._post_events.publish(queue_name, project,
+                                              newest['k'])
 
                 return map(str, ids)
 
             except pymongo.errors.DuplicateKeyError as ex:
                 # Try again with the remaining messages
 
-                # TODO(kgriffs): Record stats of how often retries happen,
-                # and how many attempts, on average, are required to insert
-                # messages.
-
                 # NOTE(kgriffs): This can be used in conjunction with the
                 # log line, above, that is emitted after all messages have
                 # been posted, to guage how long it is taking for messages
@@ -537,7 +1320,33 @@ class MessageController(storage.MessageBase):
                     break
 
                 # Chill out for a moment to mitigate thrashing/thundering
-                self._backoff_sleep(attempt)
+                seconds = self._backoff_sleep(attempt)
+                self._metrics.observe('messages.post.backoff_seconds',
+                                      seconds, scope=scope)
+
+                if self._reserve_markers:
+                    # Reserved blocks never overlap, so we can only get
+                    # here if some other worker inserted messages
+                    # without reserving their markers first, e.g., a
+                    # worker running with reserve_markers disabled.
+                    # Such a message may take a marker in the middle of
+                    # our block, in which case the messages before it
+                    # were inserted. Only the rest are retried, with a
+                    # fresh block, which always moves past the current
+                    # counter value, so there is no need to wait for
+                    # the stall window to elapse. The unused part of the
+                    # previous block is committed along with the rest.
+                    pending = self._not_inserted(collection, pending)
+
+                    next_marker = self._queue_ctrl._reserve_markers(
+                        queue_name, project, amount=len(pending))
+
+                    reserved.append((next_marker, len(pending)))
+
+                    for index, message in enumerate(pending):
+                        message['k'] = next_marker + index
+
+                    continue
 
                 # NOTE(kgriffs): Perhaps we failed because a worker crashed
                 # after inserting messages, but before incrementing the
@@ -573,6 +1382,9 @@ class MessageController(storage.MessageBase):
                     next_marker = self._queue_ctrl._get_counter(
                         queue_name, project)
                 else:
+                    self._metrics.incr('messages.post.stalled_counters',
+                                       scope=scope)
+
                     msgtmpl = (u'Detected a stalled message counter for '
                                u'queue "%(queue)s" under project %(project)s. '
                                u'The counter was incremented to %(value)d.')
@@ -585,6 +1397,13 @@ class MessageController(storage.MessageBase):
                 for index, message in enumerate(prepared_messages):
                     message['k'] = next_marker + index
 
+                # Move on to the current bucket, so that a
+                # parallel post is caught by the unique index next time.
+                if self._buckets is not None:
+                    collection = self._prepare_bucket(
+                        queue_name, project, prepared_messages,
+                        timeutils.utcnow_ts())
+
             except Exception as ex:
                 # TODO(kgriffs): Query the DB to get the last marker that
                 # made it, and extrapolate from there to figure out what
@@ -601,6 +1420,12 @@ class MessageController(storage.MessageBase):
                          queue=queue_name,
                          project=project))
 
+        self._metrics.incr('messages.post.conflicts', scope=scope)
+
+        # Do not hold observers back until the
+        # blocks are deemed stalled.
+        self._commit_reserved(queue_name, project, reserved)
+
         succeeded_ids = []
         raise exceptions.MessageConflict(queue_name, project, succeeded_ids)
 
@@ -612,8 +1437,6 @@ class MessageController(storage.MessageBase):
         if mid is None:
             return
 
-        collection = self._collection(queue_name, project)
-
         query = {
             '_id': mid,
             'p_q': utils.scope_queue_name(queue_name, project),
@@ -627,43 +1450,235 @@ class MessageController(storage.MessageBase):
             return
 
         now = timeutils.utcnow_ts()
-        message = collection.find_one(query)
-
-        if message is None:
-            return
-
-        is_claimed = (message['c']['id'] is not None and
-                      message['c']['e'] > now)
 
+        # Remove the message in a single round trip, as
+        # long as it is not claimed or, if a claim ID was given, as long
+        # as it belongs to that claim. Only when nothing was removed is
+        # the message looked up again, to find out why.
         if claim is None:
-            if is_claimed:
-                raise exceptions.MessageIsClaimed(message_id)
+            query['c.e'] = {'$lte': now}
+
+            renewed = self._renewed_claims(queue_name, project, now)
+            if renewed:
+                query['c.id'] = {'$nin': renewed}
 
         else:
-            if message['c']['id'] != cid:
+            query['c.id'] = cid
+
+        collections = self._collections_for_id(queue_name, project, mid)
+
+        message = None
+        for collection in collections:
+            removed = collection.find_and_modify(query, remove=True,
+                                                 fields={'c': 1})
+            message = message or removed
+
+        if message is None:
+            for collection in collections:
+                if collection.find_one({'_id': mid, 'p_q': query['p_q']},
+                                       fields={'_id': 1}) is None:
+                    continue
+
+                if claim is None:
+                    raise exceptions.MessageIsClaimed(message_id)
+
                 raise exceptions.MessageIsClaimedBy(message_id, claim)
 
-        collection.remove(query['_id'], w=0)
+            return
+
+        is_claimed = claim is not None and message['c']['e'] > now
+        if claim is not None and not is_claimed and self._separate_claims:
+            is_claimed = self._claim_is_live(queue_name, cid, project, now)
+
+        self._queue_ctrl._update_stats(queue_name, project, messages=-1,
+                                       claimed=-1 if is_claimed else 0,
+                                       removed_ids=[mid])
+
+        if not is_claimed:
+            self._invalidate_head(queue_name, project, [mid])
 
     @utils.raises_conn_error
-    def bulk_delete(self, queue_name, message_ids, project=None):
+    def bulk_delete(self, queue_name, message_ids, project=None, claim=None):
+        if claim is not None:
+            return self._bulk_delete_claimed(queue_name, message_ids,
+                                             project, claim)
+
         message_ids = [mid for mid in map(utils.to_oid, message_ids) if mid]
         query = {
-            '_id': {'$in': message_ids},
             'p_q': utils.scope_queue_name(queue_name, project),
         }
 
-        collection = self._collection(queue_name, project)
-        collection.remove(query, w=0)
+        groups = self._group_by_collection(queue_name, project, message_ids)
+        self._invalidate_head(queue_name, project, message_ids)
+
+        if not self._queue_ctrl._incremental_stats:
+            for collection, ids in groups:
+                collection.remove(dict(query, _id={'$in': ids}), w=0)
+
+            return
+
+        # Wait for the number of messages actually
+        # removed, so that stats can be adjusted accordingly. Claimed
+        # messages are not accounted for here, but that will be
+        # corrected the next time the stats are reconciled.
+        removed = sum(collection.remove(dict(query, _id={'$in': ids}))['n']
+                      for collection, ids in groups)
+        if removed:
+            self._queue_ctrl._update_stats(queue_name, project,
+                                           messages=-removed,
+                                           removed_ids=message_ids)
+
+    @utils.raises_conn_error
+    def pop(self, queue_name, limit, project=None):
+        now = timeutils.utcnow_ts()
+        scope = utils.scope_queue_name(queue_name, project)
+
+        fields = {'_id': 1, 't': 1, 'e': 1, 'b': 1}
+        msgs = self._claimable(queue_name, fields, project=project,
+                               limit=limit)
+
+        if not msgs:
+            return []
+
+        # Mark the messages with a private claim, so
+        # that no other consumer can claim or pop them, and then
+        # remove exactly the ones that were marked. This takes a
+        # fixed number of round trips, regardless of `limit`.
+        claim = {'id': objectid.ObjectId(), 'e': now + POP_CLAIM_TTL}
+        msgs, marked = self._claim_head(queue_name, project, msgs, claim,
+                                        fields, now)
+        ids = [msg['_id'] for msg in msgs]
+
+        if not marked:
+            return []
+
+        if marked < len(ids):
+            # Some of the messages were claimed or
+            # deleted by someone else in the meantime.
+            msgs = list(self._claimed(queue_name, claim['id'],
+                                      project=project))
+
+            for msg in msgs:
+                del msg['claim']
+
+            ids = [utils.to_oid(msg['id']) for msg in msgs]
+
+        else:
+            msgs = [utils.basic_message(msg, now) for msg in msgs]
+
+        removed = sum(collection.remove({'p_q': scope,
+                                         '_id': {'$in': group},
+                                         'c.id': claim['id']})['n']
+                      for collection, group
+                      in self._group_by_collection(queue_name, project,
+                                                   ids))
+
+        self._queue_ctrl._update_stats(queue_name, project,
+                                       messages=-removed,
+                                       removed_ids=ids)
+
+        return msgs
+
+    def _bulk_delete_claimed(self, queue_name, message_ids, project, claim):
+        """Deletes the given messages, if they belong to the claim.
+
+        Ownership is checked by the same operation that removes the
+        messages. Only when some of them were not removed are the
+        remaining ones looked up, in order to report them.
+
+        :returns: A list of the given message IDs that were not
+            deleted, because they are not part of the claim.
+        """
+        mids = [mid for mid in map(utils.to_oid, message_ids) if mid]
+        query = {
+            'p_q': utils.scope_queue_name(queue_name, project),
+        }
+
+        groups = self._group_by_collection(queue_name, project, mids)
+
+        cid = utils.to_oid(claim)
+        if cid is not None:
+            selector = dict(query)
+            selector['c.id'] = cid
+
+            removed = sum(collection.remove(dict(selector,
+                                                 _id={'$in': ids}))['n']
+                          for collection, ids in groups)
+
+            if removed:
+                # Messages removed under an expired
+                # claim are not accounted for here, but that will be
+                # corrected the next time the stats are reconciled.
+                self._queue_ctrl._update_stats(queue_name, project,
+                                               messages=-removed,
+                                               claimed=-removed,
+                                               removed_ids=mids)
+
+            if removed == len(mids):
+                return []
+
+        now = timeutils.utcnow_ts()
+        self._unexpired(query, now)
+
+        remaining = set()
+        for collection, ids in groups:
+            remaining.update(msg['_id'] for msg in collection.find(
+                dict(query, _id={'$in': ids}), fields={'_id': 1}))
+
+        return [message_id for message_id in message_ids
+                if utils.to_oid(message_id) in remaining]
+
+
+def _move(doc, source, target):
+    """Moves a single message document between collections.
+
+    :returns: 1 if the message was moved, or 0 if it was deleted
+        before it could be removed from the source collection.
+    """
+    mid = doc['_id']
+
+    while doc is not None:
+        try:
+            target.insert(doc)
+        except pymongo.errors.DuplicateKeyError:
+            target.update({'_id': mid}, doc)
+
+        # Only remove the original if it has not been
+        # claimed, released or renewed since it was read; otherwise
+        # the copy is stale, so read the original and try again.
+        removed = source.remove({'_id': mid,
+                                 'c.id': doc['c']['id'],
+                                 'c.e': doc['c']['e'],
+                                 'e': doc['e']})['n']
+
+        if removed:
+            return 1
+
+        doc = source.find_one({'_id': mid})
+
+    target.remove({'_id': mid})
+    return 0
+
+
+def _unique_by_marker(merged):
+    """Drops duplicates from messages merged by marker.
+
+    While a queue is being moved to another partition, a message may
+    briefly exist in both. Since both copies have the same marker,
+    they are adjacent once merged.
+    """
+    last = None
+    for key, index, msg in merged:
+        if key != last:
+            yield msg
 
+        last = key
 
-def _basic_message(msg, now):
-    oid = msg['_id']
-    age = now - utils.oid_ts(oid)
 
-    return {
-        'id': str(oid),
-        'age': int(age),
-        'ttl': msg['t'],
-        'body': msg['b'],
-    }
+def _unique_by_id(messages):
+    """Drops duplicates from messages read from several partitions."""
+    seen = set()
+    for msg in messages:
+        if msg['_id'] not in seen:
+            seen.add(msg['_id'])
+            yield msg
@@ -31,12 +31,107 @@ MONGODB_OPTIONS = [
                help=('Number of databases across which to '
                      'partition message data, in order to '
                      'reduce writer lock %. DO NOT change '
-                     'this setting after initial deployment. '
-                     'It MUST remain static. Also, you '
+                     'this setting after initial deployment, '
+                     'except by following the rebalancing '
+                     'procedure (see `previous_partitions`). '
+                     'Also, you '
                      'should not need a large number of partitions '
                      'to improve performance, esp. if deploying '
                      'MongoDB on SSD storage.')),
 
+    cfg.IntOpt('partition_vnodes', default=0,
+               help=('Number of virtual nodes per partition on a '
+                     'consistent hash ring, used to map queues to '
+                     'partitions. With a ring, adding a partition only '
+                     'moves about 1/N of the queues to it. Set to 0 to '
+                     'use simple modulo hashing, as before. Changing '
+                     'either this setting or `partitions` requires '
+                     'setting `previous_partitions` and '
+                     '`previous_partition_vnodes` to the old values '
+                     'and then rebalancing the message data.')),
+
+    cfg.IntOpt('previous_partitions', default=0,
+               help=('Number of partitions before the last change '
+                     'to `partitions` or `partition_vnodes`. While '
+                     'this is set, queues whose partition changed '
+                     'are read from both their old and new '
+                     'partitions, and new messages go to the new one, '
+                     'so that messages can be moved online (see '
+                     'marconi.queues.storage.mongodb.rebalance). Set '
+                     'back to 0 once rebalancing is complete. May be '
+                     'larger than `partitions`, in which case the '
+                     'extra partitions are only drained. Not '
+                     'supported together with `separate_claims`.')),
+
+    cfg.IntOpt('previous_partition_vnodes', default=0,
+               help=('Value of `partition_vnodes` before the last '
+                     'change to the partitioning scheme. Only used '
+                     'when `previous_partitions` is set.')),
+
+    cfg.ListOpt('partition_uris', default=[],
+                help=('MongoDB connection URIs for the message '
+                      'partitions, in partition order, so that '
+                      'partitions may be placed on separate servers. '
+                      'While shrinking, include the URIs of the '
+                      'partitions being drained. '
+                      'Each distinct URI gets its own connection pool. '
+                      'Partitions without a URI in this list, or with '
+                      'an empty one, use `uri`. As with `partitions`, '
+                      'DO NOT change this setting after initial '
+                      'deployment, unless the data is moved along '
+                      'with it.')),
+
+    cfg.IntOpt('max_pool_size', default=None,
+               help=('Maximum number of connections in each '
+                     'connection pool. Defaults to the client '
+                     'library\'s own default.')),
+
+    cfg.FloatOpt('socket_timeout', default=None,
+                 help=('Number of seconds to wait for a response on '
+                       'a connection before giving up. Defaults to '
+                       'waiting indefinitely.')),
+
+    cfg.StrOpt('write_concern', default=None,
+               help=('Default write concern (i.e., the "w" option) '
+                     'for every connection, e.g., 1 or "majority". '
+                     'Defaults to the one given in the URI, if any. '
+                     'Writes must be acknowledged, since the driver '
+                     'relies on their results, so 0 (in this option '
+                     'or in any URI) is rejected.')),
+
+    cfg.BoolOpt('secondary_reads', default=False,
+                help=('Route reads that may safely be slightly stale '
+                      '(listing messages, getting the first or last '
+                      'message, counting messages and listing queues) '
+                      'to secondaries, as long as replication lag is '
+                      'within max_staleness. Claims, deletes and '
+                      'other reads always go to the primary.')),
+
+    cfg.IntOpt('max_staleness', default=10,
+               help=('Maximum replication lag, in seconds, that is '
+                     'acceptable for secondary reads. When any '
+                     'secondary lags further behind, reads go to the '
+                     'primary instead. Only used when secondary_reads '
+                     'is enabled.')),
+
+    cfg.IntOpt('staleness_check_interval', default=5,
+               help=('Number of seconds between checks of the '
+                     'replication lag of each replica set, when '
+                     'secondary_reads is enabled.')),
+
+    cfg.BoolOpt('post_events', default=False,
+                help=('Append an event to a capped "events" collection '
+                      'every time messages are posted, and tail that '
+                      'collection in every process, so that requests '
+                      'waiting for messages (see the `wait` parameter) '
+                      'are woken up right away, no matter which server '
+                      'the messages were posted through.')),
+
+    cfg.IntOpt('post_events_size', default=1024 * 1024,
+               help=('Size, in bytes, of the capped events collection '
+                     'used when post_events is enabled. Only used when '
+                     'the collection is first created.')),
+
     cfg.IntOpt('max_attempts', default=1000,
                help=('Maximum number of times to retry a failed operation.'
                      'Currently only used for retrying a message post.')),
@@ -51,6 +146,106 @@ MONGODB_OPTIONS = [
                        'sleep interval, in order to decrease probability '
                        'that parallel requests will retry at the '
                        'same instant.')),
+
+    cfg.BoolOpt('reserve_markers', default=False,
+                help=('Reserve a contiguous block of message markers, '
+                      'using a single atomic increment of the queue\'s '
+                      'counter, before inserting a batch of messages. '
+                      'Parallel producers will never collide on the '
+                      'same markers, so posts to hot queues are not '
+                      'retried. Since a batch may then be inserted '
+                      'after a batch that reserved higher markers, '
+                      'listing messages only goes as far as the '
+                      'highest marker below which every batch has '
+                      'been inserted, which takes an additional read '
+                      'of the queue. A batch that is still missing '
+                      'after 5 seconds is assumed to have been '
+                      'abandoned by a crashed worker, and skipped.')),
+
+    cfg.BoolOpt('incremental_stats', default=False,
+                help=('Keep message counts and the oldest/newest '
+                      'messages in each queue\'s document, updating '
+                      'them as messages are posted, claimed, released '
+                      'and deleted, so that getting queue stats only '
+                      'requires reading a single document. Claims and '
+                      'messages that simply expire are not tracked, '
+                      'and are accounted for by periodically '
+                      'reconciling the stats against the messages '
+                      'collection.')),
+
+    cfg.IntOpt('stats_reconcile_interval', default=60,
+               help=('Maximum age, in seconds, of incrementally '
+                     'maintained queue stats before they are '
+                     'recalculated from scratch. Only used when '
+                     'incremental_stats is enabled.')),
+
+    cfg.IntOpt('queue_cache_ttl', default=0,
+               help=('Number of seconds for which to cache the '
+                     'existence and metadata of queues, in-process. '
+                     'Changes made by other processes may not be seen '
+                     'until the cached entry expires. Set to 0 to '
+                     'disable the cache.')),
+
+    cfg.IntOpt('queue_cache_size', default=1000,
+               help=('Maximum number of queues to cache, when '
+                     'queue_cache_ttl is greater than 0.')),
+
+    cfg.BoolOpt('separate_claims', default=False,
+                help=('Keep the TTL and expiration time of each claim '
+                      'in a dedicated claims collection, rather than '
+                      'in every claimed message, so that renewing a '
+                      'claim only needs to update a single document. '
+                      'Listing and counting unclaimed messages then '
+                      'requires an additional query for renewed '
+                      'claims. DO NOT change this setting while there '
+                      'are any live claims.')),
+
+    cfg.IntOpt('claim_lanes', default=1,
+               help=('Number of lanes across which to spread parallel '
+                     'claims on the same queue. Each request reads '
+                     'up to limit * claim_lanes unclaimed messages, '
+                     'and then tries to claim a randomly chosen lane '
+                     'of up to limit messages, so that parallel '
+                     'requests are less likely to compete for the '
+                     'same messages. The tradeoff is that messages '
+                     'are no longer claimed strictly in order.')),
+
+    cfg.IntOpt('head_cache_size', default=0,
+               help=('Number of claimable messages to cache, '
+                     'in-process, from the head of each queue. When '
+                     'creating a claim, messages are taken from the '
+                     'cache, if possible, rather than querying for '
+                     'them. Messages that were claimed or deleted by '
+                     'other processes are skipped when claiming, in '
+                     'which case the cached entry is dropped, and '
+                     'the queue is queried once more for the rest. '
+                     'Messages released by other processes are not '
+                     'seen until the cached entry expires. Set to 0 '
+                     'to disable the cache.')),
+
+    cfg.IntOpt('head_cache_ttl', default=5,
+               help=('Number of seconds for which to cache the head '
+                     'of a queue, when head_cache_size is greater '
+                     'than 0.')),
+
+    cfg.IntOpt('head_cache_queues', default=1000,
+               help=('Maximum number of queues whose heads are cached, '
+                     'when head_cache_size is greater than 0.')),
+
+    cfg.IntOpt('bucket_seconds', default=0,
+               help=('Split the messages collection in each partition '
+                     'into rolling time buckets of this many seconds, '
+                     'according to the time each message was posted. '
+                     'Once every message in a bucket has expired, the '
+                     'whole bucket is dropped, instead of relying on '
+                     'the TTL index to remove messages one at a time. '
+                     'Listing and claiming messages queries live '
+                     'buckets in order, until enough messages are '
+                     'found, while counting them queries every live '
+                     'bucket, so buckets should not be too short '
+                     'relative to message TTLs. DO NOT change this '
+                     'setting after initial deployment. Set to 0 to '
+                     'disable buckets.')),
 ]
 
 MONGODB_GROUP = 'queues:drivers:storage:mongodb'
@@ -21,6 +21,8 @@ Field Mappings:
     letter of their long name.
 """
 
+import calendar
+
 import pymongo.errors
 
 import marconi.openstack.common.log as logging
@@ -46,6 +48,7 @@ class QueueController(storage.QueueBase):
         name         ->   p_q
         msg counter  ->     c
         metadata     ->     m
+        stats        ->     s
 
     Message Counter:
 
@@ -53,6 +56,31 @@ class QueueController(storage.QueueBase):
         -------------------
         value        ->   v
         modified ts  ->   t
+        committed    ->   h
+        done         ->   d
+        committed ts ->   a
+
+    The committed marker and the list of done blocks are only
+    maintained when markers are reserved up front (see
+    `_reserve_markers` and `_commit_markers`). Every marker below
+    the committed one belongs to a batch that has already been
+    inserted, or abandoned. Blocks that were inserted while an
+    earlier block was still pending are listed as done, in the form
+    {'k': first marker, 'n': number of markers, 't': done ts}, until
+    the committed marker catches up with them.
+
+    Stats (only when incremental_stats is enabled):
+
+        Name          Field
+        -------------------
+        messages     ->   m
+        claimed      ->   c
+        oldest       ->   o
+        newest       ->   n
+        reconciled   ->   r
+
+    The oldest and newest messages are recorded as references
+    of the form {'id': ObjectId, 'e': expires ts}.
     """
 
     def __init__(self, *args, **kwargs):
@@ -60,6 +88,19 @@ class QueueController(storage.QueueBase):
 
         self._collection = self.driver.queues_database.queues
 
+        # Cache for convenience and performance
+        conf = self.driver.mongodb_conf
+        self._incremental_stats = conf.incremental_stats
+        self._stats_reconcile_interval = conf.stats_reconcile_interval
+
+        # Only queues that exist are cached, along
+        # with their metadata, so that a queue created by another
+        # process is never reported as missing.
+        self._cache = None
+        if conf.queue_cache_ttl > 0 and conf.queue_cache_size > 0:
+            self._cache = utils.LRUCache(conf.queue_cache_size,
+                                         conf.queue_cache_ttl)
+
         # NOTE(flaper87): This creates a unique index for
         # project and name. Using project as the prefix
         # allows for querying by project and project+name.
@@ -71,6 +112,21 @@ class QueueController(storage.QueueBase):
     # Helpers
     #-----------------------------------------------------------------------
 
+    def _cached_metadata(self, name, project=None):
+        """Returns the queue's cached metadata, or None if not cached."""
+        if self._cache is None:
+            return None
+
+        return self._cache.get(utils.scope_queue_name(name, project))
+
+    def _cache_metadata(self, name, project, metadata):
+        if self._cache is not None:
+            self._cache.set(utils.scope_queue_name(name, project), metadata)
+
+    def _invalidate(self, name, project=None):
+        if self._cache is not None:
+            self._cache.unset(utils.scope_queue_name(name, project))
+
     def _get(self, name, project=None, fields={'m': 1, '_id': 0}):
         queue = self._collection.find_one(_get_scoped_query(name, project),
                                           fields=fields)
@@ -109,7 +165,8 @@ class QueueController(storage.QueueBase):
 
         return doc['c']['v']
 
-    def _inc_counter(self, name, project=None, amount=1, window=None):
+    def _inc_counter(self, name, project=None, amount=1, window=None,
+                     stats=None):
         """Increments the message counter and returns the new value.
 
         :param name: Name of the queue to which the counter is scoped
@@ -118,6 +175,8 @@ class QueueController(storage.QueueBase):
         :param window: (Default None) A time window, in seconds, that
             must have elapsed since the counter was last updated, in
             order to increment the counter.
+        :param stats: (Default None) Stats update, as returned by
+            `_stats_update`, to apply along with the increment.
 
         :returns: Updated message counter value, or None if window
             was specified, and the counter has already been updated
@@ -127,7 +186,9 @@ class QueueController(storage.QueueBase):
         """
         now = timeutils.utcnow_ts()
 
-        update = {'$inc': {'c.v': amount}, '$set': {'c.t': now}}
+        update = _merge_update({'$inc': {'c.v': amount}, '$set': {'c.t': now}},
+                               stats)
+
         query = _get_scoped_query(name, project)
         if window is not None:
             threshold = now - window
@@ -162,6 +223,334 @@ class QueueController(storage.QueueBase):
 
         return doc['c']['v']
 
+    def _reserve_markers(self, name, project=None, amount=1):
+        """Atomically reserves a contiguous block of message markers.
+
+        Unlike `_get_counter`, parallel requests to this method
+        will never be given overlapping markers, since the counter
+        is incremented by `amount` in the same operation that
+        reads its current value.
+
+        :param name: Name of the queue to which the counter is scoped
+        :param project: Queue's project name
+        :param amount: (Default 1) Number of markers to reserve
+
+        :returns: First marker in the reserved block. The block
+            spans the range [first, first + amount). It must be
+            committed with `_commit_markers` once its messages have
+            been inserted, so that observers may page past it.
+
+        :raises: storage.exceptions.QueueDoesNotExist
+        """
+        now = timeutils.utcnow_ts()
+
+        update = {'$inc': {'c.v': amount}, '$set': {'c.t': now}}
+        query = _get_scoped_query(name, project)
+
+        while True:
+            try:
+                # Ask for the document as it was
+                # before the update, so that we get the first
+                # marker in the block.
+                doc = self._collection.find_and_modify(
+                    query, update, new=False,
+                    fields={'c.v': 1, 'c.h': 1, '_id': 0})
+
+                break
+            except pymongo.errors.AutoReconnect as ex:
+                LOG.exception(ex)
+
+        if doc is None:
+            raise exceptions.QueueDoesNotExist(name, project)
+
+        first = doc['c']['v']
+
+        # Queues created before markers were committed
+        # start committing from the first block reserved for them.
+        if 'h' not in doc['c']:
+            query['c.h'] = {'$exists': False}
+            self._collection.update(query,
+                                    {'$set': {'c.h': first, 'c.a': now}},
+                                    multi=False, manipulate=False)
+
+        return first
+
+    def _commit_markers(self, name, project=None, first=1, amount=1,
+                        stats=None):
+        """Marks a reserved block of markers as done.
+
+        Must be called once the messages in a block returned by
+        `_reserve_markers` have been inserted, or abandoned. The
+        committed marker is moved past the block right away if every
+        earlier block is done as well. Otherwise, the block is listed
+        as done, and the committed marker is moved past it along with
+        the last earlier block to be committed.
+
+        :param name: Name of the queue to which the counter is scoped
+        :param project: Queue's project name
+        :param first: First marker in the block
+        :param amount: Number of markers in the block
+        :param stats: (Default None) Stats update, as returned by
+            `_stats_update`, to apply along with the commit.
+
+        :raises: storage.exceptions.QueueDoesNotExist
+        """
+        now = timeutils.utcnow_ts()
+        query = _get_scoped_query(name, project)
+
+        update = _merge_update(
+            {'$set': {'c.h': first + amount, 'c.a': now}}, stats)
+
+        doc = self._collection.find_and_modify(
+            dict(query, **{'c.h': first}), update, new=True,
+            fields={'c': 1, '_id': 0})
+
+        if doc is None:
+            update = _merge_update(
+                {'$push': {'c.d': {'k': first, 'n': amount, 't': now}}},
+                stats)
+
+            doc = self._collection.find_and_modify(
+                query, update, new=True, fields={'c': 1, '_id': 0})
+
+            if doc is None:
+                raise exceptions.QueueDoesNotExist(name, project)
+
+        self._advance_markers(name, project, doc['c'])
+
+    def _advance_markers(self, name, project, counter):
+        """Moves the committed marker past every contiguous done block.
+
+        :param counter: The queue's message counter, as last read
+        :returns: The committed marker, or None if the queue no
+            longer exists.
+        """
+        query = _get_scoped_query(name, project)
+
+        while True:
+            high = counter['h']
+            done = dict((block['k'], block) for block in counter.get('d', []))
+
+            if high not in done and not any(k < high for k in done):
+                return high
+
+            # Drop the block being committed, along with
+            # any that were left behind by a stalled counter.
+            update = {'$pull': {'c.d': {'k': {'$lte': high}}}}
+            if high in done:
+                update['$set'] = {'c.h': high + done[high]['n'],
+                                  'c.a': timeutils.utcnow_ts()}
+
+            doc = self._collection.find_and_modify(
+                dict(query, **{'c.h': high}), update, new=True,
+                fields={'c': 1, '_id': 0})
+
+            if doc is None:
+                # Someone else moved the committed marker
+                # in the meantime, so start over.
+                doc = self._collection.find_one(query,
+                                                fields={'c': 1, '_id': 0})
+
+                if doc is None:
+                    return None
+
+            counter = doc['c']
+
+    def _committed_marker(self, name, project=None, window=None):
+        """Gets the marker below which every message has been posted.
+
+        Observers must not page past this marker, since a batch with
+        lower markers may still be on its way. If the committed marker
+        has been stuck for longer than `window`, the worker holding
+        the next block is assumed to have crashed, and the marker is
+        moved past the gap.
+
+        :param name: Name of the queue to which the counter is scoped
+        :param project: Queue's project name
+        :param window: (Default None) Number of seconds after which
+            a gap is assumed to have been abandoned. If not given,
+            gaps are never skipped.
+
+        :returns: The committed marker, or None if it is not known,
+            e.g., because the queue does not exist.
+        """
+        query = _get_scoped_query(name, project)
+        doc = self._collection.find_one(query, fields={'c': 1, '_id': 0})
+
+        if doc is None or 'h' not in doc['c']:
+            return None
+
+        counter = doc['c']
+        high = counter['h']
+        if high >= counter['v'] or window is None:
+            return high
+
+        # The gap is measured from the time the oldest
+        # block waiting on it was done or, if there are none, from
+        # the time the last block was reserved.
+        done = [block for block in counter.get('d', []) if block['k'] > high]
+        since = min(block['t'] for block in done) if done else counter['t']
+
+        now = timeutils.utcnow_ts()
+        if now - since < window:
+            return high
+
+        target = min(block['k'] for block in done) if done else counter['v']
+        doc = self._collection.find_and_modify(
+            dict(query, **{'c.h': high}),
+            {'$set': {'c.h': target, 'c.a': now}},
+            new=True, fields={'c': 1, '_id': 0})
+
+        if doc is None:
+            doc = self._collection.find_one(query, fields={'c': 1, '_id': 0})
+            if doc is None:
+                return None
+        else:
+            msgtmpl = _(u'Detected a stalled marker reservation for '
+                        u'queue "%(queue)s" under project %(project)s. '
+                        u'The committed marker was moved from %(old)d '
+                        u'to %(new)d.')
+
+            LOG.warning(msgtmpl, dict(queue=name, project=project,
+                                      old=high, new=target))
+
+        return self._advance_markers(name, project, doc['c'])
+
+    def _stats_update(self, messages=0, claimed=0, newest=None):
+        """Builds an update document for the queue's stats.
+
+        :param messages: (Default 0) Amount by which to adjust the
+            number of messages in the queue
+        :param claimed: (Default 0) Amount by which to adjust the
+            number of claimed messages in the queue
+        :param newest: (Default None) Message document to record
+            as the newest one in the queue. Must include the '_id'
+            and 'e' fields.
+
+        :returns: An update document, or None if incremental stats
+            are disabled.
+        """
+        if not self._incremental_stats:
+            return None
+
+        update = {'$inc': {'s.m': messages, 's.c': claimed}}
+        if newest is not None:
+            update['$set'] = {'s.n': _stat_ref(newest)}
+
+        return update
+
+    def _update_stats(self, name, project=None, messages=0, claimed=0,
+                      newest=None, removed_ids=None):
+        """Adjusts the queue's stats, if they are enabled.
+
+        See also `_stats_update`.
+
+        :param removed_ids: (Default None) IDs of the messages that
+            were removed from the queue, if any. If one of them was
+            the oldest message, it is forgotten, and looked up again
+            the next time stats are requested.
+        """
+        update = self._stats_update(messages, claimed, newest)
+        if update is None:
+            return
+
+        query = _get_scoped_query(name, project)
+
+        if not removed_ids:
+            self._collection.update(query, update, multi=False,
+                                    manipulate=False)
+            return
+
+        doc = self._collection.find_and_modify(
+            query, update, new=False, fields={'s.o': 1, '_id': 0})
+
+        try:
+            oldest = doc['s']['o']['id']
+        except (TypeError, KeyError):
+            return
+
+        if oldest in removed_ids:
+            self._collection.update(dict(query, **{'s.o.id': oldest}),
+                                    {'$unset': {'s.o': 1}},
+                                    multi=False, manipulate=False)
+
+    def _collect_stats(self, name, project=None):
+        """Calculates the queue's stats from the messages collection.
+
+        :returns: A stats document, as described in the
+            class docstring, minus the 'r' field.
+        """
+        controller = self.driver.message_controller
+
+        active = controller._count(name, project=project,
+                                   include_claimed=False)
+        total = controller._count(name, project=project,
+                                  include_claimed=True)
+
+        stats = {'m': total, 'c': total - active}
+
+        try:
+            oldest = controller.first(name, project=project, sort=1)
+            newest = controller.first(name, project=project, sort=-1)
+        except exceptions.QueueIsEmpty:
+            pass
+        else:
+            stats['o'] = _stat_ref(oldest)
+            stats['n'] = _stat_ref(newest)
+
+        return stats
+
+    def _reconcile_stats(self, name, project, now):
+        """Recalculates the queue's stats and saves them."""
+        stats = self._collect_stats(name, project)
+        stats['r'] = now
+
+        # Any adjustments made in parallel are lost,
+        # but since the stats were just recalculated, they
+        # should already be reflected in them anyway.
+        self._collection.update(_get_scoped_query(name, project),
+                                {'$set': {'s': stats}},
+                                multi=False, manipulate=False)
+
+        return stats
+
+    def _incremental_stats_for(self, name, project, now):
+        """Gets the queue's stats, reconciling them if necessary."""
+        query = _get_scoped_query(name, project)
+        doc = self._collection.find_one(query, fields={'s': 1, '_id': 0})
+        if doc is None:
+            raise exceptions.QueueDoesNotExist(name, project)
+
+        stats = doc.get('s')
+
+        if (stats is None or 'r' not in stats or
+                now - stats['r'] >= self._stats_reconcile_interval):
+            return self._reconcile_stats(name, project, now)
+
+        if stats.get('m', 0) <= 0:
+            return stats
+
+        # If the newest message has expired, most
+        # likely every other message has as well, so start over.
+        newest = stats.get('n')
+        if newest is None or newest['e'] <= now:
+            return self._reconcile_stats(name, project, now)
+
+        oldest = stats.get('o')
+        if oldest is None or oldest['e'] <= now:
+            controller = self.driver.message_controller
+
+            try:
+                message = controller.first(name, project=project, sort=1)
+            except exceptions.QueueIsEmpty:
+                return self._reconcile_stats(name, project, now)
+
+            stats['o'] = _stat_ref(message)
+            self._collection.update(query, {'$set': {'s.o': stats['o']}},
+                                    multi=False, manipulate=False)
+
+        return stats
+
     #-----------------------------------------------------------------------
     # Interface
     #-----------------------------------------------------------------------
@@ -190,7 +579,12 @@ class QueueController(storage.QueueBase):
         if detailed:
             fields['m'] = 1
 
-        cursor = self._collection.find(query, fields=fields)
+        kwargs = {}
+        preference = self.driver.stale_read_preference(self.driver.connection)
+        if preference is not None:
+            kwargs['read_preference'] = preference
+
+        cursor = self._collection.find(query, fields=fields, **kwargs)
         cursor = cursor.limit(limit).sort('p_q')
         marker_name = {}
 
@@ -206,8 +600,12 @@ class QueueController(storage.QueueBase):
 
     @utils.raises_conn_error
     def get_metadata(self, name, project=None):
-        queue = self._get(name, project)
-        return queue.get('m', {})
+        metadata = self._cached_metadata(name, project)
+        if metadata is None:
+            metadata = self._get(name, project).get('m', {})
+            self._cache_metadata(name, project, metadata)
+
+        return metadata
 
     @utils.raises_conn_error
     def create(self, name, project=None):
@@ -215,21 +613,34 @@ class QueueController(storage.QueueBase):
             # NOTE(kgriffs): Start counting at 1, and assume the first
             # message ever posted will succeed and set t to a UNIX
             # "modified at" timestamp.
-            counter = {'v': 1, 't': 0}
+            counter = {'v': 1, 't': 0, 'h': 1}
 
             scoped_name = utils.scope_queue_name(name, project)
-            self._collection.insert({'p_q': scoped_name, 'm': {},
-                                     'c': counter})
+            queue = {'p_q': scoped_name, 'm': {}, 'c': counter}
+
+            if self._incremental_stats:
+                queue['s'] = {'m': 0, 'c': 0,
+                              'r': timeutils.utcnow_ts()}
+
+            self._collection.insert(queue)
 
         except pymongo.errors.DuplicateKeyError:
             return False
         else:
+            self._cache_metadata(name, project, {})
             return True
 
     @utils.raises_conn_error
     def exists(self, name, project=None):
-        query = _get_scoped_query(name, project)
-        return self._collection.find_one(query) is not None
+        if self._cached_metadata(name, project) is not None:
+            return True
+
+        try:
+            self.get_metadata(name, project)
+        except exceptions.QueueDoesNotExist:
+            return False
+
+        return True
 
     @utils.raises_conn_error
     def set_metadata(self, name, metadata, project=None):
@@ -239,43 +650,72 @@ class QueueController(storage.QueueBase):
                                       manipulate=False)
 
         if not rst['updatedExisting']:
+            self._invalidate(name, project)
             raise exceptions.QueueDoesNotExist(name, project)
 
+        self._cache_metadata(name, project, metadata)
+
     @utils.raises_conn_error
     def delete(self, name, project=None):
         self.driver.message_controller._purge_queue(name, project)
         self._collection.remove(_get_scoped_query(name, project))
 
+        # Only invalidate once the queue is gone, so
+        # that a parallel read can not cache it again in between.
+        self._invalidate(name, project)
+
     @utils.raises_conn_error
     def stats(self, name, project=None):
-        if not self.exists(name, project=project):
-            raise exceptions.QueueDoesNotExist(name, project)
+        now = timeutils.utcnow_ts()
 
-        controller = self.driver.message_controller
+        if self._incremental_stats:
+            stats = self._incremental_stats_for(name, project, now)
+        else:
+            if not self.exists(name, project=project):
+                raise exceptions.QueueDoesNotExist(name, project)
 
-        active = controller._count(name, project=project,
-                                   include_claimed=False)
-        total = controller._count(name, project=project,
-                                  include_claimed=True)
+            stats = self._collect_stats(name, project)
+
+        # Incrementally maintained counts may drift
+        # between reconciliations, so keep them within sane bounds.
+        total = max(stats.get('m', 0), 0)
+        claimed = min(max(stats.get('c', 0), 0), total)
 
         message_stats = {
-            'claimed': total - active,
-            'free': active,
+            'claimed': claimed,
+            'free': total - claimed,
             'total': total,
         }
 
-        try:
-            oldest = controller.first(name, project=project, sort=1)
-            newest = controller.first(name, project=project, sort=-1)
-        except exceptions.QueueIsEmpty:
-            pass
-        else:
-            now = timeutils.utcnow_ts()
-            message_stats['oldest'] = utils.stat_message(oldest, now)
-            message_stats['newest'] = utils.stat_message(newest, now)
+        if total and 'o' in stats and 'n' in stats:
+            message_stats['oldest'] = utils.stat_message(
+                {'_id': stats['o']['id']}, now)
+            message_stats['newest'] = utils.stat_message(
+                {'_id': stats['n']['id']}, now)
 
         return {'messages': message_stats}
 
 
 def _get_scoped_query(name, project):
     return {'p_q': utils.scope_queue_name(name, project)}
+
+
+def _merge_update(update, other):
+    """Merges the operators of another update document into update.
+
+    :param other: Update document to merge, or None
+    :returns: update
+    """
+    if other is not None:
+        for operator, fields in other.items():
+            update.setdefault(operator, {}).update(fields)
+
+    return update
+
+
+def _stat_ref(message):
+    """Creates a reference to the given message, for queue stats."""
+    return {
+        'id': message['_id'],
+        'e': calendar.timegm(message['e'].utctimetuple()),
+    }
@@ -0,0 +1,78 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Online rebalancing of MongoDB message partitions.
+
+Changing the number of partitions, or switching to a consistent hash
+ring, changes the partition that some queues map to. To do so without
+downtime:
+
+1. Set `partitions` and `partition_vnodes` to their new values, and
+   `previous_partitions` and `previous_partition_vnodes` to the old
+   ones, on every server. While both are set, every queue whose
+   partition changed is read from both partitions, and new messages
+   are only written to its new partition.
+2. Call `rebalance` (e.g., from a one-off script) to move the
+   remaining messages of those queues to their new partitions.
+3. Set `previous_partitions` back to 0 on every server.
+"""
+
+import marconi.openstack.common.log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+def rebalance(driver, batch_size=100):
+    """Moves messages to the partitions their queues now map to.
+
+    Safe to run while the driver is in use by other processes, and
+    to run again if interrupted.
+
+    :param driver: MongoDB data driver instance, configured with
+        `previous_partitions`.
+    :param batch_size: (Default 100) Number of messages to read
+        at a time.
+    :returns: Number of messages moved
+    :raises: ValueError if the driver is not configured for
+        rebalancing.
+    """
+
+    conf = driver.mongodb_conf
+
+    if not conf.previous_partitions:
+        raise ValueError(u'previous_partitions must be set in order '
+                         u'to rebalance partitions')
+
+    if conf.separate_claims:
+        raise ValueError(u'Partitions can not be rebalanced while '
+                         u'separate_claims is enabled')
+
+    msg_ctrl = driver.message_controller
+    queues = driver.queue_controller._collection.find(
+        {}, fields={'p_q': 1, '_id': 0})
+
+    moved = 0
+    for queue in queues:
+        project, name = queue['p_q'].split('/', 1)
+        count = msg_ctrl._migrate(name, project or None, batch_size)
+
+        if count:
+            LOG.info(u'Moved %(count)d message(s) for queue %(queue)s',
+                     {'count': count, 'queue': queue['p_q']})
+
+        moved += count
+
+    return moved
@@ -14,15 +14,20 @@
 # limitations under the License.
 
 import binascii
+import bisect
 import collections
 import datetime
 import functools
+import hashlib
 import random
+import threading
 
 from bson import errors as berrors
 from bson import objectid
 from bson import tz_util
 from pymongo import errors
+from pymongo import read_preferences
+import six
 
 import marconi.openstack.common.log as logging
 from marconi.openstack.common import timeutils
@@ -124,6 +129,19 @@ def oid_ts(oid):
         raise TypeError(u'Expected ObjectId and got %s' % type(oid))
 
 
+def basic_message(msg, now):
+    """Creates a message document for the client, relative to now."""
+    oid = msg['_id']
+    age = now - oid_ts(oid)
+
+    return {
+        'id': str(oid),
+        'age': int(age),
+        'ttl': msg['t'],
+        'body': msg['b'],
+    }
+
+
 def stat_message(message, now):
     """Creates a stat document from the given message, relative to now."""
     oid = message['_id']
@@ -193,6 +211,62 @@ def get_partition(num_partitions, queue, project=None):
     return binascii.crc32(name) % num_partitions
 
 
+class PartitionRing(object):
+    """Consistent hash ring for mapping queues to partitions.
+
+    Each partition is placed on the ring at a number of pseudo-random
+    points (virtual nodes), and a queue belongs to the partition that
+    owns the first point at or after the queue's own hash. Unlike
+    `get_partition`, adding a partition only moves about 1/N of the
+    queues, all of them to the new partition.
+
+    :param num_partitions: Number of partitions on the ring
+    :param vnodes: Number of virtual nodes per partition. More
+        virtual nodes make for a more uniform distribution, at
+        the cost of a larger ring.
+    """
+
+    def __init__(self, num_partitions, vnodes):
+        points = sorted((_ring_hash('%d-%d' % (partition, vnode)), partition)
+                        for partition in range(num_partitions)
+                        for vnode in range(vnodes))
+
+        self._keys = [key for key, partition in points]
+        self._partitions = [partition for key, partition in points]
+
+    def get_partition(self, queue, project=None):
+        """Get the partition number for a given queue and project."""
+
+        name = project + queue if project is not None else queue
+
+        index = bisect.bisect_left(self._keys, _ring_hash(name))
+        return self._partitions[index % len(self._keys)]
+
+
+def _ring_hash(name):
+    if isinstance(name, six.text_type):
+        name = name.encode('utf-8')
+
+    return int(hashlib.md5(name).hexdigest()[:8], 16)
+
+
+def partitioner(num_partitions, vnodes=0):
+    """Creates a function that maps queues to partitions.
+
+    :param num_partitions: Number of partitions
+    :param vnodes: (Default 0) Number of virtual nodes per
+        partition on a consistent hash ring, or 0 to use
+        `get_partition`, as before.
+    :returns: A callable that takes a queue name and,
+        optionally, a project ID, and returns a partition number.
+    """
+
+    if vnodes > 0:
+        return PartitionRing(num_partitions, vnodes).get_partition
+
+    return functools.partial(get_partition, num_partitions)
+
+
 def raises_conn_error(func):
     """Handles mongodb ConnectionFailure error
 
@@ -232,3 +306,139 @@ class HookedCursor(object):
     def next(self):
         item = next(self.cursor)
         return self.denormalizer(item)
+
+
+class LRUCache(object):
+    """Thread-safe, in-process cache with bounded size and TTL.
+
+    When the cache is full, the least-recently used entry is
+    evicted to make room for the new one.
+
+    :param size: Maximum number of entries to keep
+    :param ttl: Number of seconds for which an entry is valid
+    """
+
+    def __init__(self, size, ttl):
+        self._size = size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        now = timeutils.utcnow_ts()
+
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return default
+
+            if expires <= now:
+                return default
+
+            # Re-insert the entry so that it
+            # becomes the most-recently used one.
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        expires = timeutils.utcnow_ts() + self._ttl
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+            while len(self._entries) >= self._size:
+                self._entries.popitem(last=False)
+
+            self._entries[key] = (expires, value)
+
+    def pop(self, key, default=None):
+        """Removes an entry from the cache, returning its value."""
+        now = timeutils.utcnow_ts()
+
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return default
+
+            return default if expires <= now else value
+
+    def unset(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class StalenessMonitor(object):
+    """Routes stale-tolerant reads based on replication lag.
+
+    Reads are routed to secondaries only while every secondary in
+    the replica set is known to lag behind the primary by no more
+    than the given number of seconds. The lag is checked at most
+    once every `interval` seconds, so reads may be up to
+    max_staleness + interval seconds stale in the worst case.
+
+    If the lag can not be determined (e.g., when not connected
+    to a replica set), reads are routed to the primary.
+
+    :param connection: MongoDB client connection
+    :param max_staleness: Maximum acceptable lag, in seconds
+    :param interval: Minimum number of seconds between checks
+    """
+
+    def __init__(self, connection, max_staleness, interval):
+        self._connection = connection
+        self._max_staleness = max_staleness
+        self._interval = interval
+
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._preference = read_preferences.ReadPreference.PRIMARY
+
+    def read_preference(self):
+        """Gets the read preference to use for stale-tolerant reads."""
+
+        now = timeutils.utcnow_ts()
+
+        # Only one thread checks at a time; the
+        # others go with the last known preference meanwhile.
+        if (self._checked_at is None or
+                now - self._checked_at >= self._interval):
+            if self._lock.acquire(False):
+                try:
+                    self._checked_at = now
+                    self._preference = self._check()
+                finally:
+                    self._lock.release()
+
+        return self._preference
+
+    def _check(self):
+        try:
+            status = self._connection.admin.command('replSetGetStatus')
+        except Exception as ex:
+            LOG.debug(u'Unable to get replica set status: %s', ex)
+            return read_preferences.ReadPreference.PRIMARY
+
+        optimes = {}
+        for member in status.get('members', []):
+            optimes.setdefault(member.get('state'), []).append(
+                member['optimeDate'])
+
+        # Member states; 1 is PRIMARY, 2 is SECONDARY
+        primary, secondaries = optimes.get(1), optimes.get(2)
+        if not primary or not secondaries:
+            return read_preferences.ReadPreference.PRIMARY
+
+        lag = timeutils.delta_seconds(min(secondaries), primary[0])
+        if lag > self._max_staleness:
+            LOG.debug(u'Replication lag of %(lag)s seconds exceeds the '
+                      u'maximum staleness; reading from the primary',
+                      {'lag': lag})
+
+            return read_preferences.ReadPreference.PRIMARY
+
+        return read_preferences.ReadPreference.SECONDARY_PREFERRED
@@ -0,0 +1,139 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process notifications of new messages.
+
+Storage drivers call `notify` once messages have been posted to a
+queue, so that requests waiting on that queue within the same process
+(i.e., long polls) can check for them right away, rather than waiting
+for their next polling interval. Posts made by other processes are
+not seen, so waiters must still poll from time to time.
+"""
+
+import threading
+
+
+class Notifier(object):
+    """Wakes up the watchers of a queue when messages are posted to it.
+
+    Only queues that are currently being watched are tracked, so
+    notifying a queue that nobody is watching is cheap.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def notify(self, name, project=None):
+        """Wakes up every watcher of the given queue."""
+        key = _key(name, project)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.generation += 1
+                entry.condition.notify_all()
+
+    def watch(self, name, project=None):
+        """Starts watching the given queue for new messages.
+
+        Use the returned watcher as a context manager, so that it
+        is released once the caller is done waiting.
+        """
+        key = _key(name, project)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(self._lock)
+                self._entries[key] = entry
+
+            entry.watchers += 1
+
+        return _Watcher(self, key, entry)
+
+    def _release(self, key, entry):
+        with self._lock:
+            entry.watchers -= 1
+            if entry.watchers == 0:
+                del self._entries[key]
+
+
+class _Entry(object):
+
+    __slots__ = ('condition', 'generation', 'watchers')
+
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.generation = 0
+        self.watchers = 0
+
+
+class _Watcher(object):
+
+    __slots__ = ('_notifier', '_key', '_entry', '_seen')
+
+    def __init__(self, notifier, key, entry):
+        self._notifier = notifier
+        self._key = key
+        self._entry = entry
+        self._seen = entry.generation
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._notifier._release(self._key, self._entry)
+
+    def wait(self, timeout):
+        """Waits for messages to be posted to the queue.
+
+        Returns immediately if messages were posted since the watcher
+        was created or since the last call to this method, so that
+        posts made while the caller was checking for messages are
+        never missed.
+
+        :param timeout: Maximum number of seconds to wait
+        :returns: True if messages were posted, False otherwise
+        """
+        entry = self._entry
+
+        with entry.condition:
+            if entry.generation == self._seen:
+                entry.condition.wait(timeout)
+
+            posted = entry.generation != self._seen
+            self._seen = entry.generation
+
+        return posted
+
+
+def _key(name, project):
+    # Drivers disagree on whether the default
+    # project is None or the empty string.
+    return (project or '', name)
+
+
+_NOTIFIER = Notifier()
+
+
+def notify(name, project=None):
+    """Signals the process-wide notifier. See `Notifier.notify`."""
+    _NOTIFIER.notify(name, project)
+
+
+def watch(name, project=None):
+    """Watches the process-wide notifier. See `Notifier.watch`."""
+    return _NOTIFIER.watch(name, project)
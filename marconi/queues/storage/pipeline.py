@@ -14,11 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import inspect
+
 from oslo.config import cfg
 from stevedore import driver
 
 from marconi import common
 from marconi.common import decorators
+from marconi.common import metrics
 from marconi.openstack.common import log as logging
 from marconi.queues.storage import base
 
@@ -36,10 +39,46 @@ _PIPELINE_CONFIGS = [
     for resource in _PIPELINE_RESOURCES
 ]
 
+_PIPELINE_CONFIGS.append(
+    cfg.BoolOpt('pipeline_timing', default=False,
+                help=_('Record the time spent in each stage of the '
+                       'storage pipelines, including the storage '
+                       'driver\'s controllers, in the metrics sink.')))
+
 _PIPELINE_GROUP = 'storage'
 
+try:
+    _getargspec = inspect.getfullargspec
+except AttributeError:
+    _getargspec = inspect.getargspec
+
+
+def _load_stage(stage_cls, **kwargs):
+    """Instantiates a stage with the arguments it declares.
+
+    Stages were originally instantiated without arguments, so
+    only those named in the stage's constructor are passed on.
+
+    :param stage_cls: Stage class to instantiate
+    :param kwargs: Arguments the stage may declare, by name
+
+    :returns: The stage instance
+    """
+    try:
+        argspec = _getargspec(stage_cls.__init__)
+    except TypeError:
+        # Stages that do not define __init__ inherit
+        # object's, which cannot be introspected.
+        return stage_cls()
+
+    if argspec[2] is None:
+        kwargs = dict((name, value) for name, value in kwargs.items()
+                      if name in argspec.args)
+
+    return stage_cls(**kwargs)
+
 
-def _get_storage_pipeline(resource_name, conf):
+def _get_storage_pipeline(resource_name, conf, cache=None, storage=None):
     """Constructs and returns a storage resource pipeline.
 
     This is a helper function for any service supporting
@@ -54,8 +93,15 @@ def _get_storage_pipeline(resource_name, conf):
     to the next stage, ending with the actual storage
     controller.
 
+    Stages may take the configuration, the cache backend
+    and the storage driver as constructor arguments, named
+    `conf`, `cache` and `storage`; each is passed only to
+    the stages declaring it.
+
     :param conf: Configuration instance.
     :type conf: `cfg.ConfigOpts`
+    :param cache: (Default None) Cache backend to pass to stages
+    :param storage: (Default None) Storage driver to pass to stages
 
     :returns: A pipeline to use.
     :rtype: `Pipeline`
@@ -69,14 +115,19 @@ def _get_storage_pipeline(resource_name, conf):
     for ns in storage_conf[resource_name + '_pipeline']:
         try:
             mgr = driver.DriverManager('marconi.queues.storage.stages',
-                                       ns, invoke_on_load=True)
-            pipeline.append(mgr.driver)
+                                       ns, invoke_on_load=False)
+            pipeline.append(_load_stage(mgr.driver, conf=conf,
+                                        cache=cache, storage=storage))
         except RuntimeError as exc:
             LOG.warning(_(u'Stage %(stage)d could not be imported: %(ex)s'),
                         {'stage': ns, 'ex': str(exc)})
             continue
 
-    return common.Pipeline(pipeline)
+    sink = None
+    if storage_conf.pipeline_timing:
+        sink = metrics.get_sink(conf)
+
+    return common.Pipeline(pipeline, sink=sink)
 
 
 class DataDriver(base.DataDriverBase):
@@ -87,26 +138,32 @@ class DataDriver(base.DataDriverBase):
     :param conf: Configuration from which to load pipeline settings
     :param storage: Storage driver that will service requests as the
         last step in the pipeline
+    :param cache: (Default None) Cache backend for stages to use
     """
 
-    def __init__(self, conf, storage):
+    def __init__(self, conf, storage, cache=None):
         super(DataDriver, self).__init__(conf)
         self._storage = storage
+        self._cache = cache
+
+    def _pipeline(self, resource_name):
+        return _get_storage_pipeline(resource_name, self.conf,
+                                     self._cache, self._storage)
 
     @decorators.lazy_property(write=False)
     def queue_controller(self):
-        stages = _get_storage_pipeline('queue', self.conf)
+        stages = self._pipeline('queue')
         stages.append(self._storage.queue_controller)
         return stages
 
     @decorators.lazy_property(write=False)
     def message_controller(self):
-        stages = _get_storage_pipeline('message', self.conf)
+        stages = self._pipeline('message')
         stages.append(self._storage.message_controller)
         return stages
 
     @decorators.lazy_property(write=False)
     def claim_controller(self):
-        stages = _get_storage_pipeline('claim', self.conf)
+        stages = self._pipeline('claim')
         stages.append(self._storage.claim_controller)
         return stages
@@ -79,14 +79,11 @@ class ClaimController(base.ClaimBase):
             id = self.driver.lastrowid
 
             self.driver.run('''
-                insert into Locked
-                select last_insert_rowid(), id
-                  from Messages left join Locked
-                    on id = msgid
-                 where msgid is null
-                   and ttl > julianday() * 86400.0 - created
-                   and qid = ?
-                 limit ?''', qid, limit)
+                update Messages
+                   set cid = ?,
+                       claim_expires = julianday() * 86400.0 + ?
+                 where id in (%s)''' % utils.claimable_head('id'),
+                            id, metadata['ttl'], qid, limit)
 
             messages_ttl = metadata['ttl'] + metadata['grace']
             self.__update_claimed(id, messages_ttl)
@@ -96,9 +93,8 @@ class ClaimController(base.ClaimBase):
     def __get(self, cid):
         records = self.driver.run('''
             select id, content, ttl, julianday() * 86400.0 - created
-              from Messages join Locked
-                on msgid = id
-             where ttl > julianday() * 86400.0 - created
+              from Messages
+             where expires > julianday() * 86400.0
                and cid = ?''', cid)
 
         for id, content, ttl, age in records:
@@ -135,6 +131,11 @@ class ClaimController(base.ClaimBase):
                                                    queue,
                                                    project)
 
+            self.driver.run('''
+                update Messages
+                   set claim_expires = julianday() * 86400.0 + ?
+                 where cid = ?''', metadata['ttl'], id)
+
             self.__update_claimed(id, metadata['ttl'])
 
     def __update_claimed(self, cid, ttl):
@@ -142,11 +143,11 @@ class ClaimController(base.ClaimBase):
         self.driver.run('''
             update Messages
                set created = julianday() * 86400.0,
-                   ttl = ?
+                   ttl = ?,
+                   expires = julianday() * 86400.0 + ?
              where ttl < ?
-               and id in (select msgid from Locked
-                           where cid = ?)
-        ''', ttl, ttl, cid)
+               and cid = ?
+        ''', ttl, ttl, ttl, cid)
 
     def delete(self, queue, claim_id, project):
         if project is None:
@@ -156,9 +157,18 @@ class ClaimController(base.ClaimBase):
         if cid is None:
             return
 
-        self.driver.run('''
-            delete from Claims
-             where id = ?
-               and qid = (select id from Queues
-                           where project = ? and name = ?)
-        ''', cid, project, queue)
+        with self.driver('immediate'):
+            self.driver.run('''
+                delete from Claims
+                 where id = ?
+                   and qid = (select id from Queues
+                               where project = ? and name = ?)
+            ''', cid, project, queue)
+
+            # Release the claimed messages
+            if self.driver.affected:
+                self.driver.run('''
+                    update Messages
+                       set cid = null,
+                           claim_expires = 0
+                     where cid = ?''', cid)
@@ -15,6 +15,7 @@
 
 import contextlib
 import sqlite3
+import threading
 import uuid
 
 import msgpack
@@ -23,18 +24,63 @@ from oslo.config import cfg
 from marconi.common import decorators
 from marconi.queues import storage
 from marconi.queues.storage.sqlite import controllers
+from marconi.queues.storage.sqlite import migrations
 from marconi.queues.storage.sqlite import utils
 
 
 _SQLITE_OPTIONS = [
     cfg.StrOpt('database', default=':memory:',
-               help='Sqlite database to use.')
+               help='Sqlite database to use.'),
+
+    cfg.StrOpt('journal_mode', default='wal',
+               help=('Journal mode for file-backed databases. In WAL '
+                     'mode, readers do not block the writer, and the '
+                     'writer does not block readers.')),
+
+    cfg.StrOpt('synchronous', default='normal',
+               help=('How often SQLite waits for data to be written '
+                     'to disk (off, normal, full or extra). "normal" '
+                     'is safe from corruption in WAL mode, but the '
+                     'last transactions may be lost on power loss.')),
+
+    cfg.IntOpt('mmap_size', default=0,
+               help=('Maximum number of bytes of the database file to '
+                     'access through memory-mapped I/O. Set to 0 to '
+                     'disable memory-mapped I/O.')),
+
+    cfg.FloatOpt('busy_timeout', default=5.0,
+                 help=('Number of seconds to wait for another '
+                       'connection to release a lock on the database, '
+                       'before giving up.')),
+
+    cfg.FloatOpt('gc_interval', default=10.0,
+                 help=('Minimum number of seconds between sweeps for '
+                       'expired messages. Sweeps are made by the '
+                       'request posting messages, after they have been '
+                       'committed.')),
+
+    cfg.IntOpt('gc_batch_size', default=1000,
+               help=('Maximum number of expired messages to delete '
+                     'per sweep, in a single transaction. Should there '
+                     'be more, the sweep is repeated by the next '
+                     'request posting messages.')),
 ]
 
 _SQLITE_GROUP = 'queues:drivers:storage:sqlite'
 
+_MEMORY_DATABASE = ':memory:'
+
 
 class DataDriver(storage.DataDriverBase):
+    """SQLite data driver.
+
+    Each thread gets its own connection to file-backed databases,
+    so that parallel readers proceed while a single writer commits.
+
+    In-memory databases can not be shared among connections, so
+    every thread shares a single connection instead, and transactions
+    are serialized.
+    """
 
     def __init__(self, conf):
         super(DataDriver, self).__init__(conf)
@@ -43,17 +89,59 @@ class DataDriver(storage.DataDriverBase):
         self.sqlite_conf = self.conf[_SQLITE_GROUP]
 
         self.__path = self.sqlite_conf.database
+        self.__local = threading.local()
 
         # TODO(kgriffs): SHARDING - Make use of uri
-        self.__conn = sqlite3.connect(self.__path,
-                                      detect_types=sqlite3.PARSE_DECLTYPES)
-        self.__db = self.__conn.cursor()
-        self.run('''PRAGMA foreign_keys = ON''')
+        self.__shared_conn = None
+        self.__lock = _NoLock()
+        if self.__path == _MEMORY_DATABASE:
+            self.__shared_conn = self._connect()
+            self.__lock = threading.RLock()
+
+        migrations.upgrade(self)
+
+    def _connect(self):
+        """Opens a new connection to the database."""
+
+        # Transactions are begun and ended explicitly
+        # (see __call__), so turn off the implicit transactions of
+        # the sqlite3 module. Otherwise, a statement run outside of
+        # a transaction could keep the database locked.
+        conn = sqlite3.connect(self.__path,
+                               timeout=self.sqlite_conf.busy_timeout,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               isolation_level=None,
+                               check_same_thread=False)
+
+        conn.execute('PRAGMA foreign_keys = ON')
+
+        if self.__path != _MEMORY_DATABASE:
+            conn.execute('PRAGMA journal_mode = ' +
+                         self.sqlite_conf.journal_mode)
+            conn.execute('PRAGMA synchronous = ' +
+                         self.sqlite_conf.synchronous)
+            conn.execute('PRAGMA mmap_size = %d' %
+                         self.sqlite_conf.mmap_size)
+
+        return conn
 
-        self._ensure_tables()
+    @property
+    def __db(self):
+        """The calling thread's cursor."""
+        try:
+            return self.__local.cursor
+        except AttributeError:
+            conn = self.__shared_conn or self._connect()
+            self.__local.cursor = conn.cursor()
+            return self.__local.cursor
 
     def _ensure_tables(self):
-        """Creates tables if they don't already exist."""
+        """Creates tables if they don't already exist.
+
+        The tables are created as they were in the first version of
+        the schema. Called by marconi.queues.storage.sqlite.migrations,
+        which then applies the changes made to them since.
+        """
 
         # NOTE(kgriffs): Create tables all together rather
         # than separately in each controller, since some queries
@@ -140,7 +228,8 @@ class DataDriver(storage.DataDriverBase):
         :param sql: a query string with the '?' placeholders
         :param args: the arguments to substitute the placeholders
         """
-        return self.__db.execute(sql, args)
+        with self.__lock:
+            return self.__db.execute(sql, args)
 
     def run_multiple(self, sql, it):
         """Iteratively perform multiple SQL queries.
@@ -149,7 +238,8 @@ class DataDriver(storage.DataDriverBase):
         :param it: an iterator which yields a sequence of arguments to
                    substitute the placeholders
         """
-        self.__db.executemany(sql, it)
+        with self.__lock:
+            self.__db.executemany(sql, it)
 
     def get(self, sql, *args):
         """Runs %sql and returns the first entry in the results.
@@ -177,13 +267,23 @@ class DataDriver(storage.DataDriverBase):
 
     @contextlib.contextmanager
     def __call__(self, isolation):
-        self.run('begin ' + isolation)
-        try:
-            yield
-            self.__conn.commit()
-        except Exception:
-            self.__conn.rollback()
-            raise
+        with self.__lock:
+            # Nested transactions simply become
+            # part of the outermost one.
+            if getattr(self.__local, 'in_transaction', False):
+                yield
+                return
+
+            self.run('begin ' + isolation)
+            self.__local.in_transaction = True
+            try:
+                yield
+                self.run('commit')
+            except Exception:
+                self.run('rollback')
+                raise
+            finally:
+                self.__local.in_transaction = False
 
     @decorators.lazy_property(write=False)
     def queue_controller(self):
@@ -198,6 +298,16 @@ class DataDriver(storage.DataDriverBase):
         return controllers.ClaimController(self)
 
 
+class _NoLock(object):
+    """Stands in for a lock when none is needed."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
 class ControlDriver(storage.ControlDriverBase):
 
     def __init__(self, conf):
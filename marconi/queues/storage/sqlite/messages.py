@@ -13,14 +13,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+import time
+
 from marconi.openstack.common import timeutils
 from marconi.queues.storage import base
 from marconi.queues.storage import exceptions
+from marconi.queues.storage import notifier
 from marconi.queues.storage.sqlite import utils
 
 
 class MessageController(base.MessageBase):
 
+    def __init__(self, *args, **kwargs):
+        super(MessageController, self).__init__(*args, **kwargs)
+
+        self._reap_lock = threading.Lock()
+        self._reaped_at = 0
+
     def get(self, queue, message_id, project):
         if project is None:
             project = ''
@@ -34,7 +44,7 @@ class MessageController(base.MessageBase):
                 select content, ttl, julianday() * 86400.0 - created
                   from Queues as Q join Messages as M
                     on qid = Q.id
-                 where ttl > julianday() * 86400.0 - created
+                 where expires > julianday() * 86400.0
                    and M.id = ? and project = ? and name = ?
                 ''', mid, project, queue)
 
@@ -52,20 +62,25 @@ class MessageController(base.MessageBase):
         if project is None:
             project = ''
 
-        message_ids = ','.join(
-            ["'%s'" % id for id in
-             map(utils.msgid_decode, message_ids) if id is not None]
-        )
+        ids = [id for id in map(utils.msgid_decode, message_ids)
+               if id is not None]
 
         sql = '''
             select M.id, content, ttl, julianday() * 86400.0 - created
               from Queues as Q join Messages as M
                 on qid = Q.id
-             where ttl > julianday() * 86400.0 - created
+             where expires > julianday() * 86400.0
                and M.id in (%s) and project = ? and name = ?
-        ''' % message_ids
+        ''' % utils.ID_PLACEHOLDERS
+
+        # Read the records before yielding, so that
+        # the transaction is not held open by the caller.
+        records = []
+        with self.driver('deferred'):
+            for chunk in utils.id_chunks(ids):
+                args = chunk + (project, queue)
+                records.extend(self.driver.run(sql, *args))
 
-        records = self.driver.run(sql, project, queue)
         for id, content, ttl, age in records:
             yield {
                 'id': utils.msgid_encode(id),
@@ -82,8 +97,8 @@ class MessageController(base.MessageBase):
             sql = '''
                 select id, content, ttl, created,
                        julianday() * 86400.0 - created
-                  from Messages
-                 where ttl > julianday() * 86400.0 - created
+                  from Messages indexed by Messages_qid_id
+                 where expires > julianday() * 86400.0
                    and qid = ?
               order by id %s
                  limit 1'''
@@ -126,9 +141,10 @@ class MessageController(base.MessageBase):
         with self.driver('deferred'):
             sql = '''
                 select M.id, content, ttl, julianday() * 86400.0 - created
-                  from Queues as Q join Messages as M
+                  from Queues as Q
+                  join Messages as M indexed by Messages_qid_id
                     on M.qid = Q.id
-                 where M.ttl > julianday() * 86400.0 - created
+                 where M.expires > julianday() * 86400.0
                    and Q.name = ? and Q.project = ?'''
 
             args = [queue, project]
@@ -145,29 +161,35 @@ class MessageController(base.MessageBase):
 
             if not include_claimed:
                 sql += '''
-                   and M.id not in (select msgid
-                                      from Claims join Locked
-                                        on id = cid)'''
+                   and M.claim_expires <= julianday() * 86400.0'''
 
+            # Markers are message IDs, so messages must be listed in
+            # that order. Walking the queue by ID, rather than looking
+            # up every free message by claim_expires and sorting them,
+            # lets the scan stop once the page is full.
             sql += '''
+              order by M.id
                  limit ?'''
             args += [limit]
 
-            records = self.driver.run(sql, *args)
-            marker_id = {}
+            # Read the records before yielding, so that
+            # the transaction is not held open by the caller.
+            records = self.driver.run(sql, *args).fetchall()
 
-            def it():
-                for id, content, ttl, age in records:
-                    marker_id['next'] = id
-                    yield {
-                        'id': utils.msgid_encode(id),
-                        'ttl': ttl,
-                        'age': int(age),
-                        'body': content,
-                    }
+        marker_id = {}
 
-            yield it()
-            yield utils.marker_encode(marker_id['next'])
+        def it():
+            for id, content, ttl, age in records:
+                marker_id['next'] = id
+                yield {
+                    'id': utils.msgid_encode(id),
+                    'ttl': ttl,
+                    'age': int(age),
+                    'body': content,
+                }
+
+        yield it()
+        yield utils.marker_encode(marker_id['next'])
 
     def post(self, queue, messages, client_uuid, project):
         if project is None:
@@ -176,32 +198,63 @@ class MessageController(base.MessageBase):
         with self.driver('immediate'):
             qid = utils.get_qid(self.driver, queue, project)
 
-            # cleanup all expired messages in this queue
+            rows = [(qid, m['ttl'], self.driver.pack(m['body']),
+                     self.driver.uuid(client_uuid), m['ttl'])
+                    for m in messages]
 
-            self.driver.run('''
-                delete from Messages
-                 where ttl <= julianday() * 86400.0 - created
-                   and qid = ?''', qid)
+            # Let SQLite allocate the IDs. Since writers
+            # are serialized, and each new row gets an ID one larger
+            # than the largest one in the table, the IDs of the rows
+            # inserted here are contiguous, and end at the last one.
+            self.driver.run_multiple('''
+                insert into Messages
+                       (id, qid, ttl, content, client, created, expires)
+                values (null, ?, ?, ?, ?, julianday() * 86400.0,
+                        julianday() * 86400.0 + ?)''', rows)
 
-            # executemany() sets lastrowid to None, so no matter we manually
-            # generate the IDs or not, we still need to query for it.
+            last = self.driver.get('''
+                select last_insert_rowid()''')[0]
 
-            unused = self.driver.get('''
-                select max(id) + 1 from Messages''')[0] or 1001
-            my = dict(newid=unused)
+        notifier.notify(queue, project)
+        self._reap_expired()
 
-            def it():
-                for m in messages:
-                    yield (my['newid'], qid, m['ttl'],
-                           self.driver.pack(m['body']),
-                           self.driver.uuid(client_uuid))
-                    my['newid'] += 1
+        return map(utils.msgid_encode, range(last - len(rows) + 1, last + 1))
 
-            self.driver.run_multiple('''
-                insert into Messages
-                values (?, ?, ?, ?, ?, julianday() * 86400.0)''', it())
+    def _reap_expired(self):
+        """Deletes expired messages, every once in a while.
+
+        At most one chunk of messages is deleted per call, in its own
+        transaction, so that neither the caller nor other writers are
+        held up for long. While there are more expired messages than
+        fit in a chunk, the next call deletes another one, so a large
+        backlog is spread across subsequent posts. Only one thread
+        reaps at a time; the others simply skip it.
+        """
+
+        sqlite_conf = self.driver.sqlite_conf
+
+        now = time.time()
+        if now - self._reaped_at < sqlite_conf.gc_interval:
+            return
+
+        if not self._reap_lock.acquire(False):
+            return
+
+        try:
+            batch_size = sqlite_conf.gc_batch_size
 
-        return map(utils.msgid_encode, range(unused, my['newid']))
+            with self.driver('immediate'):
+                deleted = self.driver.run('''
+                    delete from Messages
+                     where id in (select id
+                                    from Messages
+                                   where expires <= julianday() * 86400.0
+                                   limit ?)''', batch_size).rowcount
+
+            if deleted < batch_size:
+                self._reaped_at = now
+        finally:
+            self._reap_lock.release()
 
     def delete(self, queue, message_id, project, claim=None):
         if project is None:
@@ -211,12 +264,27 @@ class MessageController(base.MessageBase):
         if id is None:
             return
 
+        # Delete the message with a single conditional
+        # statement. Only when nothing was deleted is the message
+        # looked up again, to find out why.
         with self.driver('immediate'):
+            if claim is None:
+                self.__delete_unclaimed(id, project, queue)
+            else:
+                cid = utils.cid_decode(claim)
+                if cid is None:
+                    return
+
+                self.__delete_claimed(id, cid, project, queue)
+
+            if self.driver.affected:
+                return
+
             message_exists, = self.driver.get('''
                 select count(M.id)
                   from Queues as Q join Messages as M
                     on qid = Q.id
-                 where ttl > julianday() * 86400.0 - created
+                 where expires > julianday() * 86400.0
                    and M.id = ? and project = ? and name = ?
             ''', id, project, queue)
 
@@ -224,54 +292,119 @@ class MessageController(base.MessageBase):
                 return
 
             if claim is None:
-                self.__delete_unclaimed(id)
-            else:
-                self.__delete_claimed(id, claim)
+                raise exceptions.MessageIsClaimed(id)
 
-    def __delete_unclaimed(self, id):
+            raise exceptions.MessageIsClaimedBy(id, claim)
+
+    def __delete_unclaimed(self, id, project, queue):
         self.driver.run('''
             delete from Messages
              where id = ?
-               and not exists (select *
-                                 from Claims join Locked
-                                   on id = cid
-                                where ttl > julianday() * 86400.0 - created)
-        ''', id)
-
-        if not self.driver.affected:
-            raise exceptions.MessageIsClaimed(id)
-
-    def __delete_claimed(self, id, claim):
-        # Precondition: id exists in a specific queue
-        cid = utils.cid_decode(claim)
-        if cid is None:
-            return
+               and qid = (select id from Queues
+                           where project = ? and name = ?)
+               and expires > julianday() * 86400.0
+               and claim_expires <= julianday() * 86400.0
+        ''', id, project, queue)
 
+    def __delete_claimed(self, id, cid, project, queue):
         self.driver.run('''
             delete from Messages
              where id = ?
-               and id in (select msgid
-                            from Claims join Locked
-                              on id = cid
-                           where ttl > julianday() * 86400.0 - created
-                             and id = ?)
-        ''', id, cid)
-
-        if not self.driver.affected:
-            raise exceptions.MessageIsClaimedBy(id, claim)
+               and qid = (select id from Queues
+                           where project = ? and name = ?)
+               and expires > julianday() * 86400.0
+               and cid = ?
+               and claim_expires > julianday() * 86400.0
+        ''', id, project, queue, cid)
 
-    def bulk_delete(self, queue, message_ids, project):
+    def bulk_delete(self, queue, message_ids, project, claim=None):
         if project is None:
             project = ''
 
-        message_ids = ','.join(
-            ["'%s'" % id for id in
-             map(utils.msgid_decode, message_ids) if id]
-        )
+        ids = [id for id in map(utils.msgid_decode, message_ids) if id]
 
-        self.driver.run('''
-            delete from Messages
-             where id in (%s)
-               and qid = (select id from Queues
-                           where project = ? and name = ?)
-        ''' % message_ids, project, queue)
+        if claim is None:
+            sql = '''
+                delete from Messages
+                 where id in (%s)
+                   and qid = (select id from Queues
+                               where project = ? and name = ?)
+            ''' % utils.ID_PLACEHOLDERS
+
+            with self.driver('immediate'):
+                self.driver.run_multiple(sql, [
+                    chunk + (project, queue)
+                    for chunk in utils.id_chunks(ids)
+                ])
+
+            return
+
+        # Only delete messages that belong to the given
+        # claim, a chunk at a time. Only when some were not deleted
+        # are the remaining ones looked up, to report them.
+        with self.driver('immediate'):
+            cid = utils.cid_decode(claim)
+            if cid is not None:
+                sql = '''
+                    delete from Messages
+                     where id in (%s)
+                       and qid = (select id from Queues
+                                   where project = ? and name = ?)
+                       and cid = ?
+                       and claim_expires > julianday() * 86400.0
+                ''' % utils.ID_PLACEHOLDERS
+
+                deleted = 0
+                for chunk in utils.id_chunks(ids):
+                    args = chunk + (project, queue, cid)
+                    deleted += self.driver.run(sql, *args).rowcount
+
+                if deleted == len(ids):
+                    return []
+
+            sql = '''
+                select M.id
+                  from Queues as Q join Messages as M
+                    on qid = Q.id
+                 where expires > julianday() * 86400.0
+                   and M.id in (%s) and project = ? and name = ?
+            ''' % utils.ID_PLACEHOLDERS
+
+            remaining = set()
+            for chunk in utils.id_chunks(ids):
+                args = chunk + (project, queue)
+                remaining.update(id for id, in self.driver.run(sql, *args))
+
+        return [message_id for message_id in message_ids
+                if utils.msgid_decode(message_id) in remaining]
+
+    def pop(self, queue, limit, project=None):
+        if project is None:
+            project = ''
+
+        with self.driver('immediate'):
+            try:
+                qid = utils.get_qid(self.driver, queue, project)
+            except exceptions.QueueDoesNotExist:
+                return []
+
+            records = list(self.driver.run(utils.claimable_head(
+                'id, content, ttl, julianday() * 86400.0 - created'),
+                qid, limit))
+
+            ids = [id for id, content, ttl, age in records]
+            self.driver.run_multiple('''
+                delete from Messages
+                 where id in (%s)''' % utils.ID_PLACEHOLDERS,
+                                     list(utils.id_chunks(ids)))
+
+        return [
+            {
+                'id': utils.msgid_encode(id),
+                'ttl': ttl,
+                'age': int(age),
+                'body': content,
+            }
+
+            for id, content, ttl, age in records
+        ]
@@ -0,0 +1,147 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Schema migrations for the SQLite driver.
+
+The version of the schema is kept in the `user_version` header field
+of the database file; the tables created by `DataDriver._ensure_tables`
+are version 0. Every migration brings the schema up by one version, so
+existing databases are upgraded in place, the next time they are
+opened.
+
+Migrations must only be appended to MIGRATIONS, never reordered
+or modified, since databases out there record how many of them
+have already been applied.
+"""
+
+import marconi.openstack.common.log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _add_indexes(driver):
+    """Indexes the columns that queries look rows up by."""
+
+    driver.run('''
+        create index if not exists
+        Messages_qid_id on Messages(qid, id)''')
+
+    driver.run('''
+        create index if not exists
+        Locked_msgid on Locked(msgid)''')
+
+    driver.run('''
+        create index if not exists
+        Locked_cid on Locked(cid)''')
+
+    driver.run('''
+        create index if not exists
+        Claims_qid on Claims(qid)''')
+
+
+def _add_message_expires(driver):
+    """Stores when each message expires, so that it can be indexed.
+
+    Checking whether a message is still alive then becomes a
+    comparison against the current time, rather than an expression
+    to compute for every row.
+    """
+
+    # Like created, in seconds since the Julian day
+    driver.run('''
+        alter table Messages
+        add column expires REAL''')
+
+    driver.run('''
+        update Messages
+           set expires = created + ttl''')
+
+    driver.run('''
+        create index if not exists
+        Messages_expires on Messages(expires)''')
+
+
+def _denormalize_claims(driver):
+    """Records on each message which claim it is locked by.
+
+    Messages get the ID of the last claim made on them, and the
+    time at which that claim expires (0 if never claimed, or if the
+    claim was deleted), so that whether a message is claimed can be
+    told from its row alone. This replaces the Locked table.
+    """
+
+    driver.run('''
+        alter table Messages
+        add column cid INTEGER''')
+
+    # Like expires, in seconds since the Julian day
+    driver.run('''
+        alter table Messages
+        add column claim_expires REAL not null default 0''')
+
+    driver.run('''
+        update Messages
+           set cid = (select cid from Locked
+                       where msgid = Messages.id),
+               claim_expires = coalesce(
+                   (select C.created + C.ttl
+                      from Claims as C join Locked
+                        on C.id = cid
+                     where msgid = Messages.id), 0)
+         where id in (select msgid from Locked)''')
+
+    driver.run('''
+        drop table Locked''')
+
+    driver.run('''
+        create index if not exists
+        Messages_qid_claim_expires on Messages(qid, claim_expires)''')
+
+    driver.run('''
+        create index if not exists
+        Messages_cid on Messages(cid)''')
+
+
+MIGRATIONS = [
+    _add_indexes,
+    _add_message_expires,
+    _denormalize_claims,
+]
+
+
+def upgrade(driver):
+    """Applies the migrations that the database is missing.
+
+    All of them are applied in a single exclusive transaction, so
+    that when several processes open the same database at once,
+    only one of them upgrades it.
+
+    :param driver: SQLite data driver whose database to upgrade
+    """
+    with driver('exclusive'):
+        current, = driver.get('PRAGMA user_version')
+
+        # Either a new database, or one created
+        # before there were any migrations.
+        if current == 0:
+            driver._ensure_tables()
+
+        for version in range(current, len(MIGRATIONS)):
+            LOG.info(u'Upgrading SQLite schema to version %d', version + 1)
+            MIGRATIONS[version](driver)
+
+        if current < len(MIGRATIONS):
+            driver.run('PRAGMA user_version = %d' % len(MIGRATIONS))
@@ -121,18 +121,21 @@ class QueueController(base.QueueBase):
 
         with self.driver('deferred'):
             qid = utils.get_qid(self.driver, name, project)
+
+            # Messages_qid_claim_expires is there for these counts.
+            # Queries that page through a queue use Messages_qid_id,
+            # so that they can stop early.
             claimed, free = self.driver.get('''
                 select * from
-                   (select count(msgid)
-                      from Claims join Locked
-                        on id = cid
-                     where ttl > julianday() * 86400.0 - created
+                   (select count(id)
+                      from Messages
+                     where claim_expires > julianday() * 86400.0
+                       and expires > julianday() * 86400.0
                        and qid = ?),
                    (select count(id)
-                      from Messages left join Locked
-                        on id = msgid
-                     where msgid is null
-                       and ttl > julianday() * 86400.0 - created
+                      from Messages
+                     where claim_expires <= julianday() * 86400.0
+                       and expires > julianday() * 86400.0
                        and qid = ?)
             ''', qid, qid)
 
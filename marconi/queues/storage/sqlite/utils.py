@@ -19,6 +19,15 @@ from marconi.queues.storage import exceptions
 
 UNIX_EPOCH_AS_JULIAN_SEC = 2440587.5 * 86400.0
 
+# Bulk operations bind IDs to a fixed number of
+# placeholders, so that the sqlite3 module prepares each of their
+# statements once and reuses it, however many IDs are given, and so
+# that statements stay well below SQLite's limit on the number of
+# variables they may have.
+BULK_CHUNK_SIZE = 64
+
+ID_PLACEHOLDERS = ','.join('?' * BULK_CHUNK_SIZE)
+
 
 class NoResult(Exception):
     pass
@@ -34,6 +43,19 @@ def get_qid(driver, queue, project):
         raise exceptions.QueueDoesNotExist(queue, project)
 
 
+def id_chunks(ids):
+    """Splits IDs into tuples of BULK_CHUNK_SIZE items each.
+
+    The last tuple is padded with None, which matches no ID, so
+    that every tuple can be bound to ID_PLACEHOLDERS.
+
+    :param ids: a list of database IDs
+    """
+    for start in range(0, len(ids), BULK_CHUNK_SIZE):
+        chunk = tuple(ids[start:start + BULK_CHUNK_SIZE])
+        yield chunk + (None,) * (BULK_CHUNK_SIZE - len(chunk))
+
+
 # The utilities below make the database IDs opaque to the users
 # of Marconi API.  The only purpose is to advise the users NOT to
 # make assumptions on the implementation of and/or relationship
@@ -42,6 +64,28 @@ def get_qid(driver, queue, project):
 # The magic numbers are arbitrarily picked; the numbers themselves
 # come with no special functionalities.
 
+def claimable_head(columns):
+    """Returns a query for the claimable messages at a queue's head.
+
+    The query selects `columns` from up to `limit` messages that are
+    neither expired nor claimed, oldest first, and takes the qid
+    and the limit as parameters, in that order.
+
+    The queue is walked in ID order, so that the scan stops once
+    enough messages are found. Left to itself, the planner may rather
+    look up every free message in the queue by claim_expires, and
+    then sort them all.
+    """
+    return '''
+        select %s
+          from Messages indexed by Messages_qid_id
+         where qid = ?
+           and claim_expires <= julianday() * 86400.0
+           and expires > julianday() * 86400.0
+      order by id
+         limit ?''' % columns
+
+
 def msgid_encode(id):
     return hex(id ^ 0x5c693a53)[2:]
 
@@ -0,0 +1,130 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Storage pipeline stages.
+
+Stages are loaded by name from the `marconi.queues.storage.stages`
+entry point namespace, according to the `{resource}_pipeline`
+options (see marconi.queues.storage.pipeline). A stage may take
+the configuration, the cache backend and the storage driver whose
+controllers end the pipeline as `conf`, `cache` and `storage`
+constructor arguments.
+"""
+
+from oslo.config import cfg
+
+from marconi.common.cache import cache as oslo_cache
+
+_QUEUE_CACHE_OPTIONS = [
+    cfg.IntOpt('metadata_ttl', default=5,
+               help=('Number of seconds for which to cache the '
+                     'existence and metadata of queues. Changes made '
+                     'through other processes may not be seen until '
+                     'the cached entry expires. Set to 0 to not cache '
+                     'them.')),
+
+    cfg.IntOpt('stats_ttl', default=2,
+               help=('Number of seconds for which to cache queue '
+                     'stats. Set to 0 to not cache stats.')),
+]
+
+_QUEUE_CACHE_GROUP = 'queues:storage:queue_cache'
+
+
+class QueueCache(object):
+    """Read-through cache for queue existence, metadata and stats.
+
+    Meant for the queue pipeline. Lookups are served from the cache
+    backend when possible. Otherwise, they go on to the next stages
+    in the pipeline, and their result is cached on the way back.
+    Writes invalidate the cached entries for the queue, both before
+    and after going on to the next stages.
+
+    Only queues that exist are cached, so that a queue created by
+    another process is never reported as missing.
+
+    :param conf: Configuration instance
+    :param cache: (Default None) Cache backend to use, or None to
+        load the configured one.
+    """
+
+    def __init__(self, conf, cache=None):
+        conf.register_opts(_QUEUE_CACHE_OPTIONS, group=_QUEUE_CACHE_GROUP)
+        self._conf = conf[_QUEUE_CACHE_GROUP]
+
+        self._cache = cache if cache is not None else (
+            oslo_cache.get_cache(conf))
+
+    def get_metadata(self, name, project=None):
+        if self._conf.metadata_ttl <= 0:
+            return None
+
+        return self._cache.get(_metadata_key(name, project))
+
+    def after_get_metadata(self, metadata, name, project=None):
+        if self._conf.metadata_ttl > 0 and metadata is not None:
+            self._cache.set(_metadata_key(name, project), metadata,
+                            ttl=self._conf.metadata_ttl)
+
+    def exists(self, name, project=None):
+        if self.get_metadata(name, project) is None:
+            return None
+
+        return True
+
+    def stats(self, name, project=None):
+        if self._conf.stats_ttl <= 0:
+            return None
+
+        return self._cache.get(_stats_key(name, project))
+
+    def after_stats(self, stats, name, project=None):
+        if self._conf.stats_ttl > 0 and stats is not None:
+            self._cache.set(_stats_key(name, project), stats,
+                            ttl=self._conf.stats_ttl)
+
+    # A lookup made while a write is in progress may cache the
+    # old value again, so the entries are invalidated once more
+    # after the write.
+
+    def create(self, name, project=None):
+        self._invalidate(name, project)
+
+    def after_create(self, result, name, project=None):
+        self._invalidate(name, project)
+
+    def set_metadata(self, name, metadata, project=None):
+        self._invalidate(name, project)
+
+    def after_set_metadata(self, result, name, metadata, project=None):
+        self._invalidate(name, project)
+
+    def delete(self, name, project=None):
+        self._invalidate(name, project)
+
+    def after_delete(self, result, name, project=None):
+        self._invalidate(name, project)
+
+    def _invalidate(self, name, project):
+        self._cache.unset(_metadata_key(name, project))
+        self._cache.unset(_stats_key(name, project))
+
+
+def _metadata_key(name, project):
+    return 'queue.m.' + (project or '') + '/' + name
+
+
+def _stats_key(name, project):
+    return 'queue.s.' + (project or '') + '/' + name
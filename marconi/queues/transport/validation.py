@@ -27,6 +27,20 @@ _TRANSPORT_LIMITS_OPTIONS = [
     cfg.IntOpt('message_ttl_max', default=1209600),
     cfg.IntOpt('claim_ttl_max', default=43200),
     cfg.IntOpt('claim_grace_max', default=43200),
+
+    # Each waiting request ties up a worker thread (or
+    # greenlet) of the WSGI server, so long polls are only allowed
+    # when the server can handle many requests concurrently.
+    cfg.IntOpt('message_wait_max', default=0,
+               help=('Maximum number of seconds that a request to list '
+                     'or claim messages may wait for messages to '
+                     'arrive. Set to 0 to disable waiting. Only enable '
+                     'this when running under a threaded or evented '
+                     'WSGI server. The WSGI transport\'s own server, '
+                     'as used by marconi-server, handles one request '
+                     'at a time, so a waiting request would stall '
+                     'every other one, including the post that would '
+                     'wake it up.')),
 ]
 
 _TRANSPORT_LIMITS_GROUP = 'queues:limits:transport'
@@ -142,6 +156,19 @@ class Validator(object):
                 'Limit must be at least 1 and may not be greater than %d. ' %
                 self._limits_conf.message_paging_uplimit)
 
+    def message_waiting(self, wait):
+        """Restrictions on waiting for messages to arrive.
+
+        :param wait: Number of seconds to wait, or None
+        :raises: ValidationFailed if wait is out of range
+        """
+
+        uplimit = self._limits_conf.message_wait_max
+        if wait is not None and not (0 <= wait <= uplimit):
+            raise ValidationFailed(
+                'Wait must be at least 0 and may not be greater than %d.' %
+                uplimit)
+
     def claim_creation(self, metadata, **kwargs):
         """Restrictions on the claim parameters upon creation.
 
@@ -14,20 +14,28 @@
 # limitations under the License.
 """marconi-queues (admin): interface for managing partitions."""
 
+from marconi.common import metrics as common_metrics
 from marconi.common.transport.wsgi import health
 from marconi.queues.transport.wsgi import driver
+from marconi.queues.transport.wsgi import metrics
 from marconi.queues.transport.wsgi.public import driver as public_driver
 
 
 class Driver(driver.DriverBase):
 
     def __init__(self, conf, storage, cache):
-        super(Driver, self).__init__(conf, storage, cache)
+        # The public driver must be initialized first,
+        # since the base class builds the routes, and those include
+        # the public driver's bridge.
         self.public = public_driver.Driver(conf, storage, cache)
+        super(Driver, self).__init__(conf, storage, cache)
 
     @property
     def bridge(self):
         return self.public.bridge + [
             ('/health',
-             health.Resource())
+             health.Resource()),
+
+            ('/metrics',
+             metrics.Resource(common_metrics.get_sink(self._conf)))
         ]
@@ -31,11 +31,13 @@ CLAIM_PATCH_SPEC = (('ttl', int),)
 
 class Resource(object):
 
-    __slots__ = ('claim_controller', '_metadata_max_length', '_validate')
+    __slots__ = ('claim_controller', '_metadata_max_length', '_validate',
+                 '_wait_poll_interval')
 
     def __init__(self, wsgi_conf, validate, claim_controller):
         self.claim_controller = claim_controller
         self._metadata_max_length = wsgi_conf.metadata_max_length
+        self._wait_poll_interval = wsgi_conf.wait_poll_interval
         self._validate = validate
 
 
@@ -50,6 +52,9 @@ class CollectionResource(Resource):
         limit = req.get_param_as_int('limit')
         claim_options = {} if limit is None else {'limit': limit}
 
+        # Optionally wait for messages to arrive when none are available
+        wait = req.get_param_as_int('wait')
+
         # Place JSON size restriction before parsing
         if req.content_length > self._metadata_max_length:
             description = _(u'Claim metadata size is too large.')
@@ -60,26 +65,38 @@ class CollectionResource(Resource):
         metadata, = wsgi_utils.filter_stream(req.stream, req.content_length,
                                              CLAIM_POST_SPEC)
 
-        # Claim some messages
         try:
             self._validate.claim_creation(metadata, **claim_options)
-            cid, msgs = self.claim_controller.create(
-                queue_name,
-                metadata=metadata,
-                project=project_id,
-                **claim_options)
-
-            # Buffer claimed messages
-            # TODO(kgriffs): optimize, along with serialization (below)
-            resp_msgs = list(msgs)
+            self._validate.message_waiting(wait)
 
         except validation.ValidationFailed as ex:
             raise wsgi_exceptions.HTTPBadRequestAPI(six.text_type(ex))
 
-        except Exception as ex:
-            LOG.exception(ex)
-            description = _(u'Claim could not be created.')
-            raise wsgi_exceptions.HTTPServiceUnavailable(description)
+        # Claim some messages
+        def create():
+            try:
+                cid, msgs = self.claim_controller.create(
+                    queue_name,
+                    metadata=metadata,
+                    project=project_id,
+                    **claim_options)
+
+                # Buffer claimed messages
+                # TODO(kgriffs): optimize, along with serialization (below)
+                resp_msgs = list(msgs)
+
+            except Exception as ex:
+                LOG.exception(ex)
+                description = _(u'Claim could not be created.')
+                raise wsgi_exceptions.HTTPServiceUnavailable(description)
+
+            return (cid, resp_msgs) if resp_msgs else None
+
+        claimed = wsgi_utils.wait_for_messages(create, queue_name,
+                                               project_id, wait,
+                                               self._wait_poll_interval)
+
+        cid, resp_msgs = claimed or (None, [])
 
         # Serialize claimed messages, if any. This logic assumes
         # the storage driver returned well-formed messages.
@@ -35,7 +35,15 @@ _WSGI_OPTIONS = [
                help='Port on which the self-hosting server will listen'),
 
     cfg.IntOpt('content_max_length', default=256 * 1024),
-    cfg.IntOpt('metadata_max_length', default=64 * 1024)
+    cfg.IntOpt('metadata_max_length', default=64 * 1024),
+
+    cfg.FloatOpt('wait_poll_interval', default=1.0,
+                 help=('Maximum number of seconds between checks for '
+                       'new messages while a request is waiting for '
+                       'them. Messages posted through the same process '
+                       'are picked up right away, but messages posted '
+                       'through other processes are only seen the next '
+                       'time the storage driver is checked.'))
 ]
 
 _WSGI_GROUP = 'queues:drivers:transport:wsgi'
@@ -123,6 +123,29 @@ class CollectionResource(object):
             ]
         }
 
+    def _pop(self, req, project_id, queue_name, limit):
+        """Removes up to `limit` messages from the queue and returns them."""
+        try:
+            self._validate.message_listing(limit=limit)
+            messages = self.message_controller.pop(
+                queue_name,
+                limit=limit,
+                project=project_id)
+
+        except validation.ValidationFailed as ex:
+            raise wsgi_exceptions.HTTPBadRequestAPI(six.text_type(ex))
+
+        except Exception as ex:
+            LOG.exception(ex)
+            description = _(u'Messages could not be popped.')
+            raise wsgi_exceptions.HTTPServiceUnavailable(description)
+
+        for each_message in messages:
+            each_message['href'] = req.path + '/' + each_message['id']
+            del each_message['id']
+
+        return messages
+
     #-----------------------------------------------------------------------
     # Interface
     #-----------------------------------------------------------------------
@@ -203,7 +226,20 @@ class CollectionResource(object):
 
         ids = req.get_param_as_list('ids')
         if ids is None:
-            response = self._get(req, project_id, queue_name)
+            # Optionally hold the request open until
+            # messages arrive, so that idle consumers do not need to
+            # keep polling the storage driver.
+            wait = req.get_param_as_int('wait')
+
+            try:
+                self._validate.message_waiting(wait)
+            except validation.ValidationFailed as ex:
+                raise wsgi_exceptions.HTTPBadRequestAPI(six.text_type(ex))
+
+            response = wsgi_utils.wait_for_messages(
+                lambda: self._get(req, project_id, queue_name),
+                queue_name, project_id, wait,
+                self._wsgi_conf.wait_poll_interval)
         else:
             base_path = req.path + '/messages'
             response = self._get_by_id(base_path, project_id, queue_name, ids)
@@ -216,16 +252,37 @@ class CollectionResource(object):
         # status defaults to 200
 
     def on_delete(self, req, resp, project_id, queue_name):
+        # Pop messages, i.e., claim and delete them
+        # in a single operation, for consumers that do not need
+        # to hold a claim while processing them.
+        pop_limit = req.get_param_as_int('pop')
+        if pop_limit is not None:
+            if req.get_param('ids') is not None:
+                description = _(u'The pop and ids parameters can not '
+                                u'be used together.')
+                raise wsgi_exceptions.HTTPBadRequestAPI(description)
+
+            messages = self._pop(req, project_id, queue_name, pop_limit)
+
+            if not messages:
+                resp.status = falcon.HTTP_204
+                return
+
+            resp.body = utils.to_json({'messages': messages})
+            return
+
         # NOTE(zyuan): Attempt to delete the whole message collection
         # (without an "ids" parameter) is not allowed
         ids = req.get_param_as_list('ids', required=True)
+        claim_id = req.get_param('claim_id')
 
         try:
             self._validate.message_listing(limit=len(ids))
-            self.message_controller.bulk_delete(
+            not_deleted = self.message_controller.bulk_delete(
                 queue_name,
                 message_ids=ids,
-                project=project_id)
+                project=project_id,
+                claim=claim_id)
 
         except validation.ValidationFailed as ex:
             raise wsgi_exceptions.HTTPBadRequestAPI(six.text_type(ex))
@@ -235,7 +292,19 @@ class CollectionResource(object):
             description = _(u'Messages could not be deleted.')
             raise wsgi_exceptions.HTTPServiceUnavailable(description)
 
-        resp.status = falcon.HTTP_204
+        if claim_id is None:
+            resp.status = falcon.HTTP_204
+            return
+
+        # Report which messages were acknowledged, and
+        # which are still in the queue because they are not part of
+        # the given claim (e.g., because the claim expired and the
+        # message was claimed again by someone else).
+        not_deleted = set(not_deleted)
+        resp.body = utils.to_json({
+            'deleted': [id for id in ids if id not in not_deleted],
+            'not_deleted': [id for id in ids if id in not_deleted],
+        })
 
 
 class ItemResource(object):
@@ -0,0 +1,37 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import falcon
+
+from marconi.queues.transport import utils
+
+
+class Resource(object):
+
+    __slots__ = ('sink')
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def on_get(self, req, resp, **kwargs):
+        snapshot = self.sink.snapshot()
+
+        if snapshot is None:
+            resp.status = falcon.HTTP_204
+            return
+
+        resp.content_location = req.path
+        resp.body = utils.to_json(snapshot)
+        # status defaults to 200
@@ -14,9 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 import uuid
 
 import marconi.openstack.common.log as logging
+from marconi.queues.storage import notifier
 from marconi.queues.transport import utils
 from marconi.queues.transport.wsgi import exceptions
 
@@ -171,3 +173,38 @@ def get_client_uuid(req):
     except ValueError:
         description = _(u'Malformed hexadecimal UUID.')
         raise exceptions.HTTPBadRequestAPI(description)
+
+
+def wait_for_messages(fetch, queue_name, project_id, wait, poll_interval):
+    """Calls fetch until it returns a result, or the wait expires.
+
+    Between attempts, waits for messages to be posted to the queue
+    by this process, for at most poll_interval seconds at a time, so
+    that messages posted through other processes are picked up, too.
+
+    :param fetch: Callable that takes no arguments and returns
+        a result that is false when no messages were found
+    :param queue_name: Name of the queue to wait on
+    :param project_id: Queue's project
+    :param wait: Maximum number of seconds to wait, or None to
+        call fetch only once
+    :param poll_interval: Maximum number of seconds between attempts
+    :returns: The last result returned by fetch
+    """
+
+    if not wait:
+        return fetch()
+
+    # Start watching before the first attempt, so that
+    # messages posted while fetching are not missed.
+    with notifier.watch(queue_name, project_id) as watcher:
+        deadline = time.time() + wait
+
+        while True:
+            result = fetch()
+
+            remaining = deadline - time.time()
+            if result or remaining <= 0:
+                return result
+
+            watcher.wait(min(remaining, poll_interval))
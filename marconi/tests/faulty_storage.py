@@ -96,5 +96,8 @@ class MessageController(storage.MessageBase):
     def delete(self, queue, message_id, project=None, claim=None):
         raise NotImplementedError()
 
-    def bulk_delete(self, queue, message_ids, project=None):
+    def bulk_delete(self, queue, message_ids, project=None, claim=None):
+        raise NotImplementedError()
+
+    def pop(self, queue, limit, project=None):
         raise NotImplementedError()
@@ -369,6 +369,116 @@ class MessageControllerTest(ControllerBaseTest):
                                    project=self.project,
                                    claim=cid)
 
+    def test_bulk_delete_with_claim(self):
+        _insert_fixtures(self.controller, self.queue_name,
+                         project=self.project, client_uuid=uuid.uuid4(),
+                         num=4)
+
+        interaction = self.controller.list(self.queue_name,
+                                           project=self.project,
+                                           echo=True)
+        ids = [msg['id'] for msg in next(interaction)]
+
+        meta = {'ttl': 70, 'grace': 60}
+        cid, msgs = self.claim_controller.create(self.queue_name, meta,
+                                                 project=self.project,
+                                                 limit=2)
+        claimed = [msg['id'] for msg in msgs]
+        unclaimed = [id for id in ids if id not in claimed]
+
+        another_cid, _ = self.claim_controller.create(self.queue_name, meta,
+                                                      project=self.project,
+                                                      limit=1)
+
+        # Only messages that belong to the claim are deleted
+        not_deleted = self.controller.bulk_delete(self.queue_name, ids,
+                                                  project=self.project,
+                                                  claim=cid)
+        self.assertEqual(not_deleted, unclaimed)
+
+        for id in claimed:
+            with testing.expect(storage.exceptions.DoesNotExist):
+                self.controller.get(self.queue_name, id,
+                                    project=self.project)
+
+        # Deleting messages that are gone is a no-op
+        not_deleted = self.controller.bulk_delete(self.queue_name, claimed,
+                                                  project=self.project,
+                                                  claim=cid)
+        self.assertEqual(not_deleted, [])
+
+    def test_pop(self):
+        _insert_fixtures(self.controller, self.queue_name,
+                         project=self.project, client_uuid=uuid.uuid4(),
+                         num=4)
+
+        meta = {'ttl': 70, 'grace': 60}
+        cid, msgs = self.claim_controller.create(self.queue_name, meta,
+                                                 project=self.project,
+                                                 limit=1)
+        [claimed] = msgs
+
+        # Claimed messages are skipped
+        popped = self.controller.pop(self.queue_name, 2,
+                                     project=self.project)
+
+        self.assertEqual([msg['body']['event'] for msg in popped],
+                         ['Event number 1', 'Event number 2'])
+
+        for msg in popped:
+            self.assertEqual(msg['ttl'], 120)
+
+            with testing.expect(storage.exceptions.DoesNotExist):
+                self.controller.get(self.queue_name, msg['id'],
+                                    project=self.project)
+
+        self.controller.get(self.queue_name, claimed['id'],
+                            project=self.project)
+
+        popped = self.controller.pop(self.queue_name, 2,
+                                     project=self.project)
+        self.assertEqual([msg['body']['event'] for msg in popped],
+                         ['Event number 3'])
+
+        self.assertEqual(self.controller.pop(self.queue_name, 2,
+                                             project=self.project), [])
+
+        self.assertEqual(self.controller.pop('not-a-queue', 2,
+                                             project=self.project), [])
+
+    def test_delete_unclaimed(self):
+        _insert_fixtures(self.controller, self.queue_name,
+                         project=self.project, client_uuid=uuid.uuid4(),
+                         num=2)
+
+        meta = {'ttl': 70, 'grace': 60}
+        cid, msgs = self.claim_controller.create(self.queue_name, meta,
+                                                 project=self.project,
+                                                 limit=1)
+        [claimed] = msgs
+
+        # A claimed message can not be deleted without its claim
+        with testing.expect(storage.exceptions.NotPermitted):
+            self.controller.delete(self.queue_name, claimed['id'],
+                                   project=self.project)
+
+        # Other messages in the queue are not affected by the claim
+        interaction = self.controller.list(self.queue_name,
+                                           project=self.project,
+                                           echo=True)
+        [unclaimed] = list(next(interaction))
+
+        self.controller.delete(self.queue_name, unclaimed['id'],
+                               project=self.project)
+
+        with testing.expect(storage.exceptions.DoesNotExist):
+            self.controller.get(self.queue_name, unclaimed['id'],
+                                project=self.project)
+
+        # Deleting a message that no longer exists is a no-op
+        self.controller.delete(self.queue_name, unclaimed['id'],
+                               project=self.project)
+
     @testing.is_slow(condition=lambda self: self.gc_interval != 0)
     def test_expired_messages(self):
         messages = [{'body': 3.14, 'ttl': 0}]
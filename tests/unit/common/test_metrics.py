@@ -0,0 +1,81 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from marconi.common import metrics
+from marconi.tests import base
+
+
+class TestRegistry(base.TestBase):
+
+    def setUp(self):
+        super(TestRegistry, self).setUp()
+        self.registry = metrics.Registry()
+
+    def test_incr(self):
+        self.registry.incr('conflicts')
+        self.registry.incr('conflicts', 2, scope='/fizbit')
+
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot['global']['counters'], {'conflicts': 3})
+        self.assertEqual(snapshot['scopes']['/fizbit']['counters'],
+                         {'conflicts': 2})
+
+    def test_observe(self):
+        for value in (1, 1, 7, 5000):
+            self.registry.observe('attempts', value, scope='/fizbit')
+
+        histogram = self.registry.snapshot('/fizbit')['histograms']['attempts']
+        self.assertEqual(histogram['count'], 4)
+        self.assertEqual(histogram['sum'], 5009)
+        self.assertEqual(histogram['buckets']['1'], 2)
+        self.assertEqual(histogram['buckets']['10'], 1)
+        self.assertEqual(histogram['buckets']['+Inf'], 1)
+        self.assertEqual(sum(histogram['buckets'].values()), 4)
+
+    def test_scopes_are_bounded(self):
+        registry = metrics.Registry(max_scopes=2)
+
+        registry.incr('conflicts', scope='/a')
+        registry.incr('conflicts', scope='/b')
+        registry.observe('attempts', 1, scope='/a')
+        registry.incr('conflicts', scope='/c')
+
+        # The least-recently updated scope is discarded,
+        # but the global metrics still account for it.
+        snapshot = registry.snapshot()
+        self.assertEqual(sorted(snapshot['scopes']), ['/a', '/c'])
+        self.assertEqual(snapshot['global']['counters'], {'conflicts': 3})
+
+    def test_snapshot_unknown_scope(self):
+        self.assertEqual(self.registry.snapshot('/nope'),
+                         {'counters': {}, 'histograms': {}})
+
+    def test_reset(self):
+        self.registry.incr('conflicts', scope='/fizbit')
+        self.registry.reset()
+
+        self.assertEqual(self.registry.snapshot(),
+                         {'global': {'counters': {}, 'histograms': {}},
+                          'scopes': {}})
+
+
+class TestNullSink(base.TestBase):
+
+    def test_discards(self):
+        sink = metrics.NullSink()
+        sink.incr('conflicts', scope='/fizbit')
+        sink.observe('attempts', 3)
+
+        self.assertIsNone(sink.snapshot())
@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import mock
+
+from marconi.common import metrics
 from marconi.common import pipeline
 from marconi.tests import base
 
@@ -87,3 +90,72 @@ class TestPipeLine(base.TestBase):
 
     def test_calls_the_latest(self):
         self.assertTrue(self.pipeline.calls_the_latest())
+
+    def test_stages_resolved_once(self):
+        self.assertTrue(self.pipeline.calls_the_latest())
+
+        with mock.patch.object(self.pipeline, '_resolve',
+                               wraps=self.pipeline._resolve) as resolve:
+            self.assertTrue(self.pipeline.calls_the_latest())
+            self.assertFalse(resolve.called)
+
+            # Appending a stage must be taken into
+            # account by consumers that were already created.
+            consumer = self.pipeline.consumer_for('does_not_exist')
+            self.assertRaises(AttributeError, consumer)
+
+            stage = mock.Mock()
+            stage.does_not_exist.return_value = 'found'
+            self.pipeline.append(stage)
+
+            self.assertEqual(consumer(), 'found')
+            self.assertEqual(resolve.call_count, 2)
+
+    def test_after_hooks(self):
+        class Hooked(object):
+            def __init__(self):
+                self.results = []
+
+            def with_args(self, name):
+                return None
+
+            def after_with_args(self, result, name):
+                self.results.append((result, name))
+
+            def no_args(self):
+                return True
+
+            def after_no_args(self, result):
+                self.results.append(result)
+
+        first, second = Hooked(), Hooked()
+        hooked = pipeline.Pipeline([first, second, FirstClass()])
+
+        self.assertEqual(hooked.with_args('James'), 'James')
+        self.assertEqual(first.results, [('James', 'James')])
+        self.assertEqual(second.results, [('James', 'James')])
+
+        # Hooks are only called on the stages before
+        # the one returning a value.
+        self.assertTrue(hooked.no_args())
+        self.assertEqual(first.results, [('James', 'James')])
+
+    def test_timing(self):
+        sink = metrics.Registry()
+        timed = pipeline.Pipeline([FirstClass(), SecondClass()], sink=sink)
+
+        self.assertTrue(timed.calls_the_latest())
+
+        histograms = sink.snapshot()['global']['histograms']
+        self.assertEqual(
+            histograms['pipeline.calls_the_latest.FirstClass']['count'], 1)
+        self.assertEqual(
+            histograms['pipeline.calls_the_latest.SecondClass']['count'], 1)
+
+        # Stages after the one returning a value
+        # are never called, and so are not timed either.
+        self.assertEqual(timed.with_args('James'), 'James')
+
+        histograms = sink.snapshot()['global']['histograms']
+        self.assertIn('pipeline.with_args.FirstClass', histograms)
+        self.assertNotIn('pipeline.with_args.SecondClass', histograms)
@@ -13,11 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 import time
 
+from bson import objectid
 import mock
+import pymongo.collection
 from pymongo import cursor
 import pymongo.errors
+import pymongo.read_preferences
 from testtools import matchers
 
 from marconi.openstack.common import timeutils
@@ -25,7 +29,11 @@ from marconi.queues import storage
 from marconi.queues.storage import exceptions
 from marconi.queues.storage import mongodb
 from marconi.queues.storage.mongodb import controllers
+from marconi.queues.storage.mongodb import events
+from marconi.queues.storage.mongodb import options
+from marconi.queues.storage.mongodb import rebalance
 from marconi.queues.storage.mongodb import utils
+from marconi.queues.storage import notifier
 from marconi import tests as testing
 from marconi.tests.queues.storage import base
 
@@ -46,6 +54,73 @@ class MongodbUtilsTest(testing.TestBase):
         self.assertEqual(utils.descope_queue_name('radiant/some-pig'),
                          'some-pig')
 
+    def test_partition_ring(self):
+        ring = utils.PartitionRing(4, 100)
+        names = ['queue-%d' % i for i in range(1000)]
+
+        partitions = [ring.get_partition(name, 'project') for name in names]
+        self.assertEqual(partitions,
+                         [ring.get_partition(name, 'project')
+                          for name in names])
+
+        for partition in range(4):
+            self.assertThat(partitions.count(partition),
+                            matchers.GreaterThan(150))
+
+        # Adding a partition only moves queues to the
+        # new partition, and only about a fifth of them.
+        larger = utils.PartitionRing(5, 100)
+        moved = [larger.get_partition(name, 'project')
+                 for name, partition in zip(names, partitions)
+                 if larger.get_partition(name, 'project') != partition]
+
+        self.assertEqual(set(moved), set([4]))
+        self.assertThat(len(moved), matchers.LessThan(300))
+
+    def test_partitioner(self):
+        self.assertEqual(utils.partitioner(7)('my-q', '123'),
+                         utils.get_partition(7, 'my-q', '123'))
+
+        ring = utils.PartitionRing(7, 10)
+        self.assertEqual(utils.partitioner(7, 10)('my-q', '123'),
+                         ring.get_partition('my-q', '123'))
+
+    def test_staleness_monitor(self):
+        primary = pymongo.read_preferences.ReadPreference.PRIMARY
+        secondary = (
+            pymongo.read_preferences.ReadPreference.SECONDARY_PREFERRED)
+
+        now = timeutils.utcnow()
+        status = {
+            'members': [
+                {'state': 1, 'optimeDate': now},
+                {'state': 2, 'optimeDate': now},
+                {'state': 2, 'optimeDate': now},
+            ]
+        }
+
+        connection = mock.MagicMock()
+        connection.admin.command.return_value = status
+
+        timeutils.set_time_override()
+        monitor = utils.StalenessMonitor(connection, 10, 5)
+        self.assertEqual(monitor.read_preference(), secondary)
+
+        # The lag is not checked again until the
+        # interval has passed.
+        status['members'][2]['optimeDate'] = (
+            now - datetime.timedelta(seconds=11))
+        self.assertEqual(monitor.read_preference(), secondary)
+
+        timeutils.advance_time_seconds(5)
+        self.assertEqual(monitor.read_preference(), primary)
+        self.assertEqual(connection.admin.command.call_count, 2)
+
+        timeutils.advance_time_seconds(5)
+        connection.admin.command.side_effect = (
+            pymongo.errors.OperationFailure('not running with --replSet'))
+        self.assertEqual(monitor.read_preference(), primary)
+
     def test_calculate_backoff(self):
         sec = utils.calculate_backoff(0, 10, 2, 0)
         self.assertEqual(sec, 0)
@@ -72,6 +147,29 @@ class MongodbUtilsTest(testing.TestBase):
         self.assertRaises(ValueError, utils.calculate_backoff, 10, 10, 2, 0)
         self.assertRaises(ValueError, utils.calculate_backoff, 11, 10, 2, 0)
 
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2, 10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        # Touch 'a' so that 'b' is evicted next
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.unset('c')
+        self.assertIsNone(cache.get('c'))
+
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+
+        cache.set('d', 4)
+        timeutils.advance_time_seconds(10)
+        self.assertEqual(cache.get('d', 'expired'), 'expired')
+
 
 @testing.requires_mongodb
 class MongodbDriverTest(testing.TestBase):
@@ -88,6 +186,58 @@ class MongodbDriverTest(testing.TestBase):
             self.assertThat(db.name, matchers.StartsWith(
                 driver.mongodb_conf.database))
 
+    def test_partition_uris(self):
+        uri = 'mongodb://127.0.0.1:27018'
+        overrides = {
+            'partitions': 3,
+            'partition_uris': ['', uri, uri],
+            'max_pool_size': 10,
+            'socket_timeout': 2.5,
+            'write_concern': 'majority',
+        }
+
+        self._conf.register_opts(options.MONGODB_OPTIONS,
+                                 group=options.MONGODB_GROUP)
+
+        for name, value in overrides.items():
+            self._conf.set_override(name, value,
+                                    group=options.MONGODB_GROUP)
+            self.addCleanup(self._conf.clear_override, name,
+                            group=options.MONGODB_GROUP)
+
+        with mock.patch('pymongo.MongoClient',
+                        side_effect=lambda *args, **kwargs: mock.MagicMock()
+                        ) as client:
+            driver = mongodb.DataDriver(self._conf)
+            connections = driver.message_connections
+
+        self.assertIs(connections[0], driver.connection)
+        self.assertIs(connections[1], connections[2])
+        self.assertIsNot(connections[1], connections[0])
+
+        self.assertEqual(client.call_count, 2)
+        client.assert_called_with(uri, max_pool_size=10,
+                                  socketTimeoutMS=2500, w='majority')
+
+    def test_unacknowledged_writes_are_rejected(self):
+        self._conf.register_opts(options.MONGODB_OPTIONS,
+                                 group=options.MONGODB_GROUP)
+
+        overrides = [
+            ('write_concern', '0'),
+            ('uri', 'mongodb://127.0.0.1:27017/?w=0'),
+            ('partition_uris', ['', 'mongodb://127.0.0.1:27018/?w=0']),
+        ]
+
+        for name, value in overrides:
+            self._conf.set_override(name, value,
+                                    group=options.MONGODB_GROUP)
+
+            try:
+                self.assertRaises(ValueError, mongodb.DataDriver, self._conf)
+            finally:
+                self._conf.clear_override(name, group=options.MONGODB_GROUP)
+
 
 @testing.requires_mongodb
 class MongodbQueueTests(base.QueueControllerTest):
@@ -122,6 +272,42 @@ class MongodbQueueTests(base.QueueControllerTest):
         for collection in self.message_controller._collections:
             self.assertEqual(collection.find({'q': queue_name}).count(), 0)
 
+    def test_queue_cache(self):
+        conf = self.driver.conf
+        conf.set_override('queue_cache_ttl', 60,
+                          group=options.MONGODB_GROUP)
+        self.addCleanup(conf.clear_override, 'queue_cache_ttl',
+                        group=options.MONGODB_GROUP)
+
+        controller = controllers.QueueController(self.driver)
+        controller.create('test', project=self.project)
+        controller.set_metadata('test', {'a': 1}, project=self.project)
+
+        with mock.patch.object(controller._collection, 'find_one') as find:
+            self.assertTrue(controller.exists('test', project=self.project))
+            self.assertEqual(controller.get_metadata('test',
+                                                     project=self.project),
+                             {'a': 1})
+            self.assertFalse(find.called)
+
+        controller.delete('test', project=self.project)
+        self.assertFalse(controller.exists('test', project=self.project))
+
+        # A read made while the queue is being deleted
+        # must not leave it cached as existing.
+        controller.create('test', project=self.project)
+        remove = controller._collection.remove
+
+        def racing_remove(*args, **kwargs):
+            controller.exists('test', project=self.project)
+            return remove(*args, **kwargs)
+
+        with mock.patch.object(controller._collection, 'remove',
+                               side_effect=racing_remove):
+            controller.delete('test', project=self.project)
+
+        self.assertFalse(controller.exists('test', project=self.project))
+
     def test_raises_connection_error(self):
 
         with mock.patch.object(cursor.Cursor, 'next', autospec=True) as method:
@@ -132,6 +318,96 @@ class MongodbQueueTests(base.QueueControllerTest):
             self.assertRaises(storage.exceptions.ConnectionError, queues.next)
 
 
+@testing.requires_mongodb
+class MongodbIncrementalStatsQueueTests(base.QueueControllerTest):
+
+    driver_class = mongodb.DataDriver
+    controller_class = controllers.QueueController
+
+    def setUp(self):
+        super(MongodbIncrementalStatsQueueTests, self).setUp()
+        self.load_conf('wsgi_mongodb.conf')
+
+        conf = self.driver.conf
+        conf.set_override('incremental_stats', True,
+                          group=options.MONGODB_GROUP)
+        self.addCleanup(conf.clear_override, 'incremental_stats',
+                        group=options.MONGODB_GROUP)
+
+        self.driver = mongodb.DataDriver(conf)
+        self.controller = self.driver.queue_controller
+        self.message_controller = self.driver.message_controller
+        self.claim_controller = self.driver.claim_controller
+
+    def tearDown(self):
+        self.controller._collection.drop()
+
+        for collection in self.message_controller._collections:
+            collection.drop()
+
+        super(MongodbIncrementalStatsQueueTests, self).tearDown()
+
+    def test_stats_are_incremental(self):
+        queue_name = 'stats-test'
+        self.controller.create(queue_name, project=self.project)
+
+        uuid = '97b64000-2526-11e3-b088-d85c1300734c'
+        ids = self.message_controller.post(queue_name,
+                                           [{'ttl': 60}] * 4,
+                                           uuid, project=self.project)
+
+        claim_id, _ = self.claim_controller.create(
+            queue_name, {'ttl': 60, 'grace': 60},
+            project=self.project, limit=3)
+
+        self.message_controller.delete(queue_name, ids[0],
+                                       project=self.project,
+                                       claim=claim_id)
+
+        with mock.patch.object(controllers.MessageController, '_count',
+                               autospec=True) as count:
+            stats = self.controller.stats(queue_name, project=self.project)
+            self.assertFalse(count.called)
+
+        message_stats = stats['messages']
+        self.assertEqual(message_stats['total'], 3)
+        self.assertEqual(message_stats['claimed'], 2)
+        self.assertEqual(message_stats['free'], 1)
+        self.assertEqual(message_stats['oldest']['id'], ids[1])
+        self.assertEqual(message_stats['newest']['id'], ids[-1])
+
+        self.claim_controller.delete(queue_name, claim_id,
+                                     project=self.project)
+        self.message_controller.bulk_delete(queue_name, ids[1:3],
+                                            project=self.project)
+
+        stats = self.controller.stats(queue_name, project=self.project)
+        message_stats = stats['messages']
+        self.assertEqual(message_stats['total'], 1)
+        self.assertEqual(message_stats['claimed'], 0)
+        self.assertEqual(message_stats['oldest']['id'], ids[-1])
+
+    def test_stats_are_reconciled(self):
+        queue_name = 'stats-test'
+        self.controller.create(queue_name, project=self.project)
+        self.message_controller.post(queue_name, [{'ttl': 300}] * 2,
+                                     'uuid', project=self.project)
+
+        # Simulate drift, e.g., due to messages
+        # having been removed by the TTL index.
+        self.controller._update_stats(queue_name, self.project,
+                                      messages=5)
+
+        stats = self.controller.stats(queue_name, project=self.project)
+        self.assertEqual(stats['messages']['total'], 7)
+
+        timeutils.set_time_override()
+        timeutils.advance_time_seconds(61)
+
+        stats = self.controller.stats(queue_name, project=self.project)
+        self.assertEqual(stats['messages']['total'], 2)
+
+
 @testing.requires_mongodb
 class MongodbMessageTests(base.MessageControllerTest):
 
@@ -155,11 +431,23 @@ class MongodbMessageTests(base.MessageControllerTest):
     def test_indexes(self):
         for collection in self.controller._collections:
             indexes = collection.index_information()
-            self.assertIn('active', indexes)
+            self.assertIn('active_echo', indexes)
+            self.assertIn(('u', 1), indexes['active_echo']['key'])
             self.assertIn('claimed', indexes)
             self.assertIn('queue_marker', indexes)
             self.assertIn('counting', indexes)
 
+    def test_legacy_active_index_is_dropped(self):
+        collection = self.controller._collections[0]
+        collection.ensure_index([('p_q', 1), ('k', 1), ('c.e', 1)],
+                                name='active')
+
+        self.controller._ensure_indexes(collection)
+        self.assertNotIn('active', collection.index_information())
+
+        # Once dropped, the index is not missed
+        self.controller._ensure_indexes(collection)
+
     def test_message_counter(self):
         queue_name = 'marker_test'
         iterations = 10
@@ -277,6 +565,387 @@ class MongodbMessageTests(base.MessageControllerTest):
 
         self.assertEqual(actual_ids, expected_ids)
 
+    def test_post_with_reserved_markers(self):
+        queue_name = 'marker_test'
+        self.queue_controller.create(queue_name)
+
+        self.driver.conf.set_override('reserve_markers', True,
+                                      group=options.MONGODB_GROUP)
+        self.addCleanup(self.driver.conf.clear_override,
+                        'reserve_markers', group=options.MONGODB_GROUP)
+
+        controller = controllers.MessageController(self.driver)
+        uuid = '97b64000-2526-11e3-b088-d85c1300734c'
+
+        marker = self.queue_controller._reserve_markers(queue_name, amount=3)
+        self.assertEqual(marker, 1)
+        self.assertEqual(self.queue_controller._get_counter(queue_name), 4)
+        self.queue_controller._commit_markers(queue_name, first=marker,
+                                              amount=3)
+
+        # Simulate a worker that posted without
+        # reserving markers, and crashed before incrementing the
+        # counter, so that the next reservation collides with it.
+        with mock.patch.object(mongodb.queues.QueueController,
+                               '_inc_counter', autospec=True):
+            self.controller.post(queue_name, [{'ttl': 60, 'body': 0}], uuid)
+
+        created = controller.post(queue_name,
+                                  [{'ttl': 60, 'body': 1},
+                                   {'ttl': 60, 'body': 2}],
+                                  uuid)
+        self.assertEqual(len(created), 2)
+
+        # First reservation collided on marker 4, the
+        # retry claimed [6, 8), so the counter lands on 8.
+        self.assertEqual(self.queue_controller._get_counter(queue_name), 8)
+
+        interaction = controller.list(queue_name, client_uuid=uuid,
+                                      echo=True)
+        bodies = [msg['body'] for msg in next(interaction)]
+        self.assertEqual(bodies, [0, 1, 2])
+
+    def test_post_with_reserved_markers_partial_conflict(self):
+        queue_name = 'marker_test'
+        self.queue_controller.create(queue_name)
+
+        self.driver.conf.set_override('reserve_markers', True,
+                                      group=options.MONGODB_GROUP)
+        self.addCleanup(self.driver.conf.clear_override,
+                        'reserve_markers', group=options.MONGODB_GROUP)
+
+        controller = controllers.MessageController(self.driver)
+        uuid = '97b64000-2526-11e3-b088-d85c1300734c'
+
+        # Simulate a worker that posted without
+        # reserving markers, taking marker 2, in the middle of the
+        # block that is reserved next.
+        with mock.patch.object(mongodb.queues.QueueController,
+                               '_inc_counter', autospec=True):
+            with mock.patch.object(mongodb.queues.QueueController,
+                                   '_get_counter', autospec=True,
+                                   return_value=2):
+                self.controller.post(queue_name,
+                                     [{'ttl': 60, 'body': 0}], uuid)
+
+        with mock.patch.object(controller, '_backoff_sleep',
+                               return_value=0) as backoff:
+            created = controller.post(queue_name,
+                                      [{'ttl': 60, 'body': i}
+                                       for i in range(1, 4)],
+                                      uuid)
+
+            self.assertEqual(backoff.call_count, 1)
+
+        self.assertEqual(len(set(created)), 3)
+
+        # The first message got marker 1, and the
+        # other two were retried with a fresh block, [4, 6).
+        self.assertEqual(self.queue_controller._get_counter(queue_name), 6)
+
+        interaction = controller.list(queue_name, client_uuid=uuid,
+                                      echo=True)
+        messages = list(next(interaction))
+        self.assertEqual([msg['body'] for msg in messages], [1, 0, 2, 3])
+        self.assertEqual(set(created) - set(msg['id'] for msg in messages),
+                         set())
+
+    def test_list_with_reserved_markers_stops_at_pending_batch(self):
+        queue_name = 'marker_test'
+        self.queue_controller.create(queue_name)
+
+        self.driver.conf.set_override('reserve_markers', True,
+                                      group=options.MONGODB_GROUP)
+        self.addCleanup(self.driver.conf.clear_override,
+                        'reserve_markers', group=options.MONGODB_GROUP)
+
+        controller = controllers.MessageController(self.driver)
+        uuid = '97b64000-2526-11e3-b088-d85c1300734c'
+
+        def bodies():
+            interaction = controller.list(queue_name, client_uuid=uuid,
+                                          echo=True)
+            return [msg['body'] for msg in next(interaction)]
+
+        controller.post(queue_name, [{'ttl': 60, 'body': 0}], uuid)
+
+        # Simulate a worker that reserved a block, but
+        # has yet to insert its messages.
+        marker = self.queue_controller._reserve_markers(queue_name, amount=2)
+        self.assertEqual(marker, 2)
+
+        controller.post(queue_name, [{'ttl': 60, 'body': 3}], uuid)
+        self.assertEqual(bodies(), [0])
+
+        self.queue_controller._commit_markers(queue_name, first=marker,
+                                              amount=2)
+        self.assertEqual(bodies(), [0, 3])
+        self.assertEqual(
+            self.queue_controller._committed_marker(queue_name), 5)
+
+    def test_list_with_reserved_markers_skips_stalled_batch(self):
+        queue_name = 'marker_test'
+        self.queue_controller.create(queue_name)
+
+        self.driver.conf.set_override('reserve_markers', True,
+                                      group=options.MONGODB_GROUP)
+        self.addCleanup(self.driver.conf.clear_override,
+                        'reserve_markers', group=options.MONGODB_GROUP)
+
+        controller = controllers.MessageController(self.driver)
+        uuid = '97b64000-2526-11e3-b088-d85c1300734c'
+
+        # Simulate a worker that crashed after reserving a block
+        self.queue_controller._reserve_markers(queue_name, amount=2)
+        controller.post(queue_name, [{'ttl': 60, 'body': 2}], uuid)
+
+        interaction = controller.list(queue_name, client_uuid=uuid,
+                                      echo=True)
+        self.assertEqual(list(next(interaction)), [])
+
+        timeutils.set_time_override(timeutils.utcnow())
+        self.addCleanup(timeutils.clear_time_override)
+        timeutils.advance_time_seconds(10)
+
+        interaction = controller.list(queue_name, client_uuid=uuid,
+                                      echo=True)
+        self.assertEqual([msg['body'] for msg in next(interaction)], [2])
+
+    def test_delete_in_single_round_trip(self):
+        queue_name = 'delete_test'
+        self.queue_controller.create(queue_name)
+        [message_id] = self.controller.post(
+            queue_name, [{'ttl': 60}], '97b64000-2526-11e3-b088-d85c1300734c')
+
+        collection = self.controller._collection(queue_name)
+        with mock.patch.object(collection, 'find_and_modify',
+                               wraps=collection.find_and_modify) as fam:
+            self.controller.delete(queue_name, message_id)
+
+            self.assertEqual(fam.call_count, 1)
+            self.assertTrue(fam.call_args[1]['remove'])
+
+        self.assertRaises(storage.exceptions.MessageDoesNotExist,
+                          self.controller.get, queue_name, message_id)
+
+    def test_pop_skips_messages_claimed_meanwhile(self):
+        queue_name = 'pop_test'
+        self.queue_controller.create(queue_name)
+        self.controller.post(queue_name,
+                             [{'ttl': 60, 'body': i} for i in range(3)],
+                             '97b64000-2526-11e3-b088-d85c1300734c')
+
+        head = self.controller._claimable(queue_name,
+                                          {'_id': 1, 't': 1, 'e': 1, 'b': 1},
+                                          limit=3)
+
+        # Simulate another consumer claiming the first
+        # message after it was read as part of the head.
+        self.claim_controller.create(queue_name, {'ttl': 60, 'grace': 60},
+                                     limit=1)
+
+        with mock.patch.object(self.controller, '_claimable',
+                               return_value=head):
+            popped = self.controller.pop(queue_name, 3)
+
+        self.assertEqual([msg['body'] for msg in popped], [1, 2])
+        self.assertNotIn('claim', popped[0])
+
+        claimed = list(self.controller._claimed(queue_name, None))
+        self.assertEqual([msg['body'] for msg in claimed], [0])
+
+    def test_rebalance(self):
+        # Make sure the original driver's controller is
+        # loaded before the partitioning changes, since it is used to
+        # delete the queue when tearing down the test.
+        self.assertIsNotNone(self.driver.message_controller)
+
+        conf = self.driver.conf
+        overrides = {
+            'partitions': 3,
+            'partition_vnodes': 20,
+            'previous_partitions': 2,
+        }
+
+        for name, value in overrides.items():
+            conf.set_override(name, value, group=options.MONGODB_GROUP)
+            self.addCleanup(conf.clear_override, name,
+                            group=options.MONGODB_GROUP)
+
+        driver = mongodb.DataDriver(conf)
+        controller = driver.message_controller
+
+        def drop():
+            for collection in controller._collections:
+                collection.drop()
+
+        self.addCleanup(drop)
+
+        # Find a queue that moves to another partition
+        queue_name = next(name for name in ('rebalance-%d' % i
+                                            for i in range(100))
+                          if len(controller._partitions(name)) == 2)
+
+        self.queue_controller.create(queue_name)
+        uuid = '97b64000-2526-11e3-b088-d85c1300734c'
+
+        self.controller.post(queue_name,
+                             [{'ttl': 300, 'body': i} for i in range(3)],
+                             uuid)
+        controller.post(queue_name, [{'ttl': 300, 'body': 3}], uuid)
+
+        # Reads span both partitions until rebalanced
+        claim_id, claimed = driver.claim_controller.create(
+            queue_name, {'ttl': 60, 'grace': 60}, limit=1)
+        self.assertEqual([msg['body'] for msg in claimed], [0])
+
+        bodies = [msg['body'] for msg in next(controller.list(
+            queue_name, echo=True, include_claimed=True))]
+        self.assertEqual(bodies, [0, 1, 2, 3])
+
+        self.assertEqual(rebalance.rebalance(driver, batch_size=2), 3)
+        self.assertEqual(rebalance.rebalance(driver), 0)
+
+        partition, previous = controller._partitions(queue_name)
+        self.assertEqual(
+            controller._collections[previous].find().count(), 0)
+        self.assertEqual(
+            controller._collections[partition].find().count(), 4)
+
+        bodies = [msg['body'] for msg in next(controller.list(
+            queue_name, echo=True))]
+        self.assertEqual(bodies, [1, 2, 3])
+
+        claim, claimed = driver.claim_controller.get(queue_name, claim_id)
+        self.assertEqual([msg['body'] for msg in claimed], [0])
+
+    def test_rebalance_shrink(self):
+        self.assertIsNotNone(self.driver.message_controller)
+
+        conf = self.driver.conf
+        overrides = {
+            'partitions': 1,
+            'previous_partitions': 2,
+        }
+
+        for name, value in overrides.items():
+            conf.set_override(name, value, group=options.MONGODB_GROUP)
+            self.addCleanup(conf.clear_override, name,
+                            group=options.MONGODB_GROUP)
+
+        driver = mongodb.DataDriver(conf)
+        controller = driver.message_controller
+
+        # Partitions being drained are still reachable
+        self.assertEqual(len(controller._collections), 2)
+
+        def drop():
+            for collection in controller._collections:
+                collection.drop()
+
+        self.addCleanup(drop)
+
+        queue_name = next(name for name in ('shrink-%d' % i
+                                            for i in range(100))
+                          if len(controller._partitions(name)) == 2)
+
+        self.queue_controller.create(queue_name)
+        uuid = '97b64000-2526-11e3-b088-d85c1300734c'
+
+        self.controller.post(queue_name,
+                             [{'ttl': 300, 'body': i} for i in range(2)],
+                             uuid)
+
+        bodies = [msg['body'] for msg in next(controller.list(
+            queue_name, echo=True))]
+        self.assertEqual(bodies, [0, 1])
+
+        self.assertEqual(rebalance.rebalance(driver), 2)
+
+        partition, previous = controller._partitions(queue_name)
+        self.assertEqual(
+            controller._collections[previous].find().count(), 0)
+        self.assertEqual(
+            controller._collections[partition].find().count(), 2)
+
+    def test_secondary_reads(self):
+        queue_name = 'secondary_reads_test'
+        self.queue_controller.create(queue_name)
+        self.controller.post(queue_name, [{'ttl': 60}],
+                             '97b64000-2526-11e3-b088-d85c1300734c')
+
+        conf = self.driver.conf
+        conf.set_override('secondary_reads', True,
+                          group=options.MONGODB_GROUP)
+        self.addCleanup(conf.clear_override, 'secondary_reads',
+                        group=options.MONGODB_GROUP)
+
+        driver = mongodb.DataDriver(conf)
+        controller = driver.message_controller
+        collection = controller._collection(queue_name)
+
+        secondary = (
+            pymongo.read_preferences.ReadPreference.SECONDARY_PREFERRED)
+
+        with mock.patch.object(utils.StalenessMonitor, 'read_preference',
+                               return_value=secondary):
+            with mock.patch.object(collection, 'find',
+                                   wraps=collection.find) as find:
+                messages = list(next(controller.list(queue_name)))
+                self.assertEqual(len(messages), 1)
+
+                controller.first(queue_name)
+                self.assertEqual(controller._count(queue_name), 1)
+
+                for args, kwargs in find.call_args_list:
+                    self.assertEqual(kwargs['read_preference'], secondary)
+
+                # Claimed messages are always read
+                # from the primary.
+                find.reset_mock()
+                list(controller._claimed(queue_name, None))
+
+                kwargs = find.call_args[1]
+                self.assertNotEqual(kwargs['read_preference'], secondary)
+
+    def test_post_events(self):
+        queue_name = 'post_events_test'
+        self.queue_controller.create(queue_name)
+
+        conf = self.driver.conf
+        conf.set_override('post_events', True, group=options.MONGODB_GROUP)
+        self.addCleanup(conf.clear_override, 'post_events',
+                        group=options.MONGODB_GROUP)
+
+        driver = mongodb.DataDriver(conf)
+        controller = driver.message_controller
+
+        # Stands in for the events tailer of some
+        # other process.
+        tailer = events.Events(driver.queues_database,
+                               driver.mongodb_conf.post_events_size)
+
+        with notifier.watch(queue_name) as watcher:
+            controller.post(queue_name, [{'ttl': 60}] * 2,
+                            '97b64000-2526-11e3-b088-d85c1300734c')
+
+            # Signaled in-process by post()
+            self.assertTrue(watcher.wait(0))
+
+            tailer._dispatch(tailer._cursor())
+            self.assertTrue(watcher.wait(0))
+
+            # Events are only dispatched once, and
+            # never by the process that posted them.
+            tailer._dispatch(tailer._cursor())
+            own = driver.post_events
+            own._dispatch(own._cursor())
+            self.assertFalse(watcher.wait(0))
+
+        event = driver.queues_database.events.find_one({'p_q': '/' +
+                                                        queue_name})
+        self.assertEqual(event['k'], 2)
+
     def test_empty_queue_exception(self):
         queue_name = 'empty-queue-test'
         self.queue_controller.create(queue_name)
@@ -333,6 +1002,436 @@ class MongodbClaimTests(base.ClaimControllerTest):
                           self.controller.update, self.queue_name,
                           claim_id, {}, project=self.project)
 
+    def test_create_without_reading_back(self):
+        self.message_controller.post(self.queue_name,
+                                     [{'ttl': 300, 'body': 0},
+                                      {'ttl': 60, 'body': 1}],
+                                     'uuid', project=self.project)
+
+        with mock.patch.object(controllers.ClaimController, 'get',
+                               autospec=True) as get:
+            claim_id, messages = self.controller.create(
+                self.queue_name, {'ttl': 60, 'grace': 60},
+                project=self.project)
+
+            self.assertFalse(get.called)
+
+        messages = list(messages)
+        self.assertEqual([msg['body'] for msg in messages], [0, 1])
+
+        # The second message would have expired
+        # before the claim, so it must have been extended.
+        self.assertEqual([msg['ttl'] for msg in messages], [300, 120])
+
+        claim, stored = self.controller.get(self.queue_name, claim_id,
+                                            project=self.project)
+        self.assertEqual(sorted(msg['ttl'] for msg in stored), [120, 300])
+
+    def test_create_with_lanes(self):
+        self.driver.conf.set_override('claim_lanes', 3,
+                                      group=options.MONGODB_GROUP)
+        self.addCleanup(self.driver.conf.clear_override, 'claim_lanes',
+                        group=options.MONGODB_GROUP)
+
+        self.message_controller.post(self.queue_name,
+                                     [{'ttl': 300, 'body': i}
+                                      for i in range(5)],
+                                     'uuid', project=self.project)
+
+        meta = {'ttl': 60, 'grace': 60}
+        with mock.patch('random.randrange', return_value=1):
+            claim_id, messages = self.controller.create(
+                self.queue_name, meta, project=self.project, limit=2)
+
+        self.assertEqual([msg['body'] for msg in messages], [2, 3])
+
+        # The last lane is topped up from the first.
+        with mock.patch('random.randrange', return_value=1):
+            claim_id, messages = self.controller.create(
+                self.queue_name, meta, project=self.project, limit=2)
+
+        self.assertEqual([msg['body'] for msg in messages], [4, 0])
+
+        with mock.patch('random.randrange') as randrange:
+            claim_id, messages = self.controller.create(
+                self.queue_name, meta, project=self.project, limit=2)
+
+            self.assertFalse(randrange.called)
+
+        self.assertEqual([msg['body'] for msg in messages], [1])
+
+        scope = utils.scope_queue_name(self.queue_name, self.project)
+        snapshot = self.driver.metrics.snapshot(scope)
+        histogram = snapshot['histograms']['claims.create.claimed']
+        self.assertThat(histogram['count'], matchers.GreaterThan(2))
+
+    def test_create_with_head_cache(self):
+        conf = self.driver.conf
+        conf.set_override('head_cache_size', 4,
+                          group=options.MONGODB_GROUP)
+        self.addCleanup(conf.clear_override, 'head_cache_size',
+                        group=options.MONGODB_GROUP)
+
+        driver = mongodb.DataDriver(conf)
+        controller = driver.claim_controller
+        msg_ctrl = driver.message_controller
+
+        ids = msg_ctrl.post(self.queue_name,
+                            [{'ttl': 300, 'body': i} for i in range(10)],
+                            'uuid', project=self.project)
+
+        meta = {'ttl': 60, 'grace': 60}
+        claim_id, messages = controller.create(self.queue_name, meta,
+                                               project=self.project,
+                                               limit=2)
+        self.assertEqual([msg['body'] for msg in messages], [0, 1])
+
+        # Simulate another process claiming the
+        # next message in the cached head. The stale head is dropped,
+        # and the index is read once more to make up for it.
+        self.controller.create(self.queue_name, meta,
+                               project=self.project, limit=1)
+
+        claim_id, messages = controller.create(self.queue_name, meta,
+                                               project=self.project,
+                                               limit=2)
+        self.assertEqual([msg['body'] for msg in messages], [3, 4])
+
+        claim_id, messages = controller.create(self.queue_name, meta,
+                                               project=self.project,
+                                               limit=1)
+        self.assertEqual([msg['body'] for msg in messages], [5])
+
+        with mock.patch.object(msg_ctrl, '_active') as active:
+            claim_id, messages = controller.create(self.queue_name, meta,
+                                                   project=self.project,
+                                                   limit=1)
+            self.assertFalse(active.called)
+
+        self.assertEqual([msg['body'] for msg in messages], [6])
+
+        # Deleting an unclaimed message drops it from
+        # the cached head, so the next claim has to read again.
+        msg_ctrl.delete(self.queue_name, ids[7], project=self.project)
+
+        claim_id, messages = controller.create(self.queue_name, meta,
+                                               project=self.project,
+                                               limit=2)
+        self.assertEqual([msg['body'] for msg in messages], [8, 9])
+
+        # Released messages must be claimable again
+        controller.delete(self.queue_name, claim_id, project=self.project)
+
+        claim_id, messages = controller.create(self.queue_name, meta,
+                                               project=self.project,
+                                               limit=2)
+        self.assertEqual([msg['body'] for msg in messages], [8, 9])
+
+
+@testing.requires_mongodb
+class MongodbSeparateClaimsTests(base.ClaimControllerTest):
+    driver_class = mongodb.DataDriver
+    controller_class = controllers.ClaimController
+
+    def setUp(self):
+        super(MongodbSeparateClaimsTests, self).setUp()
+        self.load_conf('wsgi_mongodb.conf')
+
+        conf = self.driver.conf
+        conf.set_override('separate_claims', True,
+                          group=options.MONGODB_GROUP)
+        self.addCleanup(conf.clear_override, 'separate_claims',
+                        group=options.MONGODB_GROUP)
+
+        self.driver = mongodb.DataDriver(conf)
+        self.controller = self.driver.claim_controller
+        self.queue_controller = self.driver.queue_controller
+        self.message_controller = self.driver.message_controller
+
+    def tearDown(self):
+        for collection in self.message_controller._collections:
+            collection.drop()
+
+        for collection in self.message_controller._claim_collections:
+            collection.drop()
+
+        self.queue_controller._collection.drop()
+        super(MongodbSeparateClaimsTests, self).tearDown()
+
+    def test_indexes(self):
+        for collection in self.message_controller._claim_collections:
+            indexes = collection.index_information()
+            self.assertIn('ttl', indexes)
+            self.assertIn('renewed', indexes)
+
+    def test_renewal_outlives_stamped_expiration(self):
+        self.message_controller.post(self.queue_name,
+                                     [{'ttl': 300}] * 3,
+                                     'uuid', project=self.project)
+
+        timeutils.set_time_override()
+        claim_id, messages = self.controller.create(
+            self.queue_name, {'ttl': 60, 'grace': 60},
+            project=self.project, limit=2)
+        self.assertEqual(len(list(messages)), 2)
+
+        timeutils.advance_time_seconds(30)
+
+        collection = self.message_controller._collection(self.queue_name,
+                                                         self.project)
+        with mock.patch.object(collection, 'update') as update:
+            self.controller.update(self.queue_name, claim_id,
+                                   {'ttl': 80}, project=self.project)
+            self.assertFalse(update.called)
+
+        # Go past the expiration time that was
+        # stamped on the messages when the claim was created.
+        timeutils.advance_time_seconds(40)
+
+        claim, messages = self.controller.get(self.queue_name, claim_id,
+                                              project=self.project)
+        self.assertEqual(claim['ttl'], 80)
+        self.assertEqual(claim['age'], 40)
+        self.assertEqual(len(list(messages)), 2)
+
+        active = list(next(self.message_controller.list(
+            self.queue_name, project=self.project, echo=True)))
+        self.assertEqual(len(active), 1)
+
+        stats = self.queue_controller.stats(self.queue_name,
+                                            project=self.project)
+        self.assertEqual(stats['messages']['claimed'], 2)
+
+        self.controller.delete(self.queue_name, claim_id,
+                               project=self.project)
+
+        active = list(next(self.message_controller.list(
+            self.queue_name, project=self.project, echo=True)))
+        self.assertEqual(len(active), 3)
+
+        timeutils.advance_time_seconds(100)
+        self.assertRaises(storage.exceptions.ClaimDoesNotExist,
+                          self.controller.update, self.queue_name,
+                          claim_id, {'ttl': 100}, project=self.project)
+
+    def test_stale_candidates_under_renewed_claim_are_skipped(self):
+        self.message_controller.post(self.queue_name,
+                                     [{'ttl': 300}] * 2,
+                                     'uuid', project=self.project)
+
+        timeutils.set_time_override()
+
+        # Candidates read before the claim was made, as they would
+        # be from a stale head cache.
+        fields = {'_id': 1, 't': 1, 'e': 1, 'b': 1}
+        stale = self.message_controller._claimable(
+            self.queue_name, fields, project=self.project)
+        self.assertEqual(len(stale), 2)
+
+        claim_id, messages = self.controller.create(
+            self.queue_name, {'ttl': 60, 'grace': 60},
+            project=self.project)
+        self.assertEqual(len(list(messages)), 2)
+
+        self.controller.update(self.queue_name, claim_id,
+                               {'ttl': 200}, project=self.project)
+
+        # Go past the expiration time that was
+        # stamped on the messages when the claim was created.
+        timeutils.advance_time_seconds(100)
+        now = timeutils.utcnow_ts()
+
+        claim = {'id': objectid.ObjectId(), 'e': now + 60}
+        msgs, claimed = self.message_controller._claim_head(
+            self.queue_name, self.project, stale, claim, fields, now)
+        self.assertEqual(claimed, 0)
+
+        with mock.patch.object(self.message_controller, '_claimable',
+                               return_value=stale):
+            popped = self.message_controller.pop(self.queue_name, 2,
+                                                 project=self.project)
+            self.assertEqual(popped, [])
+
+        claim, messages = self.controller.get(self.queue_name, claim_id,
+                                              project=self.project)
+        self.assertEqual(len(list(messages)), 2)
+
+
+@testing.requires_mongodb
+class MongodbBucketsMessageTests(base.MessageControllerTest):
+    driver_class = mongodb.DataDriver
+    controller_class = controllers.MessageController
+
+    def setUp(self):
+        super(MongodbBucketsMessageTests, self).setUp()
+        self.load_conf('wsgi_mongodb.conf')
+
+        conf = self.driver.conf
+        conf.set_override('bucket_seconds', 60,
+                          group=options.MONGODB_GROUP)
+        self.addCleanup(conf.clear_override, 'bucket_seconds',
+                        group=options.MONGODB_GROUP)
+
+        self.driver = mongodb.DataDriver(conf)
+        self.controller = self.driver.message_controller
+        self.queue_controller = self.driver.queue_controller
+        self.claim_controller = self.driver.claim_controller
+
+    def tearDown(self):
+        for db in self.driver.message_databases:
+            for name in db.collection_names():
+                if name.startswith('messages') or name == 'buckets':
+                    db.drop_collection(name)
+
+        self.queue_controller._collection.drop()
+        super(MongodbBucketsMessageTests, self).tearDown()
+
+    def _post(self, ttl):
+        # ObjectIds embed the current time, so
+        # keep them in step with the overridden clock.
+        with mock.patch('time.time', return_value=timeutils.utcnow_ts()):
+            return self.controller.post(self.queue_name, [{'ttl': ttl}],
+                                        'uuid', project=self.project)
+
+    def test_messages_are_bucketed_by_creation_time(self):
+        timeutils.set_time_override()
+
+        first = self._post(120)
+
+        timeutils.advance_time_seconds(60)
+        second = self._post(120)
+
+        partition_buckets = self.controller._partition_buckets(
+            self.queue_name, self.project)
+        buckets = [partition_buckets.bucket_for_id(utils.to_oid(mid))
+                   for mid in first + second]
+        self.assertEqual(buckets[1], buckets[0] + 1)
+
+        # Listing merges every live bucket, in order
+        messages = list(next(self.controller.list(
+            self.queue_name, project=self.project, echo=True)))
+        self.assertEqual([msg['id'] for msg in messages], first + second)
+
+        found = self.controller.bulk_get(self.queue_name, first + second,
+                                         project=self.project)
+        self.assertEqual(len(list(found)), 2)
+
+    def test_listing_stops_once_limit_is_filled(self):
+        timeutils.set_time_override()
+
+        ids = []
+        for i in range(3):
+            ids += self._post(300)
+            timeutils.advance_time_seconds(60)
+
+        queried = []
+        find = pymongo.collection.Collection.find
+
+        def tracked_find(collection, *args, **kwargs):
+            queried.append(collection.name)
+            return find(collection, *args, **kwargs)
+
+        with mock.patch.object(pymongo.collection.Collection, 'find',
+                               autospec=True, side_effect=tracked_find):
+            messages = list(next(self.controller.list(
+                self.queue_name, project=self.project, limit=1, echo=True)))
+
+        # The first bucket fills the page, and only the
+        # next one is checked for out-of-order messages.
+        self.assertEqual([msg['id'] for msg in messages], ids[:1])
+        self.assertEqual(len(queried), 2)
+
+    def test_post_backs_out_of_marker_taken_in_adjacent_bucket(self):
+        timeutils.set_time_override(datetime.datetime(2013, 1, 1, 0, 0, 55))
+
+        # Simulate a parallel post that took the same
+        # marker in the previous bucket, and has yet to increment
+        # the counter.
+        with mock.patch.object(mongodb.queues.QueueController,
+                               '_inc_counter', autospec=True):
+            first = self._post(300)
+
+        timeutils.advance_time_seconds(10)
+        with mock.patch.object(self.controller, '_backoff_sleep',
+                               return_value=0) as backoff:
+            second = self._post(300)
+
+            self.assertEqual(backoff.call_count, 1)
+
+        messages = list(next(self.controller.list(
+            self.queue_name, project=self.project, echo=True)))
+        self.assertEqual([msg['id'] for msg in messages], first + second)
+
+    def test_expired_buckets_are_dropped(self):
+        timeutils.set_time_override()
+
+        ids = self._post(60)
+
+        partition_buckets = self.controller._partition_buckets(
+            self.queue_name, self.project)
+        bucket = partition_buckets.bucket_for_id(utils.to_oid(ids[0]))
+        collection = partition_buckets.collection_for_id(
+            utils.to_oid(ids[0]))
+
+        # Expired messages are filtered out, even
+        # though their bucket has not been dropped yet.
+        timeutils.advance_time_seconds(90)
+        self.assertEqual(self.controller._count(self.queue_name,
+                                                self.project), 0)
+        self.assertEqual(collection.count(), 1)
+
+        timeutils.advance_time_seconds(120)
+        self._post(60)
+
+        database = self.controller._collection(self.queue_name,
+                                               self.project).database
+        self.assertNotIn('messages_' + str(bucket),
+                         database.collection_names())
+
+    def test_claim_extends_bucket(self):
+        timeutils.set_time_override()
+
+        ids = self._post(60)
+
+        self.claim_controller.create(self.queue_name,
+                                     {'ttl': 300, 'grace': 60},
+                                     project=self.project)
+
+        # The message outlives its original TTL, so
+        # its bucket must not be dropped along the way.
+        timeutils.advance_time_seconds(240)
+        self._post(60)
+
+        message = self.controller.get(self.queue_name, ids[0],
+                                      project=self.project)
+        self.assertEqual(message['id'], ids[0])
+
+    def test_claim_does_not_extend_expired_bucket(self):
+        # Start at the beginning of a bucket, so that
+        # the first message's bucket is still the previous one, and
+        # is not dropped, when the second message is posted.
+        timeutils.set_time_override(datetime.datetime(2013, 1, 1))
+
+        expired = self._post(60)
+
+        timeutils.advance_time_seconds(90)
+        live = self._post(60)
+
+        self.claim_controller.create(self.queue_name,
+                                     {'ttl': 300, 'grace': 60},
+                                     project=self.project)
+
+        partition_buckets = self.controller._partition_buckets(
+            self.queue_name, self.project)
+        now = timeutils.utcnow_ts()
+
+        def bucket_expires(mid):
+            bucket = partition_buckets.bucket_for_id(utils.to_oid(mid))
+            return partition_buckets._meta.find_one({'_id': bucket})['e']
+
+        self.assertTrue(bucket_expires(expired[0]) <= now)
+        self.assertEqual(bucket_expires(live[0]), now + 360)
+
 
 @testing.requires_mongodb
 class MongodbShardsTests(base.ShardsControllerTest):
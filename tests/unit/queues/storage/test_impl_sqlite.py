@@ -13,12 +13,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import mock
+from oslo.config import cfg
+
 from marconi.queues import storage
 from marconi.queues.storage import sqlite
 from marconi.queues.storage.sqlite import controllers
+from marconi.queues.storage.sqlite import driver
+from marconi.queues.storage.sqlite import migrations
+from marconi.queues.storage.sqlite import utils
+from marconi import tests as testing
 from marconi.tests.queues.storage import base
 
 
+def _query_plan(data_driver, sql, *args):
+    """Returns the steps that SQLite plans for a query, as one string."""
+    return '\n'.join(step[-1] for step in
+                     data_driver.run('explain query plan ' + sql, *args))
+
+
 class SQliteQueueTests(base.QueueControllerTest):
     driver_class = sqlite.DataDriver
     controller_class = controllers.QueueController
@@ -41,7 +60,250 @@ class SQliteMessageTests(base.MessageControllerTest):
                           self.controller.first,
                           'foo', None, sort='dosomething()')
 
+    def test_reap_expired(self):
+        for name, value in (('gc_interval', 3600), ('gc_batch_size', 2)):
+            self.driver.conf.set_override(name, value,
+                                          group=driver._SQLITE_GROUP)
+            self.addCleanup(self.driver.conf.clear_override, name,
+                            group=driver._SQLITE_GROUP)
+
+        queue_name = 'reap-test'
+        self.queue_controller.create(queue_name, None)
+        client_uuid = uuid.uuid4()
+
+        def count():
+            return self.driver.get('select count(*) from Messages')[0]
+
+        # Messages with a TTL of 0 expire right away,
+        # and are reaped after being posted, one chunk per post.
+        with mock.patch.object(self.driver, 'run',
+                               wraps=self.driver.run) as run:
+            ids = self.controller.post(queue_name,
+                                       [{'ttl': 0, 'body': i}
+                                        for i in range(5)],
+                                       client_uuid, None)
+
+            deletes = [args for args, kwargs in run.call_args_list
+                       if 'delete from Messages' in args[0]]
+            self.assertEqual(len(deletes), 1)
+
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(count(), 3)
+
+        # The backlog is worked off by the next posts,
+        # regardless of gc_interval.
+        for i in range(2):
+            self.controller.post(queue_name, [{'ttl': 60, 'body': 'live'}],
+                                 client_uuid, None)
+
+        self.assertEqual(count(), 2)
+
+        # Once caught up, the next sweep waits for gc_interval
+        self.controller.post(queue_name, [{'ttl': 0, 'body': 'expired'}],
+                             client_uuid, None)
+        self.assertEqual(count(), 3)
+
+    def test_listing_walks_queue_in_order(self):
+        self.queue_controller.create('fizbit', None)
+
+        with mock.patch.object(self.driver, 'run',
+                               wraps=self.driver.run) as run:
+            list(next(self.controller.list('fizbit', None,
+                                           client_uuid=uuid.uuid4())))
+            self.assertRaises(storage.exceptions.QueueIsEmpty,
+                              self.controller.first, 'fizbit', None)
+
+            queries = [(args[0], args[1:]) for args, kwargs
+                       in run.call_args_list if 'order by' in args[0]]
+
+        self.assertEqual(len(queries), 2)
+        for sql, args in queries:
+            plan = _query_plan(self.driver, sql, *args)
+
+            self.assertIn('Messages_qid_id', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_bulk_chunks(self):
+        queue_name = 'bulk-test'
+        self.queue_controller.create(queue_name, None)
+        client_uuid = uuid.uuid4()
+
+        count = utils.BULK_CHUNK_SIZE * 2 + 1
+        ids = self.controller.post(queue_name,
+                                   [{'ttl': 60, 'body': i}
+                                    for i in range(count)],
+                                   client_uuid, None)
+
+        # The same statement is run for every chunk,
+        # whatever the number of IDs.
+        with mock.patch.object(self.driver, 'run',
+                               wraps=self.driver.run) as run:
+            messages = list(self.controller.bulk_get(queue_name, ids, None))
+            list(self.controller.bulk_get(queue_name, ids[:1], None))
+
+            statements = set(args[0] for args, kwargs in run.call_args_list
+                             if 'select' in args[0])
+            self.assertEqual(len(statements), 1)
+
+        self.assertEqual(sorted(m['body'] for m in messages), range(count))
+
+        self.controller.bulk_delete(queue_name, ids[1:], None)
+
+        remaining = list(self.controller.bulk_get(queue_name, ids, None))
+        self.assertEqual([m['id'] for m in remaining], ids[:1])
+
+        claim_id, claimed = self.claim_controller.create(
+            queue_name, {'ttl': 60, 'grace': 60}, None)
+        self.assertEqual(len(list(claimed)), 1)
+
+        left = self.controller.bulk_delete(queue_name, ids, None,
+                                           claim=claim_id)
+        self.assertEqual(left, [])
+        self.assertEqual(self.driver.get('select count(*) from Messages')[0],
+                         0)
+
 
 class SQliteClaimTests(base.ClaimControllerTest):
     driver_class = sqlite.DataDriver
     controller_class = controllers.ClaimController
+
+    def test_claimable_head_walks_queue_in_order(self):
+        # Finding the head must not read and sort every
+        # free message in the queue before applying the limit.
+        plan = _query_plan(self.driver, utils.claimable_head('id'), 1, 10)
+
+        self.assertIn('Messages_qid_id', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class SQliteFileTests(testing.TestBase):
+
+    def setUp(self):
+        super(SQliteFileTests, self).setUp()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.driver = sqlite.DataDriver(self._conf('marconi.db'))
+        self.queue_controller = self.driver.queue_controller
+        self.message_controller = self.driver.message_controller
+
+    def _conf(self, filename):
+        conf = cfg.ConfigOpts()
+        conf.register_opts(driver._SQLITE_OPTIONS, group=driver._SQLITE_GROUP)
+        conf.set_override('database', os.path.join(self.tmpdir, filename),
+                          group=driver._SQLITE_GROUP)
+
+        return conf
+
+    def test_pragmas(self):
+        self.assertEqual(self.driver.get('PRAGMA journal_mode')[0], 'wal')
+
+        # 1 is NORMAL
+        self.assertEqual(self.driver.get('PRAGMA synchronous')[0], 1)
+
+    def test_readers_proceed_while_writing(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def write():
+            with self.driver('immediate'):
+                self.queue_controller.create('fizbit', None)
+                started.set()
+                release.wait(10)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.assertTrue(started.wait(10))
+
+        # Does not block on the writer, and does not
+        # see its uncommitted changes.
+        try:
+            self.assertFalse(self.queue_controller.exists('fizbit', None))
+        finally:
+            release.set()
+            writer.join()
+
+        self.assertTrue(self.queue_controller.exists('fizbit', None))
+
+    def test_parallel_posts(self):
+        self.queue_controller.create('fizbit', None)
+        client_uuid = uuid.uuid4()
+        posted = []
+
+        def post():
+            for i in range(10):
+                posted.extend(self.message_controller.post(
+                    'fizbit', [{'ttl': 60, 'body': i}] * 2,
+                    client_uuid, None))
+
+        threads = [threading.Thread(target=post) for i in range(4)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(posted)), 80)
+
+        stats = self.queue_controller.stats('fizbit', None)
+        self.assertEqual(stats['messages']['total'], 80)
+
+    def test_upgrade_schema(self):
+        # Create a database the way the driver did
+        # before there were any migrations.
+        with mock.patch.object(migrations, 'MIGRATIONS', []):
+            old_driver = sqlite.DataDriver(self._conf('old.db'))
+
+        self.assertEqual(old_driver.get('PRAGMA user_version')[0], 0)
+
+        old_driver.run('''
+            insert into Queues
+            values (null, '', 'fizbit', ?)''', old_driver.pack({}))
+        old_driver.run('''
+            insert into Messages
+            values (null, 1, 60, ?, ?, julianday() * 86400.0)''',
+                       old_driver.pack('old'), old_driver.uuid(uuid.uuid4()))
+        old_driver.run('''
+            insert into Messages
+            values (null, 1, 60, ?, ?, julianday() * 86400.0)''',
+                       old_driver.pack('claimed'),
+                       old_driver.uuid(uuid.uuid4()))
+        old_driver.run('''
+            insert into Claims
+            values (null, 1, 60, julianday() * 86400.0)''')
+        old_driver.run('''
+            insert into Locked
+            values (1, 2)''')
+
+        new_driver = sqlite.DataDriver(self._conf('old.db'))
+
+        version = new_driver.get('PRAGMA user_version')[0]
+        self.assertEqual(version, len(migrations.MIGRATIONS))
+
+        indexes = set(name for name, in new_driver.run('''
+            select name from sqlite_master where type = 'index' '''))
+        self.assertTrue(set(['Messages_qid_id', 'Messages_expires',
+                             'Messages_qid_claim_expires', 'Messages_cid',
+                             'Claims_qid']).issubset(indexes))
+
+        for expires, created, ttl in new_driver.run('''
+                select expires, created, ttl from Messages'''):
+            self.assertEqual(expires, created + ttl)
+
+        messages = list(next(new_driver.message_controller.list(
+            'fizbit', None, echo=True)))
+        self.assertEqual([m['body'] for m in messages], ['old'])
+
+        # Claims are carried over to the messages
+        stats = new_driver.queue_controller.stats('fizbit', None)
+        self.assertEqual(stats['messages']['claimed'], 1)
+        self.assertEqual(stats['messages']['free'], 1)
+
+        claim, messages = new_driver.claim_controller.get(
+            'fizbit', utils.cid_encode(1), None)
+        self.assertEqual([m['body'] for m in messages], ['claimed'])
+
+        # Upgrading is a no-op from then on
+        sqlite.DataDriver(self._conf('old.db'))
+        self.assertEqual(new_driver.get('PRAGMA user_version')[0], version)
@@ -0,0 +1,67 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from marconi.queues.storage import notifier
+from marconi.tests import base
+
+
+class TestNotifier(base.TestBase):
+
+    def setUp(self):
+        super(TestNotifier, self).setUp()
+        self.notifier = notifier.Notifier()
+
+    def test_wait_times_out(self):
+        with self.notifier.watch('fizbit', '480924') as watcher:
+            self.assertFalse(watcher.wait(0.01))
+
+    def test_notify_wakes_watcher(self):
+        timer = threading.Timer(0.05, self.notifier.notify,
+                                args=('fizbit', '480924'))
+
+        with self.notifier.watch('fizbit', '480924') as watcher:
+            start = time.time()
+            timer.start()
+
+            self.assertTrue(watcher.wait(10))
+            self.assertLess(time.time() - start, 5)
+
+        timer.join()
+
+    def test_notify_before_wait_is_not_missed(self):
+        with self.notifier.watch('fizbit') as watcher:
+            self.notifier.notify('fizbit', '')
+
+            self.assertTrue(watcher.wait(0))
+            self.assertFalse(watcher.wait(0))
+
+    def test_notify_is_scoped(self):
+        with self.notifier.watch('fizbit', '480924') as watcher:
+            self.notifier.notify('fizbit', 'other-project')
+            self.notifier.notify('other-queue', '480924')
+
+            self.assertFalse(watcher.wait(0))
+
+    def test_released_after_watching(self):
+        with self.notifier.watch('fizbit'):
+            with self.notifier.watch('fizbit'):
+                pass
+
+            self.assertEqual(len(self.notifier._entries), 1)
+
+        self.assertEqual(len(self.notifier._entries), 0)
@@ -0,0 +1,173 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from oslo.config import cfg
+
+from marconi import common
+from marconi.common.cache import cache as oslo_cache
+from marconi.queues.storage import exceptions
+from marconi.queues.storage import pipeline
+from marconi.queues.storage import sqlite
+from marconi.queues.storage import stages
+from marconi.tests import base
+
+
+class TestQueueCache(base.TestBase):
+
+    def setUp(self):
+        super(TestQueueCache, self).setUp()
+
+        conf = cfg.ConfigOpts()
+        self.storage = sqlite.DataDriver(conf)
+        self.controller = self.storage.queue_controller
+
+        self.cache = oslo_cache.get_cache(conf)
+        self.stage = stages.QueueCache(conf, self.cache)
+        self.pipeline = common.Pipeline([self.stage, self.controller])
+
+    def test_reads_are_cached(self):
+        self.controller.create('fizbit', project='480924')
+        self.controller.set_metadata('fizbit', {'a': 1}, project='480924')
+
+        with mock.patch.object(self.controller, 'get_metadata',
+                               wraps=self.controller.get_metadata) as get:
+            for i in range(3):
+                self.assertTrue(self.pipeline.exists('fizbit', '480924'))
+                self.assertEqual(
+                    self.pipeline.get_metadata('fizbit', '480924'), {'a': 1})
+
+            self.assertEqual(get.call_count, 1)
+
+        with mock.patch.object(self.controller, 'stats',
+                               wraps=self.controller.stats) as stats:
+            for i in range(3):
+                self.assertEqual(
+                    self.pipeline.stats('fizbit', '480924')['messages'],
+                    {'claimed': 0, 'free': 0, 'total': 0})
+
+            self.assertEqual(stats.call_count, 1)
+
+    def test_writes_invalidate(self):
+        self.assertFalse(self.pipeline.exists('fizbit', None))
+
+        # Missing queues are never cached
+        self.pipeline.create('fizbit', None)
+        self.assertTrue(self.pipeline.exists('fizbit', None))
+        self.assertEqual(self.pipeline.get_metadata('fizbit', None), {})
+
+        self.pipeline.set_metadata('fizbit', {'a': 1}, None)
+        self.assertEqual(self.pipeline.get_metadata('fizbit', None), {'a': 1})
+
+        self.pipeline.delete('fizbit', None)
+        self.assertFalse(self.pipeline.exists('fizbit', None))
+        self.assertRaises(exceptions.QueueDoesNotExist,
+                          self.pipeline.get_metadata, 'fizbit', None)
+
+    def test_writes_invalidate_afterwards(self):
+        self.pipeline.create('fizbit', None)
+
+        # Simulate a lookup made by another request while the write
+        # is in progress, which caches the old value.
+        original = self.controller.set_metadata
+
+        def set_metadata(name, metadata, project=None):
+            self.assertEqual(self.pipeline.get_metadata('fizbit', None), {})
+            original(name, metadata, project)
+
+        with mock.patch.object(self.controller, 'set_metadata',
+                               side_effect=set_metadata) as write:
+            self.pipeline.set_metadata('fizbit', {'a': 1}, None)
+            self.assertEqual(write.call_count, 1)
+
+        self.assertEqual(self.pipeline.get_metadata('fizbit', None), {'a': 1})
+
+    def test_writes_reach_later_stages(self):
+        stage = mock.Mock(spec=['create', 'set_metadata', 'delete'])
+        stage.create.return_value = None
+        stage.set_metadata.return_value = None
+        stage.delete.return_value = None
+
+        self.pipeline = common.Pipeline([self.stage, stage,
+                                         self.controller])
+
+        self.pipeline.create('fizbit', None)
+        self.pipeline.set_metadata('fizbit', {'a': 1}, None)
+        self.pipeline.delete('fizbit', None)
+
+        stage.create.assert_called_once_with('fizbit', None)
+        stage.set_metadata.assert_called_once_with('fizbit', {'a': 1}, None)
+        stage.delete.assert_called_once_with('fizbit', None)
+
+    def test_misses_reach_later_stages(self):
+        self.controller.create('fizbit', None)
+
+        stage = mock.Mock(spec=['get_metadata', 'stats'])
+        stage.get_metadata.return_value = None
+        stage.stats.return_value = None
+
+        self.pipeline = common.Pipeline([self.stage, stage,
+                                         self.controller])
+
+        for i in range(3):
+            self.assertEqual(self.pipeline.get_metadata('fizbit', None), {})
+            self.assertEqual(
+                self.pipeline.stats('fizbit', None)['messages']['total'], 0)
+
+        # Only the first lookups miss the cache
+        stage.get_metadata.assert_called_once_with('fizbit', None)
+        stage.stats.assert_called_once_with('fizbit', None)
+
+    def test_metadata_ttl_zero_disables_caching(self):
+        conf = cfg.ConfigOpts()
+        stage = stages.QueueCache(conf, oslo_cache.get_cache(conf))
+        conf.set_override('metadata_ttl', 0, group=stages._QUEUE_CACHE_GROUP)
+        queues = common.Pipeline([stage, self.controller])
+
+        queues.create('fizbit', None)
+
+        with mock.patch.object(self.controller, 'get_metadata',
+                               wraps=self.controller.get_metadata) as get:
+            for i in range(3):
+                self.assertTrue(queues.exists('fizbit', None))
+                self.assertEqual(queues.get_metadata('fizbit', None), {})
+
+            self.assertEqual(get.call_count, 3)
+
+
+class TestStageLoading(base.TestBase):
+
+    def test_stages_get_the_arguments_they_declare(self):
+        class Bare(object):
+            pass
+
+        class Configured(object):
+            def __init__(self, conf):
+                self.conf = conf
+
+        class Cached(object):
+            def __init__(self, conf, cache, storage=None):
+                self.args = (conf, cache, storage)
+
+        stage = pipeline._load_stage(Bare, conf='c', cache='k', storage='s')
+        self.assertIsInstance(stage, Bare)
+
+        stage = pipeline._load_stage(Configured, conf='c', cache='k',
+                                     storage='s')
+        self.assertEqual(stage.conf, 'c')
+
+        stage = pipeline._load_stage(Cached, conf='c', cache='k',
+                                     storage='s')
+        self.assertEqual(stage.args, ('c', 'k', 's'))
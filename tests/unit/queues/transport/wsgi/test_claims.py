@@ -208,6 +208,28 @@ class ClaimsBaseTest(base.TestBase):
         self.simulate_patch(claim['href'], body=doc)
         self.assertEqual(self.srmock.status, falcon.HTTP_404)
 
+    def test_claim_wait(self):
+        self.boot.conf.set_override('message_wait_max', 20,
+                                    group='queues:limits:transport')
+        self.addCleanup(self.boot.conf.clear_override, 'message_wait_max',
+                        group='queues:limits:transport')
+
+        doc = '{"ttl": 100, "grace": 60}'
+
+        # Claim every message in the queue, so that
+        # the next request has to wait for more.
+        self.simulate_post(self.claims_path, self.project_id, body=doc,
+                           query_string='limit=10')
+        self.assertEqual(self.srmock.status, falcon.HTTP_201)
+
+        self.simulate_post(self.claims_path, self.project_id, body=doc,
+                           query_string='wait=1')
+        self.assertEqual(self.srmock.status, falcon.HTTP_204)
+
+        self.simulate_post(self.claims_path, self.project_id, body=doc,
+                           query_string='wait=21')
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
     def test_nonexistent(self):
         self.simulate_post('/v1/queues/nonexistent/claims', self.project_id,
                            body='{"ttl": 100, "grace": 60}')
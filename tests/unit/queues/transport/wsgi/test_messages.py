@@ -280,6 +280,111 @@ class MessagesBaseTest(base.TestBase):
         self.simulate_delete(target, self.project_id, query_string=params)
         self.assertEqual(self.srmock.status, falcon.HTTP_204)
 
+    def test_bulk_delete_with_claim(self):
+        path = self.queue_path + '/messages'
+        self._post_messages(path, repeat=3)
+        [target, params] = self.srmock.headers_dict['Location'].split('?')
+        ids = self._get_msg_ids(self.srmock.headers_dict)
+
+        body = self.simulate_post(self.queue_path + '/claims',
+                                  self.project_id,
+                                  body='{"ttl": 100, "grace": 100}',
+                                  query_string='limit=2')
+        self.assertEqual(self.srmock.status, falcon.HTTP_201)
+
+        claim_id = self.srmock.headers_dict['Location'].rsplit('/', 1)[-1]
+        claimed = [msg['href'].rsplit('/', 1)[-1].split('?')[0]
+                   for msg in json.loads(body[0])]
+
+        body = self.simulate_delete(target, self.project_id,
+                                    query_string=(params + '&claim_id=' +
+                                                  claim_id))
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        result = json.loads(body[0])
+        self.assertEqual(sorted(result['deleted']), sorted(claimed))
+        self.assertEqual(result['not_deleted'],
+                         [id for id in ids if id not in claimed])
+
+        # Messages that are not part of the claim are untouched
+        self.simulate_get(target, self.project_id, query_string=params)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+    def test_pop(self):
+        path = self.queue_path + '/messages'
+        self._post_messages(path, repeat=3)
+        ids = self._get_msg_ids(self.srmock.headers_dict)
+
+        body = self.simulate_delete(path, self.project_id,
+                                    query_string='pop=2')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        messages = json.loads(body[0])['messages']
+        self.assertEqual([msg['href'] for msg in messages],
+                         [path + '/' + id for id in ids[:2]])
+
+        for msg in messages:
+            self.simulate_get(msg['href'], self.project_id)
+            self.assertEqual(self.srmock.status, falcon.HTTP_404)
+
+        body = self.simulate_delete(path, self.project_id,
+                                    query_string='pop=2')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual(len(json.loads(body[0])['messages']), 1)
+
+        self.simulate_delete(path, self.project_id, query_string='pop=2')
+        self.assertEqual(self.srmock.status, falcon.HTTP_204)
+
+    def test_pop_bad_request(self):
+        path = self.queue_path + '/messages'
+
+        self.simulate_delete(path, self.project_id, query_string='pop=0')
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+        self.simulate_delete(path, self.project_id,
+                             query_string='pop=2&ids=a,b')
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+    def _enable_waiting(self, seconds=20):
+        self.boot.conf.set_override('message_wait_max', seconds,
+                                    group='queues:limits:transport')
+        self.addCleanup(self.boot.conf.clear_override, 'message_wait_max',
+                        group='queues:limits:transport')
+
+    def test_list_wait_disabled_by_default(self):
+        path = self.queue_path + '/messages'
+
+        self.simulate_get(path, self.project_id, headers=self.headers,
+                          query_string='wait=1')
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+    def test_list_wait(self):
+        self._enable_waiting()
+        path = self.queue_path + '/messages'
+
+        # Nothing is posted while waiting, so the
+        # request should time out without finding any messages.
+        self.simulate_get(path, self.project_id, headers=self.headers,
+                          query_string='wait=1')
+        self.assertEqual(self.srmock.status, falcon.HTTP_204)
+
+        # Messages that are already there are returned right away
+        self._post_messages(path, repeat=2)
+        body = self.simulate_get(path, self.project_id,
+                                 headers=self.headers,
+                                 query_string='wait=20&echo=true')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual(len(json.loads(body[0])['messages']), 2)
+
+    @ddt.data(-1, 21)
+    def test_list_wait_out_of_range(self, wait):
+        self._enable_waiting()
+        path = self.queue_path + '/messages'
+
+        self.simulate_get(path, self.project_id, headers=self.headers,
+                          query_string='wait=%d' % wait)
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
     def test_list(self):
         path = self.queue_path + '/messages'
         self._post_messages(path, repeat=10)
@@ -0,0 +1,62 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+
+import json
+
+import falcon
+
+import base  # noqa
+from marconi.common import metrics
+
+
+class TestMetrics(base.TestBase):
+
+    config_filename = 'wsgi_sqlite_admin.conf'
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+
+        self.sink = metrics.get_sink(self.boot.conf)
+        self.sink.reset()
+
+    def tearDown(self):
+        self.sink.reset()
+        super(TestMetrics, self).tearDown()
+
+    def test_get(self):
+        self.sink.incr('messages.post.conflicts', scope='480924/fizbit')
+        self.sink.observe('messages.post.attempts', 3, scope='480924/fizbit')
+
+        result = self.simulate_get('/v1/metrics')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        snapshot = json.loads(result[0])
+        self.assertEqual(
+            snapshot['global']['counters']['messages.post.conflicts'], 1)
+
+        scoped = snapshot['scopes']['480924/fizbit']
+        histogram = scoped['histograms']['messages.post.attempts']
+        self.assertEqual(histogram['count'], 1)
+        self.assertEqual(histogram['sum'], 3)
+        self.assertEqual(histogram['buckets']['5'], 1)
+
+    def test_get_empty(self):
+        result = self.simulate_get('/v1/metrics')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        snapshot = json.loads(result[0])
+        self.assertEqual(snapshot['global'],
+                         {'counters': {}, 'histograms': {}})
+        self.assertEqual(snapshot['scopes'], {})
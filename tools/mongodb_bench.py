@@ -0,0 +1,357 @@
+# Copyright (c) 2013 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the MongoDB storage driver.
+
+Each benchmark runs against a live MongoDB server, using the storage
+options from the given config file, on a queue of its own that is
+deleted afterwards. For example:
+
+    $ python tools/mongodb_bench.py claim --rounds 500 --limit 10
+
+Benchmarks only use the storage driver's public interface, so that
+the same command can be run on two revisions to compare them.
+
+Benchmarks:
+
+    claim: Latency of creating a claim, and the number of MongoDB
+        operations issued per claim.
+
+    contention: Number of messages claimed per request when several
+        consumers claim messages from the same queue at once, e.g.,
+        with and without --lanes.
+
+    echo: Cost of listing a page of messages with echo disabled, as
+        the number of the caller's own messages at the head of the
+        queue grows.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import functools
+import os
+import threading
+import time
+import uuid
+
+from oslo.config import cfg
+from pymongo import collection as mongo_collection
+
+from marconi.queues.storage import mongodb
+from marconi.queues.storage.mongodb import options
+
+_DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), os.pardir,
+                               'tests', 'etc', 'wsgi_mongodb.conf')
+
+# Collection methods that each send one request to the server (cursor
+# methods, such as find, count once even if they fetch more batches).
+_OPERATIONS = ('find', 'find_one', 'find_and_modify', 'insert',
+               'update', 'remove', 'aggregate')
+
+
+class OperationCounter(object):
+    """Counts the MongoDB operations issued while enabled.
+
+    Methods that call one another, such as find_one and find, count
+    as a single operation.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def enabled(self):
+        methods = vars(mongo_collection.Collection)
+        originals = dict((name, methods[name]) for name in _OPERATIONS)
+
+        for name, method in originals.items():
+            setattr(mongo_collection.Collection, name, self._wrap(method))
+
+        try:
+            yield self
+        finally:
+            for name, method in originals.items():
+                setattr(mongo_collection.Collection, name, method)
+
+    def _wrap(self, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            if depth == 0:
+                with self._lock:
+                    self.count += 1
+
+            self._local.depth = depth + 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._local.depth = depth
+
+        return wrapper
+
+
+def _percentile(samples, percent):
+    ordered = sorted(samples)
+    index = int(round((len(ordered) - 1) * percent / 100.0))
+    return ordered[index]
+
+
+def _report_latency(title, samples):
+    print(title)
+    print('  requests:   %d' % len(samples))
+    print('  mean (ms):  %.2f' % (1000 * sum(samples) / len(samples)))
+
+    for percent in (50, 90, 99):
+        print('  p%d (ms):    %.2f' % (percent,
+                                       1000 * _percentile(samples, percent)))
+
+
+@contextlib.contextmanager
+def _queue(driver, project='bench'):
+    """Creates a queue for the benchmark, and deletes it afterwards."""
+
+    name = 'bench-' + str(uuid.uuid4())
+    driver.queue_controller.create(name, project=project)
+
+    try:
+        yield name, project
+    finally:
+        driver.queue_controller.delete(name, project=project)
+
+
+def _post(driver, queue_name, project, count, client_uuid=None):
+    """Posts `count` messages to the queue, in batches."""
+
+    client_uuid = client_uuid or str(uuid.uuid4())
+
+    while count > 0:
+        batch = min(count, 100)
+        messages = [{'ttl': 3600, 'body': {'n': i}} for i in range(batch)]
+        driver.message_controller.post(queue_name, messages, client_uuid,
+                                       project=project)
+        count -= batch
+
+
+def bench_claim(driver, args):
+    """Times claim creation on a queue with a single consumer."""
+
+    claim_ctrl = driver.claim_controller
+    msg_ctrl = driver.message_controller
+
+    latencies = []
+    counter = OperationCounter()
+
+    with _queue(driver) as (queue_name, project):
+        for _ in range(args.rounds):
+            _post(driver, queue_name, project, args.limit)
+
+            with counter.enabled():
+                start = time.time()
+                claim_id, messages = claim_ctrl.create(
+                    queue_name, {'ttl': 60, 'grace': 60},
+                    project=project, limit=args.limit)
+                messages = list(messages)
+                latencies.append(time.time() - start)
+
+            msg_ctrl.bulk_delete(queue_name,
+                                 [msg['id'] for msg in messages],
+                                 project=project)
+
+    _report_latency('Claim creation (limit=%d)' % args.limit, latencies)
+    print('  operations per claim: %.2f' % (float(counter.count) /
+                                            args.rounds))
+
+
+def bench_contention(driver, args):
+    """Counts the messages claimed per request by parallel consumers."""
+
+    conf = driver.conf
+    if args.lanes is not None:
+        conf.set_override('claim_lanes', args.lanes,
+                          group=options.MONGODB_GROUP)
+
+    # Every consumer gets a driver of its own, as if it were talking
+    # to a different server process.
+    consumers = [mongodb.DataDriver(conf) for _ in range(args.workers)]
+
+    results = []
+    lock = threading.Lock()
+    barrier = threading.Event()
+
+    def consume(consumer, queue_name, project):
+        claim_ctrl = consumer.claim_controller
+        claimed = []
+        latencies = []
+
+        barrier.wait()
+        for _ in range(args.rounds):
+            start = time.time()
+            claim_id, messages = claim_ctrl.create(
+                queue_name, {'ttl': 300, 'grace': 60},
+                project=project, limit=args.limit)
+            claimed.append(len(list(messages)))
+            latencies.append(time.time() - start)
+
+        with lock:
+            results.append((claimed, latencies))
+
+    with _queue(driver) as (queue_name, project):
+        # Post enough messages that the queue never runs dry, so that
+        # every short claim is due to contention.
+        _post(driver, queue_name, project,
+              args.workers * args.rounds * args.limit)
+
+        threads = [threading.Thread(target=consume,
+                                    args=(consumer, queue_name, project))
+                   for consumer in consumers]
+
+        for thread in threads:
+            thread.start()
+
+        start = time.time()
+        barrier.set()
+
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.time() - start
+
+    claimed = [n for result in results for n in result[0]]
+    latencies = [n for result in results for n in result[1]]
+
+    lanes = 'default' if args.lanes is None else args.lanes
+    _report_latency('Claim creation (workers=%d, limit=%d, lanes=%s)' %
+                    (args.workers, args.limit, lanes), latencies)
+    print('  claimed per request: %.2f' % (float(sum(claimed)) /
+                                           len(claimed)))
+    print('  short claims:        %.1f%%' %
+          (100.0 * len([n for n in claimed if n < args.limit]) /
+           len(claimed)))
+    print('  empty claims:        %.1f%%' %
+          (100.0 * claimed.count(0) / len(claimed)))
+    print('  messages per second: %.1f' % (sum(claimed) / elapsed))
+
+
+def _scan_counters(connection):
+    """Returns the server's (keys, documents) examined so far.
+
+    These counters are server-wide, so the benchmark should be the
+    only client. Returns None when the server does not report them
+    (before MongoDB 3.0).
+    """
+
+    status = connection.admin.command('serverStatus')
+    executor = status.get('metrics', {}).get('queryExecutor', {})
+
+    try:
+        return executor['scanned'], executor['scannedObjects']
+    except KeyError:
+        return None
+
+
+def bench_echo(driver, args):
+    """Times listing a page while skipping the caller's own messages."""
+
+    msg_ctrl = driver.message_controller
+    own_uuid = str(uuid.uuid4())
+
+    for own in args.own:
+        latencies = []
+        keys = documents = 0
+
+        with _queue(driver) as (queue_name, project):
+            _post(driver, queue_name, project, own, client_uuid=own_uuid)
+            _post(driver, queue_name, project, args.limit)
+
+            for _ in range(args.rounds):
+                before = _scan_counters(driver.connection)
+
+                start = time.time()
+                cursor = next(msg_ctrl.list(queue_name, project=project,
+                                            limit=args.limit, echo=False,
+                                            client_uuid=own_uuid))
+                list(cursor)
+                latencies.append(time.time() - start)
+
+                after = _scan_counters(driver.connection)
+                if before is not None and after is not None:
+                    keys += after[0] - before[0]
+                    documents += after[1] - before[1]
+
+        _report_latency('List one page (own messages at head=%d, '
+                        'limit=%d)' % (own, args.limit), latencies)
+
+        if before is not None:
+            print('  keys examined per page:      %.1f' %
+                  (float(keys) / args.rounds))
+            print('  documents examined per page: %.1f' %
+                  (float(documents) / args.rounds))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the MongoDB storage driver.')
+    parser.add_argument('--config-file', default=_DEFAULT_CONFIG,
+                        help='Config file with the MongoDB storage options')
+
+    subparsers = parser.add_subparsers()
+
+    claim = subparsers.add_parser('claim', help=bench_claim.__doc__)
+    claim.add_argument('--rounds', type=int, default=200,
+                       help='Number of claims to create')
+    claim.add_argument('--limit', type=int, default=10,
+                       help='Number of messages per claim')
+    claim.set_defaults(bench=bench_claim)
+
+    contention = subparsers.add_parser('contention',
+                                       help=bench_contention.__doc__)
+    contention.add_argument('--workers', type=int, default=20,
+                            help='Number of parallel consumers')
+    contention.add_argument('--rounds', type=int, default=50,
+                            help='Number of claims per consumer')
+    contention.add_argument('--limit', type=int, default=10,
+                            help='Number of messages per claim')
+    contention.add_argument('--lanes', type=int,
+                            help='Overrides the claim_lanes option')
+    contention.set_defaults(bench=bench_contention)
+
+    echo = subparsers.add_parser('echo', help=bench_echo.__doc__)
+    echo.add_argument('--own', type=int, nargs='+',
+                      default=[0, 1000, 10000],
+                      help='Numbers of own messages to post at the head')
+    echo.add_argument('--rounds', type=int, default=100,
+                      help='Number of pages to list for each number')
+    echo.add_argument('--limit', type=int, default=10,
+                      help='Number of messages per page')
+    echo.set_defaults(bench=bench_echo)
+
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+
+    conf = cfg.ConfigOpts()
+    conf(args=[], default_config_files=[args.config_file])
+
+    args.bench(mongodb.DataDriver(conf), args)
+
+
+if __name__ == '__main__':
+    main()